@@ -0,0 +1,128 @@
+"""
+Shared helpers of the benchmark suite: per-phase step timing, peak memory, workload
+isolation and JSON results tagged with the commit and environment they were measured on.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import subprocess
+import multiprocessing
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.path.join(REPO_DIR, "model")
+
+
+def use_model_dirs(*subdirs):
+    """
+    Puts `model/<subdir>` on the import path. The model directories hold same-named script
+    modules (e.g. `dataset`), which is why every workload runs in a process of its own.
+    """
+    for subdir in (MODEL_DIR,) + tuple(os.path.join(MODEL_DIR, subdir) for subdir in subdirs):
+        if subdir not in sys.path:
+            sys.path.insert(0, subdir)
+
+
+def small_eegvit(vit_layers, as_encoder=False):
+    """
+    Randomly initialised EEGViT_pretrained keeping its first `vit_layers` ViT layers. With
+    `as_encoder`, the regression head is dropped so that it returns the pooled hidden state,
+    as the EEG encoder of WavesTransformer.
+    """
+    use_model_dirs("eeg")
+    from model_pretrained import EEGViT_pretrained
+
+    model = EEGViT_pretrained(pretrained=False)
+    model.ViT.vit.encoder.layer = model.ViT.vit.encoder.layer[:vit_layers]
+    if as_encoder:
+        model.ViT.classifier = torch.nn.Identity()
+    return model
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+class StepTimer:
+    """Accumulates wall time per phase of a step, e.g. data, forward, backward and optimizer."""
+
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.steps = 0
+
+    @contextmanager
+    def __call__(self, phase):
+        synchronize(self.device)
+        start = time.perf_counter()
+        yield
+        synchronize(self.device)
+        self.totals[phase] = self.totals.get(phase, 0.0) + time.perf_counter() - start
+
+    def breakdown_ms(self):
+        """Mean milliseconds per step spent in each phase."""
+        return {phase: 1000 * total / max(self.steps, 1) for phase, total in self.totals.items()}
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """Peak allocated CUDA memory, or the peak resident set size of the process on CPU."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # KiB on Linux
+
+
+def run_isolated(function, *args):
+    """Runs `function(*args)` in a fresh process, so that imports and peak memory do not leak across workloads."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(device, threads):
+    return {
+        "commit": git_commit(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "threads": threads,
+        "device": str(device),
+        "cuda": torch.cuda.get_device_name(device) if device.type == "cuda" else None,
+    }
+
+
+def save_results(path, benchmark, settings, results, device, threads):
+    """Writes `results` with the settings and environment they were measured with, see compare.py."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({
+            "benchmark": benchmark,
+            "environment": environment(device, threads),
+            "settings": settings,
+            "results": results,
+        }, f, indent=2)
+    print(f"Saved results to {path}")
@@ -0,0 +1,74 @@
+"""
+Compares two JSON results of the same benchmark, e.g. measured on two commits:
+
+    python benchmarks/compare.py results/before.json results/after.json
+
+Every numeric metric is printed side by side with its relative change. Throughputs
+(`*_per_sec`) are better when higher, every other metric (times, memory) when lower. Changes
+for the worse beyond `--threshold` percent are flagged, and make the script exit with an error
+under `--strict`.
+"""
+
+import sys
+import json
+import argparse
+
+
+def flatten(results, prefix=""):
+    """Numeric leaves of nested results, keyed by their dotted path."""
+    metrics = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def higher_is_better(metric):
+    return metric.endswith("per_sec")
+
+
+def compare(baseline, candidate, threshold):
+    """Rows of (metric, baseline, candidate, change in %, regressed) for the metrics both results have."""
+    baseline, candidate = flatten(baseline["results"]), flatten(candidate["results"])
+    rows = []
+    for metric in baseline:
+        if metric not in candidate:
+            continue
+        before, after = baseline[metric], candidate[metric]
+        change = 100 * (after - before) / before if before else 0.0
+        worse = -change if higher_is_better(metric) else change
+        rows.append((metric, before, after, change, worse > threshold))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline', type=str)
+    parser.add_argument('candidate', type=str)
+    parser.add_argument('--threshold', type=float, default=5.0, help='Percent change for the worse flagged as a regression')
+    parser.add_argument('--strict', action='store_true', help='Exit with an error on regressions')
+    parsed_args = parser.parse_args()
+
+    with open(parsed_args.baseline) as f:
+        baseline = json.load(f)
+    with open(parsed_args.candidate) as f:
+        candidate = json.load(f)
+
+    if baseline["benchmark"] != candidate["benchmark"]:
+        sys.exit(f"Cannot compare {baseline['benchmark']} results with {candidate['benchmark']} ones")
+    if baseline["settings"] != candidate["settings"]:
+        print("Warning: the results were measured with different settings")
+    for key in ("commit", "device", "threads", "torch"):
+        print(f"{key:>8}: {baseline['environment'].get(key)} -> {candidate['environment'].get(key)}")
+
+    rows = compare(baseline, candidate, parsed_args.threshold)
+    width = max(len(row[0]) for row in rows)
+    print(f"{'metric':<{width}} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for metric, before, after, change, regressed in rows:
+        print(f"{metric:<{width}} {before:>12.3f} {after:>12.3f} {change:>+8.1f}%{'  <- regression' if regressed else ''}")
+
+    if parsed_args.strict and any(row[-1] for row in rows):
+        sys.exit(1)
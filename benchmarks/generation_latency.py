@@ -0,0 +1,193 @@
+"""
+Latency and throughput of autoregressive MEG generation with `MatrixGPT2.generate` and
+`WavesTransformer.generate`, on CPU with small, randomly initialised GPT2 configurations.
+
+For every combination of channel count (MatrixGPT2 only), context length, generation length
+and batch size it reports the time to first token (which includes the prompt prefill and,
+for WavesTransformer, the EEG encoding), per-token latency percentiles over the following
+steps, and throughput in tokens/sec. The real-time factor is the number of generated
+timesteps per second over the MEG sampling rate: above 1, generation keeps up with the
+signal. Results are saved as JSON, to be compared across commits with compare.py:
+
+    python benchmarks/generation_latency.py --channels 32 306 --context-lengths 32 128 \
+        --generation-lengths 16 64 --batch-sizes 1 4 --output results/generation.json
+"""
+
+import os
+import time
+import argparse
+import itertools
+import numpy as np
+import torch
+from common import use_model_dirs, small_eegvit, synchronize, run_isolated, save_results
+
+MODELS = ("matrix_gpt2", "waves_transformer")
+
+
+def time_generation(generate, generation_length, device):
+    """Time to first token and per-token latencies, in milliseconds, of one `generate(on_token)` call."""
+    timestamps = []
+
+    def on_token(step, tokens):
+        synchronize(device)
+        timestamps.append(time.perf_counter())
+
+    synchronize(device)
+    start = time.perf_counter()
+    generate(on_token)
+    synchronize(device)
+    total = time.perf_counter() - start
+
+    assert len(timestamps) == generation_length
+    return 1000 * (timestamps[0] - start), 1000 * np.diff(timestamps), total
+
+
+def summarize(runs, tokens_per_step, generation_length, sample_rate):
+    """Aggregates (time to first token, per-token latencies, total time) over repeated runs."""
+    first_token_ms = [run[0] for run in runs]
+    token_ms = np.concatenate([run[1] for run in runs])
+    total_s = np.mean([run[2] for run in runs])
+
+    result = {
+        "time_to_first_token_ms": float(np.median(first_token_ms)),
+        "tokens_per_sec": tokens_per_step * generation_length / total_s,
+        "realtime_factor": generation_length / total_s / sample_rate,
+    }
+    if len(token_ms):
+        result.update({
+            "token_p50_ms": float(np.percentile(token_ms, 50)),
+            "token_p90_ms": float(np.percentile(token_ms, 90)),
+            "token_p99_ms": float(np.percentile(token_ms, 99)),
+        })
+    return result
+
+
+def sweep(settings, make_inputs, generate, device, channel_counts=(None,)):
+    """
+    Runs every configuration of the sweep, `make_inputs(config)` building the inputs of
+    `generate`. Models generating a single stream per row sweep no channel counts.
+    """
+    results = {}
+    for channels, context_length, generation_length, batch_size in itertools.product(
+        channel_counts, settings["context_lengths"], settings["generation_lengths"], settings["batch_sizes"]
+    ):
+        config = {"channels": channels, "context_length": context_length,
+                  "generation_length": generation_length, "batch_size": batch_size}
+        inputs = make_inputs(config)
+        run = lambda: time_generation(
+            lambda on_token: generate(inputs, generation_length, on_token), generation_length, device
+        )
+
+        for _ in range(settings["warmup"]):
+            run()
+        runs = [run() for _ in range(settings["repeats"])]
+
+        streams = batch_size * (channels or 1)
+        result = summarize(runs, streams, generation_length, settings["sample_rate"])
+        name = "_".join(f"{key}{config[field]}" for key, field in (
+            ("ch", "channels"), ("ctx", "context_length"), ("gen", "generation_length"), ("b", "batch_size")
+        ) if config[field] is not None)
+        results[name] = {**config, **result}
+        print(f"{name:>24} {result['time_to_first_token_ms']:>10.1f} {result.get('token_p50_ms', float('nan')):>8.2f} "
+              f"{result.get('token_p90_ms', float('nan')):>8.2f} {result.get('token_p99_ms', float('nan')):>8.2f} "
+              f"{result['tokens_per_sec']:>11.1f} {result['realtime_factor']:>9.3f}")
+    return results
+
+
+def _gpt2_config(settings, n_positions):
+    from transformers import GPT2Config
+
+    return GPT2Config(
+        vocab_size=settings["vocab_size"],
+        n_positions=n_positions,
+        n_embd=settings["embd"],
+        n_layer=settings["layers"],
+        n_head=settings["heads"],
+    )
+
+
+def matrix_gpt2_latency(settings):
+    use_model_dirs("meg")
+    from types import SimpleNamespace
+    from meg_gpt import MatrixGPT2
+
+    torch.manual_seed(settings["seed"])
+    torch.set_num_threads(settings["threads"])
+    device = torch.device(settings["device"])
+    max_positions = max(settings["context_lengths"]) + max(settings["generation_lengths"])
+
+    gpt2_config = _gpt2_config(settings, max_positions)
+    models = {}
+    for channels in settings["channels"]:
+        torch.manual_seed(settings["seed"])
+        model_args = SimpleNamespace(num_channels=channels, vocab_size=settings["vocab_size"], gpt2_config=gpt2_config)
+        models[channels] = MatrixGPT2(gpt2_config, model_args).to(device).eval()
+
+    def make_inputs(config):
+        shape = (config["batch_size"], config["channels"], config["context_length"])
+        return torch.randint(0, settings["vocab_size"], shape, device=device)
+
+    def generate(input_ids, generation_length, on_token):
+        return models[input_ids.shape[1]].generate(input_ids, generation_length, on_token=on_token)
+
+    return sweep(settings, make_inputs, generate, device, channel_counts=settings["channels"])
+
+
+def waves_transformer_latency(settings):
+    use_model_dirs()
+    from waves_transformer import WavesTransformer, EEGConditionedDecoder
+
+    torch.manual_seed(settings["seed"])
+    torch.set_num_threads(settings["threads"])
+    device = torch.device(settings["device"])
+    max_positions = 1 + max(settings["context_lengths"]) + max(settings["generation_lengths"])
+
+    encoder = small_eegvit(settings["vit_layers"], as_encoder=True)
+    decoder = EEGConditionedDecoder(_gpt2_config(settings, max_positions), eeg_dim=encoder.ViT.config.hidden_size)
+    model = WavesTransformer(encoder=encoder, decoder=decoder).to(device).eval()
+
+    def make_inputs(config):
+        # ds000117 EEG windows, padded to 129 rows, and a prompt of MEG tokens
+        eeg = torch.randn(config["batch_size"], 1, 129, 500, device=device)
+        meg = torch.randint(0, settings["vocab_size"], (config["batch_size"], config["context_length"]), device=device)
+        return eeg, meg
+
+    def generate(inputs, generation_length, on_token):
+        return model.generate(*inputs, max_tokens=generation_length, on_token=on_token)
+
+    return sweep(settings, make_inputs, generate, device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, nargs='+', default=list(MODELS), choices=MODELS)
+    parser.add_argument('--channels', type=int, nargs='+', default=[32, 306], help='MEG channels, MatrixGPT2 only')
+    parser.add_argument('--context-lengths', type=int, nargs='+', default=[32, 128])
+    parser.add_argument('--generation-lengths', type=int, nargs='+', default=[16])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--sample-rate', type=float, default=1100.0, help='MEG sampling rate in Hz, 1100 for ds000117')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are saved to')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=min(8, os.cpu_count()))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vocab-size', type=int, default=255)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--embd', type=int, default=128)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--vit-layers', type=int, default=2)
+    parsed_args = parser.parse_args()
+
+    settings = {key: value for key, value in vars(parsed_args).items() if key not in ('models', 'output')}
+    benchmarks = {"matrix_gpt2": matrix_gpt2_latency, "waves_transformer": waves_transformer_latency}
+
+    results = {}
+    for name in parsed_args.models:
+        print(f"{name}\n{'configuration':>24} {'TTFT ms':>10} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+              f"{'tokens/s':>11} {'realtime':>9}")
+        results[name] = run_isolated(benchmarks[name], settings)
+
+    if parsed_args.output is not None:
+        save_results(parsed_args.output, "generation_latency", settings, results,
+                     torch.device(parsed_args.device), parsed_args.threads)
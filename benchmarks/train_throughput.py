@@ -0,0 +1,225 @@
+"""
+Training throughput of the three models on synthetic data shaped like their real workloads:
+
+    eegvit             EEGViT_pretrained on EEGEyeNet trials, 1 x 129 x 500, through EEGEyeNetDataset
+    matrix_gpt2        MatrixGPT2 on Cichy token tensors, 306 channels, through MEGWaves
+    waves_transformer  WavesTransformer on ds000117 windows, 129 EEG rows x 500 samples and MEG tokens
+
+For each workload it reports samples/sec, the mean time per step spent loading data, in the
+forward and backward passes and in the optimizer, and the peak memory. Every workload runs
+in a process of its own with fixed seeds and thread count. Models default to small, randomly
+initialised configurations that run on CPU; pass e.g. `--gpt2-layers 12 --gpt2-embd 768
+--gpt2-heads 12 --vit-layers 12` for the full-size ones. Results are saved as JSON, to be
+compared across commits with compare.py:
+
+    python benchmarks/train_throughput.py --output results/train.json
+"""
+
+import os
+import argparse
+import tempfile
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Subset, TensorDataset
+from common import StepTimer, use_model_dirs, small_eegvit, reset_peak_memory, peak_memory_mb, run_isolated, save_results
+
+WORKLOADS = ("eegvit", "matrix_gpt2", "waves_transformer")
+
+
+def _cycle(loader):
+    while True:
+        yield from loader
+
+
+def measure_training(model, loader, step_loss, device, settings):
+    """
+    Runs `warmup` + `steps` optimizer steps of `model` over `loader`, where `step_loss(model,
+    batch)` returns the loss of a batch already on `device` and its number of samples.
+    """
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    timer = StepTimer(device)
+    batches = _cycle(loader)
+    model.train()
+
+    samples = 0
+    for step in range(settings["warmup"] + settings["steps"]):
+        if step == settings["warmup"]:
+            timer.reset()
+            reset_peak_memory(device)
+            samples = 0
+
+        with timer("data"):
+            batch = next(batches)
+            batch = batch if isinstance(batch, (tuple, list)) else (batch,)
+            batch = tuple(tensor.to(device, non_blocking=True) for tensor in batch)
+        with timer("forward"):
+            loss, num_samples = step_loss(model, batch)
+        with timer("backward"):
+            loss.backward()
+        with timer("optimizer"):
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        samples += num_samples
+
+    timer.steps = settings["steps"]
+    step_time = sum(timer.totals.values())
+    return {
+        "samples_per_sec": samples / step_time,
+        "step_ms": 1000 * step_time / timer.steps,
+        "breakdown_ms": timer.breakdown_ms(),
+        "peak_memory_mb": peak_memory_mb(device),
+        "parameters": sum(parameter.numel() for parameter in model.parameters()),
+    }
+
+
+def eegvit_workload(settings):
+    use_model_dirs("eeg")
+    from dataset import EEGEyeNetDataset, batch_loader
+
+    torch.manual_seed(settings["seed"])
+    torch.set_num_threads(settings["threads"])
+    device = torch.device(settings["device"])
+    rng = np.random.default_rng(settings["seed"])
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_file = os.path.join(directory, "eegeyenet.npz")
+        num_trials = settings["num_samples"]
+        np.savez(
+            data_file,
+            EEG=rng.normal(size=(num_trials, 500, 129)).astype(np.float32),
+            labels=np.column_stack([np.arange(num_trials), rng.uniform(0, 800, (num_trials, 2))]),
+        )
+        dataset = EEGEyeNetDataset(data_file)
+        dataset.compute_stats()
+        loader = batch_loader(Subset(dataset, np.arange(num_trials)), settings["batch_size"], shuffle=True,
+                              num_workers=settings["num_workers"])
+
+        criterion = nn.MSELoss()
+
+        def step_loss(model, batch):
+            inputs, targets, _ = batch
+            return criterion(model(inputs).squeeze(), targets.squeeze()), len(inputs)
+
+        return measure_training(small_eegvit(settings["vit_layers"]).to(device), loader, step_loss, device, settings)
+
+
+def matrix_gpt2_workload(settings):
+    use_model_dirs("meg")
+    from types import SimpleNamespace
+    from transformers import GPT2Config
+    from meg_gpt import MatrixGPT2
+    from cichy_dataset import MEGWaves
+
+    torch.manual_seed(settings["seed"])
+    torch.set_num_threads(settings["threads"])
+    device = torch.device(settings["device"])
+    rng = np.random.default_rng(settings["seed"])
+
+    gpt2_config = GPT2Config(
+        vocab_size=settings["vocab_size"],
+        n_positions=settings["seq_len"],
+        n_embd=settings["gpt2_embd"],
+        n_layer=settings["gpt2_layers"],
+        n_head=settings["gpt2_heads"],
+    )
+    model_args = SimpleNamespace(num_channels=settings["meg_channels"], vocab_size=settings["vocab_size"], gpt2_config=gpt2_config)
+    model = MatrixGPT2(gpt2_config, model_args).to(device)
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_path = os.path.join(directory, "tokens.npy")
+        shape = (settings["num_samples"], settings["meg_channels"], settings["seq_len"] + model.out_times)
+        np.save(data_path, rng.integers(0, settings["vocab_size"], shape, dtype=np.uint8))
+        loader = DataLoader(MEGWaves(data_path), batch_size=settings["batch_size"], shuffle=True,
+                            num_workers=settings["num_workers"])
+
+        def step_loss(model, batch):
+            tokens = batch[0].long()
+            inputs, targets = tokens[:, :, :-model.out_times], tokens[:, :, -model.out_times:]
+            logits = model({'inputs': inputs})
+            return model.criterion(logits.reshape(-1, model.quant_levels), targets.reshape(-1)), len(tokens)
+
+        return measure_training(model, loader, step_loss, device, settings)
+
+
+def waves_transformer_workload(settings):
+    use_model_dirs("eeg")
+    from transformers import GPT2Config
+    from waves_transformer import WavesTransformer, EEGConditionedDecoder
+
+    torch.manual_seed(settings["seed"])
+    torch.set_num_threads(settings["threads"])
+    device = torch.device(settings["device"])
+    generator = torch.Generator().manual_seed(settings["seed"])
+
+    # the EEGViT backbone as encoder, its pooled 768-d state conditioning the decoder
+    encoder = small_eegvit(settings["vit_layers"], as_encoder=True)
+    decoder = EEGConditionedDecoder(
+        GPT2Config(
+            vocab_size=settings["vocab_size"],
+            n_positions=settings["seq_len"] + 1,
+            n_embd=settings["gpt2_embd"],
+            n_layer=settings["gpt2_layers"],
+            n_head=settings["gpt2_heads"],
+        ),
+        eeg_dim=encoder.ViT.config.hidden_size,
+    )
+    model = WavesTransformer(encoder=encoder, decoder=decoder).to(device)
+
+    # ds000117 windows: EEG padded to 129 rows, and the tokenized MEG following it
+    num_windows = settings["num_samples"]
+    eeg = torch.randn(num_windows, 1, 129, 500, generator=generator)
+    meg = torch.randint(0, settings["vocab_size"], (num_windows, settings["seq_len"] + 1), generator=generator)
+    loader = DataLoader(TensorDataset(eeg, meg), batch_size=settings["batch_size"], shuffle=True,
+                        num_workers=settings["num_workers"])
+    criterion = nn.CrossEntropyLoss()
+
+    def step_loss(model, batch):
+        eeg_tokens, meg_tokens = batch
+        outputs = model(eeg_tokens, meg_tokens[:, :-1])
+        return criterion(outputs.reshape(-1, outputs.shape[-1]), meg_tokens[:, 1:].reshape(-1)), len(meg_tokens)
+
+    return measure_training(model, loader, step_loss, device, settings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workloads', type=str, nargs='+', default=list(WORKLOADS), choices=WORKLOADS)
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are saved to')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=min(8, os.cpu_count()))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--num-samples', type=int, default=64, help='Synthetic samples per workload')
+    parser.add_argument('--num-workers', type=int, default=0, help='DataLoader workers')
+    parser.add_argument('--meg-channels', type=int, default=306)
+    parser.add_argument('--seq-len', type=int, default=32, help='MEG tokens per training sequence')
+    parser.add_argument('--vocab-size', type=int, default=255)
+    parser.add_argument('--gpt2-layers', type=int, default=2)
+    parser.add_argument('--gpt2-embd', type=int, default=128)
+    parser.add_argument('--gpt2-heads', type=int, default=4)
+    parser.add_argument('--vit-layers', type=int, default=2)
+    parsed_args = parser.parse_args()
+
+    settings = {key: value for key, value in vars(parsed_args).items() if key not in ('workloads', 'output')}
+    workloads = {
+        "eegvit": eegvit_workload,
+        "matrix_gpt2": matrix_gpt2_workload,
+        "waves_transformer": waves_transformer_workload,
+    }
+
+    results = {}
+    print(f"{'workload':>18} {'samples/s':>10} {'step ms':>9} {'data':>8} {'forward':>8} {'backward':>9} {'optim':>8} {'peak MB':>9}")
+    for name in parsed_args.workloads:
+        result = results[name] = run_isolated(workloads[name], settings)
+        breakdown = result["breakdown_ms"]
+        print(f"{name:>18} {result['samples_per_sec']:>10.2f} {result['step_ms']:>9.1f} {breakdown['data']:>8.1f} "
+              f"{breakdown['forward']:>8.1f} {breakdown['backward']:>9.1f} {breakdown['optimizer']:>8.1f} "
+              f"{result['peak_memory_mb']:>9.0f}")
+
+    if parsed_args.output is not None:
+        save_results(parsed_args.output, "train_throughput", settings, results,
+                     torch.device(parsed_args.device), parsed_args.threads)
@@ -0,0 +1,174 @@
+"""
+Alignment of the EEG channels of different headsets onto the 129 rows the models take, the
+GSN-HydroCel-129 layout of EEGEyeNet.
+
+A `ChannelMap` is built once per dataset or stream, from sensor names or montage positions,
+as a pair of (source row, target row) index arrays. Applying it to a recording allocates the
+float32 output once and writes every mapped row into it, cropping or zero padding the columns
+in the same write; unmapped target rows stay zero.
+
+    eeg_map = channel_map("epoc_x")
+    eeg = eeg_map.apply(samples, num_columns=500)  # 14 x n -> 129 x 500
+"""
+
+import numpy as np
+from typing import Dict, Optional, Sequence
+
+TARGET_MONTAGE = "GSN-HydroCel-129"
+TARGET_CHANNELS = 129
+
+# sensors of the Emotiv EPOC X, in the order the headset streams them
+EPOC_X_CHANNELS = ["AF3", "F7", "F3", "FC5", "T7", "P7", "O1", "O2", "P8", "T8", "FC6", "F4", "F8", "AF4"]
+
+
+def _contiguous(index: np.ndarray) -> Optional[slice]:
+    """`index` as a slice when it is a run of consecutive rows, which numpy writes without a gather."""
+    if len(index) and np.array_equal(index, np.arange(index[0], index[0] + len(index))):
+        return slice(int(index[0]), int(index[0]) + len(index))
+    return None
+
+
+def _ten_twenty_montage() -> str:
+    import mne
+
+    # standard_1020 is deprecated in recent MNE releases in favour of the same positions on colin27
+    return "colin27_1020" if "colin27_1020" in mne.channels.get_builtin_montages() else "standard_1020"
+
+
+def _montage_positions(montage: str) -> Dict[str, np.ndarray]:
+    import mne
+
+    return mne.channels.make_standard_montage(montage).get_positions()["ch_pos"]
+
+
+def _directions(positions: np.ndarray) -> np.ndarray:
+    """Unit vectors from the center of the sensors, comparable across montages in different frames."""
+    positions = positions - positions.mean(axis=0)
+    return positions / np.linalg.norm(positions, axis=1, keepdims=True)
+
+
+class ChannelMap:
+    """Writes rows `source_index` of a recording into rows `target_index` of a `num_targets`-row array."""
+
+    def __init__(self, source_index: Sequence[int], target_index: Sequence[int], num_targets: int = TARGET_CHANNELS):
+        self.source_index = np.asarray(source_index, dtype=np.int64)
+        self.target_index = np.asarray(target_index, dtype=np.int64)
+        self.num_targets = num_targets
+        if len(self.source_index) != len(self.target_index):
+            raise ValueError("source_index and target_index should have the same length")
+        if len(np.unique(self.target_index)) != len(self.target_index) or np.any(self.target_index >= num_targets):
+            raise ValueError(f"target_index should hold distinct rows below {num_targets}")
+        self._source_rows = _contiguous(self.source_index)
+        self._target_rows = _contiguous(self.target_index)
+
+    def __eq__(self, other):
+        return (isinstance(other, ChannelMap) and self.num_targets == other.num_targets
+                and np.array_equal(self.source_index, other.source_index)
+                and np.array_equal(self.target_index, other.target_index))
+
+    @classmethod
+    def identity(cls, num_sources: int, num_targets: int = TARGET_CHANNELS) -> "ChannelMap":
+        """The first `num_sources` rows kept in place, the others zero padded."""
+        return cls(np.arange(num_sources), np.arange(num_sources), num_targets)
+
+    @classmethod
+    def from_names(cls, source_names: Sequence[str], target_names: Sequence[str]) -> "ChannelMap":
+        """Rows matched by (case-insensitive) channel name, sources without a match are dropped."""
+        targets = {name.lower(): row for row, name in enumerate(target_names)}
+        pairs = [(row, targets[name.lower()]) for row, name in enumerate(source_names) if name.lower() in targets]
+        source_index, target_index = zip(*pairs) if pairs else ((), ())
+        return cls(source_index, target_index, len(target_names))
+
+    @classmethod
+    def from_positions(cls, source_positions: np.ndarray, target_positions: np.ndarray) -> "ChannelMap":
+        """
+        Every source sensor mapped onto the nearest target sensor, by direction from the center
+        of each layout. Pairs are assigned from the closest one on, so that two sources never
+        share a target row.
+        """
+        return cls._nearest(_directions(np.asarray(source_positions)), _directions(np.asarray(target_positions)))
+
+    @classmethod
+    def from_montage(cls,
+                     source_names: Sequence[str],
+                     source_montage: Optional[str] = None,
+                     target_montage: str = TARGET_MONTAGE) -> "ChannelMap":
+        """
+        Maps the `source_names` sensors of `source_montage` (the 10-20 system by default) onto
+        the nearest sensors of `target_montage`, both standard MNE montages.
+        """
+        source_montage = source_montage or _ten_twenty_montage()
+        source_positions = _montage_positions(source_montage)
+        target_positions = _montage_positions(target_montage)
+        missing = [name for name in source_names if name not in source_positions]
+        if missing:
+            raise ValueError(f"Channels {missing} are not in the {source_montage} montage")
+
+        # directions are taken from the center of the whole montage, not of the mapped sensors only
+        directions = dict(zip(source_positions, _directions(np.array(list(source_positions.values())))))
+        return cls._nearest(np.array([directions[name] for name in source_names]),
+                            _directions(np.array(list(target_positions.values()))))
+
+    @classmethod
+    def _nearest(cls, source: np.ndarray, target: np.ndarray) -> "ChannelMap":
+        distances = np.linalg.norm(source[:, None] - target[None], axis=-1)
+
+        source_index, target_index = [], []
+        free_sources, free_targets = set(range(len(source))), set(range(len(target)))
+        for flat in np.argsort(distances, axis=None):
+            row, column = divmod(int(flat), len(target))
+            if row in free_sources and column in free_targets:
+                source_index.append(row)
+                target_index.append(column)
+                free_sources.discard(row)
+                free_targets.discard(column)
+                if not free_sources:
+                    break
+
+        # sorted by source row, so that an in-order assignment reads the rows contiguously
+        order = np.argsort(source_index)
+        return cls(np.asarray(source_index)[order], np.asarray(target_index)[order], len(target))
+
+    def apply(self, data: np.ndarray, num_columns: Optional[int] = None, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Maps the channels x time `data` to a float32 `num_targets` x `num_columns` array, its
+        columns cropped or zero padded to `num_columns` (all of them by default). `out` reuses a
+        preallocated array of that shape.
+        """
+        num_columns = data.shape[1] if num_columns is None else num_columns
+        if out is None:
+            out = np.zeros((self.num_targets, num_columns), dtype=np.float32)
+        else:
+            out.fill(0)
+        columns = min(num_columns, data.shape[1])
+
+        if len(self.source_index) and self.source_index.max() >= data.shape[0]:
+            # mapped rows missing from this recording stay zero
+            present = self.source_index < data.shape[0]
+            out[self.target_index[present], :columns] = data[self.source_index[present], :columns]
+        elif self._source_rows is not None and self._target_rows is not None:
+            out[self._target_rows, :columns] = data[self._source_rows, :columns]
+        else:
+            out[self.target_index, :columns] = data[self.source_index, :columns]
+        return out
+
+
+def fit_columns(data: np.ndarray, num_columns: int) -> np.ndarray:
+    """`data` as float32, cropped or zero padded to `num_columns` columns in a single write."""
+    return ChannelMap.identity(data.shape[0], data.shape[0]).apply(data, num_columns)
+
+
+PRESETS = {
+    # ds000117 EEG, kept in its first 74 rows as the models were trained with
+    "ds000117": lambda: ChannelMap.identity(74),
+    "epoc_x": lambda: ChannelMap.from_montage(EPOC_X_CHANNELS),
+}
+
+
+def channel_map(name) -> ChannelMap:
+    """The `ChannelMap` preset called `name`, see `PRESETS`, or `name` itself when already a map."""
+    if isinstance(name, ChannelMap):
+        return name
+    if name not in PRESETS:
+        raise ValueError(f"Unknown channel map {name}, expected one of {sorted(PRESETS)}")
+    return PRESETS[name]()
@@ -0,0 +1,224 @@
+"""
+Asynchronous checkpointing shared by the training loops.
+
+`CheckpointManager.save` snapshots the state to CPU memory and returns right away; a
+background thread writes the snapshot to disk, applies the retention policy (the best
+checkpoint plus the last `keep_last` ones) and hands the written file to an optional sink,
+e.g. the Hugging Face Hub, so that neither the write nor the upload blocks training.
+"""
+
+import os
+import re
+import glob
+import json
+import queue
+import shutil
+import threading
+import torch
+from torch import nn
+from typing import Any, Optional
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """The underlying model of DataParallel/DistributedDataParallel and torch.compile wrappers."""
+    while True:
+        if hasattr(model, "module"):
+            model = model.module
+        elif hasattr(model, "_orig_mod"):
+            model = model._orig_mod
+        else:
+            return model
+
+
+def snapshot(state: Any) -> Any:
+    """Copies every tensor in a (nested) state to CPU, so training can keep updating the originals."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class LocalDirSink:
+    """Copies uploaded checkpoints to a local directory, e.g. a mounted volume or a test fixture."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, path: str, name: str):
+        shutil.copyfile(path, os.path.join(self.directory, name))
+
+
+class HubSink:
+    """Uploads checkpoints to a Hugging Face Hub repository."""
+
+    def __init__(self, repo_id: str, repo_type: str = "model"):
+        from huggingface_hub import HfApi
+
+        self.api = HfApi()
+        self.repo_id = repo_id
+        self.repo_type = repo_type
+
+    def upload(self, path: str, name: str):
+        self.api.upload_file(
+            path_or_fileobj=path,
+            path_in_repo=name,
+            repo_id=self.repo_id,
+            repo_type=self.repo_type,
+            commit_message=f"Upload {name}",
+        )
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints to `directory` on a background thread.
+
+    Every `save` produces `name_format.format(step=step)`; only the last `keep_last` of them
+    are kept on disk. Saves reporting a `metric` that improves on the best one so far (lower
+    is better with `mode="min"`) are also written to `best_name`. With a `sink`, the best
+    checkpoint (`upload="best"`) or every checkpoint (`upload="all"`) is uploaded after it is
+    written. Upload failures are reported and training goes on, write failures are raised
+    by the next call to `save` or `wait`.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 keep_last: int = 3,
+                 sink=None,
+                 upload: str = "best",
+                 mode: str = "min",
+                 name_format: str = "checkpoint_{step}.pt",
+                 best_name: str = "best.pt",
+                 max_pending: int = 1):
+        if upload not in ("best", "all"):
+            raise ValueError(f"Unknown upload policy {upload}, expected one of best, all")
+        if keep_last < 1:
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}")
+        if mode not in ("min", "max"):
+            raise ValueError(f"Unknown mode {mode}, expected one of min, max")
+
+        self.directory = directory
+        self.keep_last = keep_last
+        self.sink = sink
+        self.upload = upload
+        self.mode = mode
+        self.name_format = name_format
+        self.best_name = best_name
+        os.makedirs(directory, exist_ok=True)
+
+        # best checkpoint so far, persisted so that retention and resuming survive restarts
+        self.manifest_path = os.path.join(directory, "checkpoints.json")
+        self.manifest = {"best_step": None, "best_metric": None}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+        # at most `max_pending` snapshots wait in memory, further saves block until one is written
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def best_metric(self) -> Optional[float]:
+        return self.manifest["best_metric"]
+
+    def _is_better(self, metric: float) -> bool:
+        if self.best_metric is None:
+            return True
+        return metric < self.best_metric if self.mode == "min" else metric > self.best_metric
+
+    def save(self, state: dict, step: int, metric: Optional[float] = None) -> bool:
+        """Queues a checkpoint of `state` for `step`, returning whether it is the new best one."""
+        self._raise_error()
+        is_best = metric is not None and self._is_better(metric)
+        if is_best:
+            self.manifest = {"best_step": step, "best_metric": metric}
+        self.jobs.put((snapshot(state), step, is_best, dict(self.manifest)))
+        return is_best
+
+    def wait(self):
+        """Blocks until every queued checkpoint is written and uploaded."""
+        self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        self.jobs.join()
+        self.jobs.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def checkpoints(self) -> list:
+        """(step, path) of the checkpoints on disk, oldest first."""
+        pattern = re.compile("^" + re.escape(self.name_format).replace(r"\{step\}", r"(\d+)") + "$")
+        found = []
+        for path in glob.glob(os.path.join(self.directory, "*")):
+            match = pattern.match(os.path.basename(path))
+            if match:
+                found.append((int(match.group(1)), path))
+        return sorted(found)
+
+    def latest(self) -> Optional[str]:
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def load_latest(self, map_location="cpu") -> Optional[dict]:
+        """The most recent checkpoint on disk, None when training starts from scratch."""
+        self.wait()
+        path = self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def _write(self, state, path):
+        partial_path = path + ".partial"
+        torch.save(state, partial_path)
+        os.replace(partial_path, path)  # never leaves a truncated checkpoint behind
+
+    def _upload(self, path, name):
+        try:
+            self.sink.upload(path, name)
+        except Exception as error:
+            print(f"Failed to upload {name}: {error}")
+
+    def _run(self):
+        while (job := self.jobs.get()) is not None:
+            state, step, is_best, manifest = job
+            try:
+                name = self.name_format.format(step=step)
+                path = os.path.join(self.directory, name)
+                self._write(state, path)
+                if is_best:
+                    best_path = os.path.join(self.directory, self.best_name)
+                    shutil.copyfile(path, best_path + ".partial")
+                    os.replace(best_path + ".partial", best_path)
+                with open(self.manifest_path, "w") as f:
+                    json.dump(manifest, f)
+
+                for _, old_path in self.checkpoints()[:-self.keep_last]:
+                    os.remove(old_path)
+
+                if self.sink is not None:
+                    if self.upload == "all":
+                        self._upload(path, name)
+                    elif is_best:
+                        self._upload(os.path.join(self.directory, self.best_name), self.best_name)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.jobs.task_done()
+        self.jobs.task_done()
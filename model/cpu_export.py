@@ -0,0 +1,82 @@
+"""
+CPU inference export helpers: dynamic int8 quantization of the Linear layers, TorchScript
+and ONNX export, and a loader returning a module for any exported file.
+ONNX export and loading need the optional `onnx` and `onnxruntime` packages.
+"""
+
+import time
+import numpy as np
+import torch
+from torch import nn
+from typing import Callable, Tuple
+
+
+def quantize_dynamic_int8(model: nn.Module) -> nn.Module:
+    """Returns a copy of `model` whose Linear layers run with int8 weights and dynamically quantized activations."""
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8, inplace=False)
+
+
+def export_torchscript(model: nn.Module, example_inputs: Tuple[torch.Tensor, ...], path: str) -> torch.jit.ScriptModule:
+    """Traces `model` on `example_inputs` and saves the frozen TorchScript module to `path`."""
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example_inputs, strict=False)
+        traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(model: nn.Module, example_inputs: Tuple[torch.Tensor, ...], path: str, opset_version: int = 17):
+    """Exports `model` to ONNX, with a dynamic batch dimension on every input and output."""
+    try:
+        import onnx  # noqa: F401
+    except ImportError as error:
+        raise ImportError("ONNX export requires the `onnx` package") from error
+
+    input_names = [f"input_{i}" for i in range(len(example_inputs))]
+    torch.onnx.export(
+        model.eval(),
+        example_inputs,
+        path,
+        input_names=input_names,
+        output_names=["output"],
+        dynamic_axes={name: {0: "batch"} for name in input_names + ["output"]},
+        opset_version=opset_version,
+    )
+
+
+class OnnxModule(nn.Module):
+    """Runs an ONNX export through onnxruntime behind the usual module interface."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        try:
+            import onnxruntime
+        except ImportError as error:
+            raise ImportError("Loading ONNX exports requires the `onnxruntime` package") from error
+
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+        feeds = {name: tensor.cpu().numpy() for name, tensor in zip(self.input_names, inputs)}
+        return torch.from_numpy(self.session.run(None, feeds)[0])
+
+
+def load_cpu_model(path: str) -> nn.Module:
+    """Loads a TorchScript (.pt) or ONNX (.onnx) export for CPU inference."""
+    if path.endswith(".onnx"):
+        return OnnxModule(path).eval()
+    return torch.jit.load(path, map_location="cpu").eval()
+
+
+def measure_latency(model: Callable[..., torch.Tensor], example_inputs: Tuple[torch.Tensor, ...], runs: int = 10, warmup: int = 2) -> dict:
+    """Median and 90th percentile latency, in milliseconds, of `model(*example_inputs)`."""
+    timings = []
+    with torch.inference_mode():
+        for run in range(warmup + runs):
+            start = time.perf_counter()
+            model(*example_inputs)
+            if run >= warmup:
+                timings.append((time.perf_counter() - start) * 1000)
+
+    return {"p50_ms": float(np.percentile(timings, 50)), "p90_ms": float(np.percentile(timings, 90))}
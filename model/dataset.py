@@ -5,47 +5,290 @@ import scipy
 import torch
 from torch import nn
 from torch.utils.data import DataLoader, Dataset, Subset
+from concurrent.futures import ProcessPoolExecutor
 import os
-import random
+import time
+import warnings
+import traceback
 import transformers
 from transformers import ViTModel
 import transformers
+import instrumentation
+from channels import channel_map, fit_columns
+
+def _window(x, start, size):
+    """Columns [start, start + size) of `x`, a view unless they run past its end and are zero padded."""
+    window = x[..., start:start + size]
+    if window.shape[-1] == size:
+        return window
+    padded = x.new_zeros(*x.shape[:-1], size)
+    padded[..., :window.shape[-1]] = window
+    return padded
+
+
+class WindowTransform:
+    """
+    Splits the last (time) dimension of a recording into windows of `window_size` columns,
+    starting every `hop_length` columns (`window_size` by default, i.e. no overlap).
+
+    Windows are views of the input: only the last one is copied, when `pad_last` zero pads it
+    to a full window instead of dropping it. Numpy inputs are wrapped without a copy.
+    """
+    def __init__(self, window_size, hop_length=None, pad_last=True):
+        self.window_size = window_size
+        self.hop_length = hop_length or window_size
+        self.pad_last = pad_last
+
+    def layout(self, num_cols):
+        """(window size, hop length, number of windows) over a `num_cols`-wide input."""
+        if num_cols <= self.window_size:
+            num_windows = 1 if self.pad_last or num_cols == self.window_size else 0
+        elif self.pad_last:
+            num_windows = -(-(num_cols - self.window_size) // self.hop_length) + 1
+        else:
+            num_windows = (num_cols - self.window_size) // self.hop_length + 1
+        return self.window_size, self.hop_length, num_windows
+
+    def __call__(self, x):
+        x = torch.as_tensor(x)
+        window_size, hop_length, num_windows = self.layout(x.shape[-1])
+        return tuple(_window(x, w * hop_length, window_size) for w in range(num_windows))
+
+    def unfold(self, x):
+        """
+        All the windows at once, as a (num windows, ..., window size) tensor. It is a strided
+        view of `x` when every window is complete; otherwise the windows are written once into
+        a new tensor, zero padding the last one.
+        """
+        x = torch.as_tensor(x)
+        window_size, hop_length, num_windows = self.layout(x.shape[-1])
+        num_full = min(num_windows, max(0, (x.shape[-1] - window_size) // hop_length + 1))
+
+        # an input shorter than a window has no complete one, which `x.unfold` rejects
+        if num_full > 0:
+            full = x.unfold(-1, window_size, hop_length)[..., :num_full, :].movedim(-2, 0)
+            if num_full == num_windows:
+                return full
+
+        windows = x.new_empty(num_windows, *x.shape[:-1], window_size)
+        if num_full > 0:
+            windows[:num_full] = full
+        for w in range(num_full, num_windows):
+            windows[w] = _window(x, w * hop_length, window_size)
+        return windows
+
 
 # Transform Class for the dataset
-class ColumnSplitTransform:
+class ColumnSplitTransform(WindowTransform):
+    """
+    Splits the columns into `num_splits` equal, non-overlapping windows, the last one zero
+    padded. The window size depends on the width of the input, see `split_size`.
+    """
     def __init__(self, num_splits):
+        super().__init__(window_size=None)
         self.num_splits = num_splits
     
-    def __call__(self, x):
-        if not isinstance(x, torch.Tensor):
-           x = torch.tensor(x)
-           
-        num_cols = x.shape[-1]
+    def split_size(self, num_cols):
+        """Number of columns in each split of a `num_cols`-wide input."""
         base_split_size = num_cols // self.num_splits
         remainder = num_cols % self.num_splits
         
-        target_split_size = base_split_size + (1 if remainder > 0 else 0)
+        return base_split_size + (1 if remainder > 0 else 0)
 
-        total_target_cols = target_split_size * self.num_splits
-        padding_needed = total_target_cols - num_cols
-        
-        if padding_needed > 0:
-            # Create padding tensor
-            pad_shape = list(x.shape)
-            pad_shape[-1] = padding_needed
-            padding = torch.zeros(pad_shape, dtype=x.dtype, device=x.device)
-            
-            # Concatenate padding
-            x = torch.cat([x, padding], dim=-1)
-        
-        # Now split into equal parts
-        return torch.split(x, target_split_size, dim=-1)
+    def layout(self, num_cols):
+        split_size = self.split_size(num_cols)
+        return split_size, split_size, self.num_splits
+
+
+class RecordingWindows:
+    """
+    Index of the windows of `window_size` columns starting every `stride` columns of
+    recordings with the given `lengths`, without materializing them: window `idx` is
+    located with a binary search over the cumulative window counts, so the index takes
+    memory proportional to the number of recordings only.
+
+    With `jitter`, each window start is moved by a random offset in [-jitter, jitter],
+    kept within its recording. Offsets are drawn from (`seed`, epoch, idx), so that they are
+    the same in every DataLoader worker and change with `set_epoch`. Recordings shorter than
+    a window hold a single one, zero padded by the reader.
+    """
+    def __init__(self, lengths, window_size, stride=None, jitter=0, seed=0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.window_size = window_size
+        self.stride = stride or window_size
+        self.jitter = jitter
+        self.seed = seed
+        self.epoch = 0
+        num_windows = np.maximum(1, (self.lengths - window_size) // self.stride + 1)
+        self.cumulative_windows = np.cumsum(num_windows)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return int(self.cumulative_windows[-1]) if len(self.cumulative_windows) else 0
+
+    def locate(self, idx):
+        """(recording index, start column) of window `idx`."""
+        recording = int(np.searchsorted(self.cumulative_windows, idx, side='right'))
+        window = idx - (self.cumulative_windows[recording - 1] if recording > 0 else 0)
+        start = int(window) * self.stride
+
+        if self.jitter:
+            offset = np.random.default_rng((self.seed, self.epoch, idx)).integers(-self.jitter, self.jitter + 1)
+            last_start = max(0, int(self.lengths[recording]) - self.window_size)
+            start = min(max(start + int(offset), 0), last_start)
+        return recording, start
+
+
+class NegativeSampler:
+    """
+    Draws `num_negatives` mismatched partners per item of a `num_items` dataset, e.g. the MEG
+    windows of other EEG windows for a contrastive objective, without storing a permutation.
+
+    The negatives of `idx` are drawn without replacement from a generator seeded by (`seed`,
+    epoch, idx), so that they are distinct, the same in every DataLoader worker, independent
+    across items and redrawn by `set_epoch`, in O(1) memory per item. They are never `idx`
+    itself and, given the `recording_ends` (cumulative item counts of the consecutive
+    recordings the items come from), never an item of the same recording, whose windows may
+    overlap it; unless the other recordings hold fewer than `num_negatives` items.
+
+    Datasets too small to draw `num_negatives` per item get as many as they hold, with a
+    warning: a one-item dataset has none.
+    """
+    def __init__(self, num_items, num_negatives=1, seed=0, recording_ends=None):
+        if num_negatives < 0:
+            raise ValueError(f"num_negatives should be positive, got {num_negatives}")
+        if num_items and num_negatives >= num_items:
+            warnings.warn(f"Cannot draw {num_negatives} negatives per item out of {num_items} items, "
+                          f"drawing {num_items - 1}")
+            num_negatives = num_items - 1
+        self.num_items = num_items
+        self.num_negatives = num_negatives
+        self.seed = seed
+        self.recording_ends = None if recording_ends is None else np.asarray(recording_ends, dtype=np.int64)
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _excluded(self, idx):
+        """The [start, stop) range of items that cannot be negatives of `idx`."""
+        if self.recording_ends is not None:
+            recording = int(np.searchsorted(self.recording_ends, idx, side='right'))
+            start = int(self.recording_ends[recording - 1]) if recording > 0 else 0
+            stop = int(self.recording_ends[recording])
+            if self.num_items - (stop - start) >= self.num_negatives:
+                return start, stop
+        return idx, idx + 1
+
+    def __call__(self, idx):
+        """Indices of the negatives of item `idx`."""
+        if not self.num_negatives:
+            return []
+        start, stop = self._excluded(idx)
+        rng = np.random.default_rng((self.seed, self.epoch, idx))
+        draws = rng.choice(self.num_items - (stop - start), self.num_negatives, replace=False)
+        # draws index the items outside [start, stop)
+        return [int(draw) + (stop - start) if draw >= start else int(draw) for draw in draws]
+
+
+def _read_columns(raw, picks, start, stop):
+    """Columns [start, stop) of the `picks` channels of `raw`, none when the range is empty, which MNE rejects."""
+    if stop <= start:
+        return np.empty((len(raw.get_channel_types(picks=picks)), 0))
+    return raw.get_data(picks=picks, start=start, stop=stop)
+
+
+def load_recording(fif_file, max_column_size, eeg_map="ds000117"):
+    """
+    Reads a FIF recording into (eeg, meg) float tensors, cropped or zero padded to
+    `max_column_size` columns, with the EEG channels aligned by `eeg_map` (a `ChannelMap` or
+    preset name, see channels.py), and its number of recorded samples. Only the kept columns
+    are read, and each modality is written once into its float32 output.
+    """
+    raw = mne.io.read_raw_fif(fif_file, preload=False, verbose=False)
+    stop = min(raw.n_times, max_column_size)
+    eeg = channel_map(eeg_map).apply(raw.get_data(picks='eeg', stop=stop), max_column_size)
+    meg = fit_columns(raw.get_data(picks='meg', stop=stop), max_column_size)
+
+    return torch.from_numpy(eeg), torch.from_numpy(meg), raw.n_times
+
+
+def _timed_load(job):
+    """Process pool entry point: loads one recording, reporting timing and failures instead of raising."""
+    fif_file, max_column_size, eeg_map = job
+    start = time.perf_counter()
+    try:
+        eeg, meg, num_samples = load_recording(fif_file, max_column_size, eeg_map)
+        error = None
+    except Exception:
+        eeg, meg, num_samples, error = None, None, None, traceback.format_exc()
+
+    return eeg, meg, _load_metrics(fif_file, start, num_samples, error)
+
+
+def _load_metrics(fif_file, start, num_samples, error):
+    """Per-file entry of `EGG2MEG_Dataset.load_metrics`, for a read started at `start`."""
+    return {
+        "file": fif_file,
+        "seconds": time.perf_counter() - start,
+        "bytes": os.path.getsize(fif_file) if os.path.exists(fif_file) else None,
+        "num_samples": num_samples,
+        "error": error,
+    }
+
+
+def window_layout(transform, max_column_size):
+    """(window size, hop length, windows per recording) produced by `transform` on `max_column_size` columns."""
+    if transform is None:
+        return max_column_size, max_column_size, 1
+    if isinstance(transform, WindowTransform):
+        return transform.layout(max_column_size)
+    raise ValueError("only transform=None or a WindowTransform can be indexed by window")
 
 
 # data is coming from https://openfmri.org/dataset/ds000117/
 class EGG2MEG_Dataset(Dataset):
-    def __init__(self, base_path, transform=None, max_participants=None, max_column_size=546_700):
+    """
+    Paired (EEG, MEG) recordings from ds000117.
+
+    By default every recording is loaded, padded and split in memory at construction. With
+    `lazy=True` only the (file, window offset) pairs are indexed, and windows are read on
+    demand from the non-preloaded FIF files, keeping memory roughly constant in the number
+    of participants. With `cache_dir`, windows are read from a preprocessed store built once
+    by `window_cache.build_window_cache` (and rebuilt whenever it is stale), using
+    `num_workers` processes. Lazy and cached modes support `transform=None` or a
+    `WindowTransform`, such as `ColumnSplitTransform`.
+
+    Items are (eeg, meg, negative meg) triplets, the negative MEG window coming from another
+    recording, see `NegativeSampler`; with `num_negatives` > 1 the negatives are stacked into a
+    num_negatives x channels x time tensor, and with 0 items are (eeg, meg) pairs.
+
+    EEG channels are aligned onto the 129 model rows by `eeg_channels`, a `ChannelMap` or
+    the name of a preset in channels.py: by default the 74 ds000117 channels fill the first
+    rows, as the models were trained with.
+
+    With `window_size`, instead of a transform, windows are cropped on the fly from the
+    recordings (read from disk when `lazy`) every `stride` columns, each randomly moved by
+    up to `jitter` columns, see `RecordingWindows`. Call `set_epoch` at every epoch for new
+    crops.
+
+    Recordings are loaded eagerly by a pool of `num_workers` processes, merged back in file
+    order. Per-file load times and failures, of the header reads when lazy, are kept in
+    `load_metrics`; files that fail are reported and skipped.
+    """
+    def __init__(self, base_path, transform=None, max_participants=None, max_column_size=546_700, lazy=False,
+                 cache_dir=None, cache_dtype="float32", num_workers=1, window_size=None, stride=None, jitter=0,
+                 seed=0, eeg_channels="ds000117", num_negatives=1):
+        if window_size is not None and (transform is not None or cache_dir is not None):
+            raise ValueError("window_size crops windows on the fly, it cannot be combined with a transform or a cache")
         self.max_column_size = max_column_size
+        self.lazy = lazy
+        self.cache = None
+        self.windows = None
+        # EEG channels aligned onto the 129 model rows, computed once for every recording
+        self.eeg_map = channel_map(eeg_channels)
         root_tree = os.path.join(base_path, "ds000117_R1.0.0/derivatives/meg_derivatives")
         # data per participant
         participants = [ name for name in os.listdir(root_tree) if os.path.isdir(os.path.join(root_tree, name)) ]
@@ -56,58 +299,182 @@ class EGG2MEG_Dataset(Dataset):
             participants = participants[:max_participants]
         
         # for each participant we want to extract all the .fif files
-        self.raws = []
+        self.files = []
         for participant in participants:
             path = os.path.join(root_tree, participant, "ses-meg/meg")
             fif_files = [ name for name in os.listdir(path) if ".fif" in name ]
             fif_files = sorted(fif_files)
+            self.files.extend(os.path.join(path, fif_file) for fif_file in fif_files)
+
+        mode = "cached" if cache_dir is not None else "lazy" if lazy else "eager"
+        with instrumentation.span("dataset.build", mode=mode, files=len(self.files)):
+            if window_size is not None:
+                # whole recordings are kept (or indexed, when lazy) and windows cropped from them
+                if lazy:
+                    self._index_windows(None)
+                else:
+                    self._load_windows(None, num_workers=num_workers)
+                # windows are cropped from the recorded samples, not from the zero padding after them
+                lengths = [min(num_samples, max_column_size) for num_samples in self.num_samples]
+                self.windows = RecordingWindows(lengths, window_size, stride, jitter, seed)
+                self.window_size = window_size
+            elif cache_dir is not None:
+                from window_cache import open_window_cache
+                self.cache = open_window_cache(
+                    self.files, cache_dir, max_column_size, transform, dtype=cache_dtype, num_workers=num_workers,
+                    eeg_map=self.eeg_map
+                )
+            elif lazy:
+                self._index_windows(transform)
+            else:
+                self._load_windows(transform, num_workers=num_workers)
 
-            for fif_file in fif_files:
-                try:
-                    raw = mne.io.read_raw_fif(os.path.join(path, fif_file), preload=True, verbose=False)
-                    eeg = self._adding_rows(
-                        self._padding_and_crop(raw.get_data(picks='eeg'), self.max_column_size)
-                    )
-                    meg = self._padding_and_crop(raw.get_data(picks='meg'), self.max_column_size)
-                    print(f"Shape of eeg_data: {eeg.shape}, meg_data {meg.shape}")
+        self.negatives = NegativeSampler(len(self), num_negatives, seed, recording_ends=self._recording_ends())
+
+    def _load_windows(self, transform, num_workers=1):
+        self.raws = []
+        self.recording_ends = []  # number of items once each file is loaded
+        self.num_samples = []  # recorded samples per loaded file, the rest of each recording is zero padding
+        self.load_metrics = []
+        jobs = [(fif_file, self.max_column_size, self.eeg_map) for fif_file in self.files]
+
+        if num_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+            # map yields in submission order, keeping the dataset indices reproducible
+            results = executor.map(_timed_load, jobs)
+        else:
+            executor, results = None, map(_timed_load, jobs)
+
+        try:
+            for eeg, meg, metrics in results:
+                if not self._record_load(metrics):
+                    continue
+
+                instrumentation.count("dataset.loaded_bytes", metrics["bytes"])
+                self.num_samples.append(metrics["num_samples"])
+                print(f"Loaded {metrics['file']} in {metrics['seconds']:.2f}s, "
+                      f"shape of eeg_data: {eeg.shape}, meg_data {meg.shape}")
                     
-                    if not isinstance(eeg, torch.Tensor):
-                        eeg = torch.tensor(eeg).float()
-                    if not isinstance(meg, torch.Tensor):
-                        meg = torch.tensor(meg).float()
-                        
-                    if transform is not None:
-                        eegs = transform(eeg)
-                        megs = transform(meg)
-                        for tupla in zip(eegs, megs):
-                            self.raws.append(tupla)
-                    else:
-                        self.raws.append((eeg, meg))
-                except Exception as error:
-                    pass
-
-            self.random_indexes = list(range(len(self.raws)))
-            random.shuffle(self.random_indexes)
-
-    def _padding_and_crop(self, matrix, column_size):
-        current_columns = matrix.shape[1]
-        target_columns = self.max_column_size
-
-        if current_columns > target_columns:
-            matrix = matrix[:, :target_columns]
-        elif current_columns < target_columns:
-            padding_width = target_columns - current_columns
-            zero_padding = np.zeros((matrix.shape[0], padding_width))
-            matrix = np.hstack((matrix, zero_padding))
-        return matrix
-
-    def _adding_rows(self,matrix):
-        padding_needed = 129 - 74  # 55 rows needed
-        return np.pad(matrix, ((0, padding_needed), (0, 0)), mode='constant', constant_values=0)
-        
+                if transform is not None:
+                    eegs = transform(eeg)
+                    megs = transform(meg)
+                    for tupla in zip(eegs, megs):
+                        self.raws.append(tupla)
+                else:
+                    self.raws.append((eeg, meg))
+                self.recording_ends.append(len(self.raws))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _record_load(self, metrics):
+        """Keeps the metrics of a file read, reporting it when it failed. Returns whether it succeeded."""
+        self.load_metrics.append(metrics)
+        instrumentation.count("dataset.load_seconds", metrics["seconds"])
+        if metrics["error"] is not None:
+            instrumentation.count("dataset.failed_files")
+            print(f"Failed to load {metrics['file']}:\n{metrics['error']}")
+            return False
+        return True
+
+    def _index_windows(self, transform):
+        window_size, hop_length, num_windows = window_layout(transform, self.max_column_size)
+
+        self.window_size = window_size
+        self.num_samples = []  # recorded samples per file, the rest of each window is zero padding
+        self.index = []  # (file index, window offset) pairs
+        self.recording_ends = []  # number of items once each file is indexed
+        self.load_metrics = []
+        self._raw_cache, self._cache_pid = {}, None
+
+        readable_files = []
+        for fif_file in self.files:
+            start = time.perf_counter()
+            try:
+                # reads the header only, the data stays on disk
+                raw = mne.io.read_raw_fif(fif_file, preload=False, verbose=False)
+                num_samples, error = raw.n_times, None
+            except Exception:
+                num_samples, error = None, traceback.format_exc()
+            if not self._record_load(_load_metrics(fif_file, start, num_samples, error)):
+                continue
+
+            file_idx = len(readable_files)
+            readable_files.append(fif_file)
+            self.num_samples.append(raw.n_times)
+            self.index.extend((file_idx, w * hop_length) for w in range(num_windows))
+            self.recording_ends.append(len(self.index))
+
+        self.files = readable_files
+
+    def _get_raw(self, file_idx):
+        """Returns the (non-preloaded) FIF handle for `file_idx`, cached per worker process."""
+        if self._cache_pid != os.getpid():
+            # handles must not be shared across forked DataLoader workers
+            self._raw_cache, self._cache_pid = {}, os.getpid()
+
+        if file_idx not in self._raw_cache:
+            self._raw_cache[file_idx] = mne.io.read_raw_fif(self.files[file_idx], preload=False, verbose=False)
+        return self._raw_cache[file_idx]
+
+    def _read_window(self, file_idx, start, with_eeg=True):
+        """(eeg, meg) window at `start`, the EEG left unread (None) without `with_eeg`."""
+        raw = self._get_raw(file_idx)
+        stop = min(start + self.window_size, self.num_samples[file_idx], self.max_column_size)
+
+        # windows past the end of the recording are zero padded, as in the eager mode
+        meg = torch.from_numpy(fit_columns(_read_columns(raw, 'meg', start, stop), self.window_size))
+        if not with_eeg:
+            return None, meg
+        eeg = torch.from_numpy(self.eeg_map.apply(_read_columns(raw, 'eeg', start, stop), self.window_size))
+
+        return eeg, meg
+
+    def _recording_ends(self):
+        """Cumulative number of items of the recordings, which hold consecutive items."""
+        if self.cache is not None:
+            return self.cache.offsets[1:]
+        if self.windows is not None:
+            return self.windows.cumulative_windows
+        return self.recording_ends
+
+    def set_epoch(self, epoch):
+        """Draws new negatives, and new random crops when windows are cropped on the fly."""
+        self.negatives.set_epoch(epoch)
+        if self.windows is not None:
+            self.windows.set_epoch(epoch)
+
+    def _crop_window(self, idx, with_eeg=True):
+        recording, start = self.windows.locate(idx)
+        if self.lazy:
+            return self._read_window(recording, start, with_eeg)
+        eeg, meg = self.raws[recording]
+        return _window(eeg, start, self.window_size), _window(meg, start, self.window_size)
+
+    def _window_pair(self, idx, with_eeg=True):
+        """(eeg, meg) window `idx`; without `with_eeg`, the EEG may be left unread and None."""
+        if self.cache is not None:
+            return self.cache[idx] if with_eeg else (None, self.cache.meg_window(idx))
+        if self.windows is not None:
+            return self._crop_window(idx, with_eeg)
+        if self.lazy:
+            return self._read_window(*self.index[idx], with_eeg=with_eeg)
+        return self.raws[idx]
+
     def __len__(self):
+        if self.cache is not None:
+            return len(self.cache)
+        if self.windows is not None:
+            return len(self.windows)
+        if self.lazy:
+            return len(self.index)
         return len(self.raws)
 
+    @instrumentation.timed("dataset.getitem")
     def __getitem__(self, idx):
-        return (*self.raws[idx], self.raws[self.random_indexes[idx]][1])
-
+        eeg, meg = self._window_pair(idx)
+        # only the MEG of the negatives is read
+        negatives = [self._window_pair(negative, with_eeg=False)[1] for negative in self.negatives(idx)]
+        if not negatives:
+            return eeg, meg
+        return eeg, meg, negatives[0] if len(negatives) == 1 else torch.stack(negatives)
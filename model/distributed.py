@@ -0,0 +1,112 @@
+"""
+DistributedDataParallel helpers for the training scripts, one process per device.
+
+Scripts are launched with torchrun, which sets RANK, LOCAL_RANK and WORLD_SIZE, e.g. on a
+single machine with 4 GPUs, or with 4 CPU processes over the gloo backend:
+
+    torchrun --nproc_per_node 4 meg/train.py --config meg/config.yaml
+
+Without torchrun every helper falls back to a single, non-distributed process.
+"""
+
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
+from typing import Optional
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """Whether this is rank 0, the process logging and writing checkpoints."""
+    return rank() == 0
+
+
+def setup(backend: Optional[str] = None) -> torch.device:
+    """
+    Joins the process group when launched by torchrun, with NCCL on GPUs and gloo on CPU
+    unless `backend` is given, and returns the device of this process.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1 and not is_distributed():
+        backend = backend or ("nccl" if torch.cuda.is_available() else "gloo")
+        dist.init_process_group(backend)
+
+    if torch.cuda.is_available():
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        torch.cuda.set_device(local_rank)
+        return torch.device(f"cuda:{local_rank}")
+    return torch.device("cpu")
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def wrap_model(model: torch.nn.Module, device: torch.device) -> torch.nn.Module:
+    """Wraps `model`, already on `device`, with DistributedDataParallel when running distributed."""
+    if not is_distributed():
+        return model
+    return DistributedDataParallel(model, device_ids=[device.index] if device.type == "cuda" else None)
+
+
+def sampler(dataset, shuffle: bool = True, seed: int = 0, drop_last: bool = False) -> Optional[DistributedSampler]:
+    """
+    Sampler giving every rank its own shard of `dataset`, None when not distributed. Call
+    `set_epoch` on it at the start of every epoch for the shuffling to change.
+    """
+    if not is_distributed():
+        return None
+    return DistributedSampler(dataset, shuffle=shuffle, seed=seed, drop_last=drop_last)
+
+
+def set_epoch(loader, epoch: int):
+    """
+    Sets the epoch of the sampler (or batch sampler) and of the dataset of `loader`, those
+    having one to set, e.g. for a dataset drawing new random crops every epoch.
+    """
+    for component in (loader.sampler, loader.batch_sampler, loader.dataset):
+        if hasattr(component, "set_epoch"):
+            component.set_epoch(epoch)
+
+
+def _all_reduce(values, op=dist.ReduceOp.SUM):
+    device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else "cpu"
+    values = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(values, op=op)
+    return values.tolist()
+
+
+def reduce_mean(total: float, count: int) -> float:
+    """
+    Mean over every rank of a metric summed over `count` items on each, e.g. the loss of an
+    epoch over its batches. All the ranks must call it.
+    """
+    if not is_distributed():
+        return total / count
+    total, count = _all_reduce([total, count])
+    return total / count
+
+
+def reduce_min(value: int) -> int:
+    """Smallest `value` over the ranks, e.g. for all of them to agree on a micro-batch size."""
+    if not is_distributed():
+        return value
+    return int(_all_reduce([value], op=dist.ReduceOp.MIN)[0])
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
@@ -1,23 +1,229 @@
+import os
+import sys
+import json
+import zipfile
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, Subset
+from torch.utils.data import DataLoader, Dataset, Sampler, Subset, get_worker_info
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
+
+
+def _npy_cache_path(data_file, transpose):
+    return os.path.splitext(data_file)[0] + ("_eeg_transposed.npy" if transpose else "_eeg.npy")
+
+
+def _convert_to_npy(data_file, path, transpose, chunk_size=256):
+    """
+    Writes the EEG array of the `data_file` archive to a contiguous float32 .npy file at
+    `path`, decompressing it `chunk_size` samples at a time rather than all at once.
+    """
+    with zipfile.ZipFile(data_file) as archive, archive.open("EEG.npy") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+
+        if fortran_order:
+            array = np.load(data_file)["EEG"]
+            array = np.transpose(array, (0,2,1))[:,np.newaxis] if transpose else array
+            np.save(path, np.ascontiguousarray(array, dtype=np.float32))
+            return
+
+        out_shape = (shape[0], 1, shape[2], shape[1]) if transpose else shape
+        partial_path = path + ".partial"
+        out = np.lib.format.open_memmap(partial_path, mode="w+", dtype=np.float32, shape=out_shape)
+        sample_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        for start in range(0, shape[0], chunk_size):
+            count = min(chunk_size, shape[0] - start)
+            chunk = np.frombuffer(f.read(count * sample_bytes), dtype=dtype).reshape(count, *shape[1:])
+            out[start:start + count] = chunk.transpose(0,2,1)[:,np.newaxis] if transpose else chunk
+        out.flush()
+        del out
+
+    os.replace(partial_path, path)
+
+
+class BatchIndexSampler(Sampler):
+    """
+    Yields arrays of `batch_size` dataset indices, taken from `indices`, to be used as the
+    `batch_sampler` of a DataLoader reading whole batches, see `batch_loader`. Indices are
+    sorted within each batch, so that a batch reads the underlying array in order.
+
+    With `num_replicas` > 1, e.g. under DistributedDataParallel, the indices are shuffled the
+    same way on every rank and `rank` only gets every `num_replicas`-th of them, padded with
+    repeated indices so that all ranks run the same number of batches, as DistributedSampler.
+    """
+    def __init__(self, indices, batch_size, shuffle=False, drop_last=False, seed=0, num_replicas=1, rank=0):
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = (len(self.indices) + num_replicas - 1) // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = np.random.default_rng(self.seed + self.epoch).permutation(indices)
+        if self.num_replicas > 1:
+            indices = np.resize(indices, self.num_samples * self.num_replicas)[self.rank::self.num_replicas]
+        for batch in range(len(self)):
+            yield np.sort(indices[batch * self.batch_size:(batch + 1) * self.batch_size])
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+class _BatchReader(Dataset):
+    """Fetches the batches of a DataLoader through `dataset.get_batch`, see `batch_loader`."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+    def __getitems__(self, indices):
+        return self.dataset.get_batch(indices)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def collate_batch(batch):
+    """`get_batch` already returns a collated (inputs, targets, indices) batch."""
+    return batch
+
+
+def batch_loader(subset, batch_size, shuffle=False, num_replicas=1, rank=0, **kwargs):
+    """
+    DataLoader reading batches of a `Subset` of `EEGEyeNetDataset` in one slice each, only
+    the `rank`-th shard of the subset when split across `num_replicas` processes.
+    """
+    sampler = BatchIndexSampler(subset.indices, batch_size, shuffle=shuffle, num_replicas=num_replicas, rank=rank)
+    return DataLoader(_BatchReader(subset.dataset), batch_sampler=sampler, collate_fn=collate_batch, **kwargs)
+
 
 class EEGEyeNetDataset(Dataset):
-    def __init__(self, data_file,transpose = True):
+    def __init__(self, data_file,transpose = True, stats=None, mmap=False):
+        """
+        `stats` are the normalization statistics returned by `compute_stats`: once set, samples
+        are returned normalized, inputs by the training mean/std and targets to [0, 1] by the
+        training min/max, so that normalization runs in the DataLoader workers.
+
+        The EEG is kept as a contiguous float32 array, already transposed to N x 1 x 129 x 500.
+        With `mmap`, it is converted once to a .npy file next to `data_file` and memory-mapped
+        instead of decompressed into RAM.
+        """
         self.data_file = data_file
         print('loading data...')
-        with np.load(self.data_file) as f: # Load the data array
-            self.trainX = f['EEG']
-            self.trainY = f['labels']
-        if transpose:
-            self.trainX = np.transpose(self.trainX, (0,2,1))[:,np.newaxis,:,:]
+        if mmap:
+            path = _npy_cache_path(data_file, transpose)
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(data_file):
+                _convert_to_npy(data_file, path, transpose)
+            self.trainX = np.load(path, mmap_mode='r')
+            with np.load(self.data_file) as f:
+                self.trainY = f['labels']
+        else:
+            with np.load(self.data_file) as f: # Load the data array
+                self.trainX = f['EEG']
+                self.trainY = f['labels']
+            if transpose:
+                self.trainX = np.transpose(self.trainX, (0,2,1))[:,np.newaxis,:,:]
+            self.trainX = np.ascontiguousarray(self.trainX, dtype=np.float32)
+        self.set_stats(stats)
+
+    def compute_stats(self, indices=None, chunk_size=256):
+        """
+        Global input mean/std and per-coordinate target min/max over `indices` (all samples by
+        default), computed on the underlying arrays in chunks of `chunk_size` samples. The
+        statistics are set on the dataset and returned.
+        """
+        indices = np.sort(np.arange(len(self)) if indices is None else np.asarray(indices))
+
+        total, total_squares = 0.0, 0.0
+        for start in range(0, len(indices), chunk_size):
+            chunk = self.trainX[indices[start:start + chunk_size]].astype(np.float64)
+            total += chunk.sum()
+            total_squares += np.square(chunk).sum()
+        count = len(indices) * np.prod(self.trainX.shape[1:])
+        mean = total / count
 
+        targets = self.trainY[indices, 1:3]
+        stats = {
+            'input_mean': float(mean),
+            'input_std': float(np.sqrt(max(total_squares / count - mean ** 2, 0.0))),
+            'min_target': targets.min(axis=0).tolist(),
+            'max_target': targets.max(axis=0).tolist(),
+        }
+        self.set_stats(stats)
+        return stats
+
+    def set_stats(self, stats):
+        """Normalizes the returned samples with `stats`, or disables normalization with None."""
+        self.stats = stats
+        if stats is not None:
+            self.min_target = np.asarray(stats['min_target'], dtype=np.float32)
+            self.target_range = np.asarray(stats['max_target'], dtype=np.float32) - self.min_target
+
+    def save_stats(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats, f, indent=2)
+
+    @staticmethod
+    def load_stats(path):
+        with open(path) as f:
+            return json.load(f)
+
+    def denormalize_targets(self, targets):
+        """Maps normalized targets (or predictions) back to screen coordinates."""
+        return targets * (torch.as_tensor(self.target_range) + 1e-8) + torch.as_tensor(self.min_target)
+
+    def _normalize(self, X, y):
+        """Normalizes freshly copied inputs and targets in place."""
+        if self.stats is not None:
+            X -= self.stats['input_mean']
+            X /= self.stats['input_std'] + 1e-8
+            y -= self.min_target
+            y /= self.target_range + 1e-8
+        return X, y
+
+    @instrumentation.timed("dataset.getitem")
     def __getitem__(self, index):
         # Read a single sample of data from the data array
-        X = torch.from_numpy(self.trainX[index]).float()
-        y = torch.from_numpy(self.trainY[index,1:3]).float()
+        X, y = self._normalize(np.array(self.trainX[index]), self.trainY[index,1:3].astype(np.float32))
         # Return the tensor data
-        return (X,y,index)
+        return (torch.from_numpy(X), torch.from_numpy(y), index)
+
+    def _read(self, indices):
+        """Inputs and targets of `indices`, sliced from the arrays in one operation."""
+        return self._normalize(np.take(self.trainX, indices, axis=0), self.trainY[indices,1:3].astype(np.float32))
+
+    @instrumentation.timed("dataset.getitems")
+    def __getitems__(self, indices):
+        """The samples of `indices` as `__getitem__` returns them, read in one slice."""
+        X, y = self._read(np.asarray(indices))
+        return [(torch.from_numpy(X[i]), torch.from_numpy(y[i]), index) for i, index in enumerate(indices)]
+
+    @instrumentation.timed("dataset.getbatch")
+    def get_batch(self, indices):
+        """A whole collated batch, sliced from the arrays in one operation: (inputs, targets, indices)."""
+        indices = np.asarray(indices)
+        X, y = self._read(indices)
+        batch = (torch.from_numpy(X), torch.from_numpy(y), torch.from_numpy(indices))
+        # pinned memory does not survive the transfer out of a worker process, where the
+        # DataLoader's `pin_memory` pins the batches instead
+        if torch.cuda.is_available() and get_worker_info() is None:
+            batch = tuple(tensor.pin_memory() for tensor in batch)
+        return batch
 
     def __len__(self):
         # Compute the number of samples in the data array
@@ -0,0 +1,84 @@
+"""
+Exports EEGViT for CPU inference and reports accuracy against latency for each variant:
+fp32 and dynamic int8, eager and TorchScript (plus ONNX with --onnx). Accuracy is the test
+MSE computed by `inference_and_test.evaluate`, e.g.:
+
+    python export_cpu.py --checkpoint ./checkpoints/model_best.pth --out-dir ./exports
+"""
+
+import os
+import sys
+import json
+import argparse
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cpu_export import quantize_dynamic_int8, export_torchscript, export_onnx, load_cpu_model, measure_latency
+from model_pretrained import EEGViT_pretrained
+from dataset import batch_loader
+from inference_and_test import evaluate, load_test_split, load_normalization
+
+
+def export_variants(model, example_inputs, out_dir, onnx=False):
+    """Writes the CPU exports of `model` to `out_dir`, returning the name -> model of every variant."""
+    int8_model = quantize_dynamic_int8(model)
+    variants = {"fp32": model, "int8": int8_model}
+
+    for name, variant in (("fp32", model), ("int8", int8_model)):
+        path = os.path.join(out_dir, f"eegvit_{name}.pt")
+        export_torchscript(variant, example_inputs, path)
+        variants[f"torchscript_{name}"] = load_cpu_model(path)
+
+    if onnx:
+        path = os.path.join(out_dir, "eegvit_fp32.onnx")
+        export_onnx(model, example_inputs, path)
+        variants["onnx_fp32"] = load_cpu_model(path)
+
+    return variants
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint saved by run.py')
+    parser.add_argument('--data-file', type=str, default='./dataset/Position_task_with_dots_synchronised_min.npz')
+    parser.add_argument('--synthetic', type=int, default=0, help='Evaluate on this many random trials instead')
+    parser.add_argument('--out-dir', type=str, default='./exports')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--onnx', action='store_true', help='Also export and evaluate ONNX (needs onnx, onnxruntime)')
+    parsed_args = parser.parse_args()
+
+    torch.set_num_threads(os.cpu_count())
+    os.makedirs(parsed_args.out_dir, exist_ok=True)
+
+    model = EEGViT_pretrained(pretrained=False)
+    if parsed_args.checkpoint is not None:
+        checkpoint = torch.load(parsed_args.checkpoint, map_location="cpu", weights_only=True)
+        model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+
+    if parsed_args.synthetic:
+        # already normalized trials
+        inputs = torch.randn(parsed_args.synthetic, 1, 129, 500)
+        targets = torch.rand(parsed_args.synthetic, 2)
+        test = TensorDataset(inputs, targets, torch.arange(parsed_args.synthetic))
+    else:
+        train, test = load_test_split(parsed_args.data_file)
+        if parsed_args.checkpoint is not None:
+            load_normalization(train, parsed_args.checkpoint)
+        else:
+            train.dataset.compute_stats(train.indices)
+    test_loader = DataLoader(test, batch_size=parsed_args.batch_size) if parsed_args.synthetic else batch_loader(test, parsed_args.batch_size)
+
+    example_inputs = (next(iter(test_loader))[0],)
+    variants = export_variants(model, example_inputs, parsed_args.out_dir, onnx=parsed_args.onnx)
+
+    report = {}
+    print(f"{'variant':>18} {'test MSE':>12} {'p50 ms':>10} {'p90 ms':>10}")
+    for name, variant in variants.items():
+        mse, _, _ = evaluate(variant, test_loader, torch.device("cpu"))
+        report[name] = {"mse": mse, **measure_latency(variant, example_inputs)}
+        print(f"{name:>18} {mse:>12.6f} {report[name]['p50_ms']:>10.1f} {report[name]['p90_ms']:>10.1f}")
+
+    with open(os.path.join(parsed_args.out_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
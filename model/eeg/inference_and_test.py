@@ -1,3 +1,4 @@
+import os
 import torch
 import transformers
 from transformers import ViTModel
@@ -9,67 +10,61 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from model_pretrained import EEGViT_pretrained
-from dataset import EEGEyeNetDataset
+from dataset import EEGEyeNetDataset, batch_loader
 from helper_functions import split
 
 
 
-EEGEyeNet = EEGEyeNetDataset('/home/admin/EEGViT/dataset/Position_task_with_dots_synchronised_min.npz')
-
-model = EEGViT_pretrained()
-model.load_state_dict(torch.load("/home/admin/EEGViT/checkpoints/model_best.pth", weights_only=True)["model_state_dict"])
-
-train_indices, _, test_indices = split(EEGEyeNet.trainY[:,0],0.7,0.15,0.15)
-train = Subset(EEGEyeNet,indices=train_indices)
-test = Subset(EEGEyeNet,indices=test_indices)
-
-targetss = []
-for element in train:
-    targetss.append(element[1])
-
-uniti = torch.cat(targetss).reshape(-1,2)
-min_target = uniti.min(dim=0, keepdim=True)[0]
-max_target = uniti.max(dim=0, keepdim=True)[0]
+def load_normalization(train, checkpoint_path):
+    """
+    Sets the normalization statistics of the dataset under `train`: the ones saved next to
+    `checkpoint_path` by run.py, or stored in the checkpoint itself, or failing both the
+    ones computed over the training split.
+    """
+    dataset = train.dataset
+    stats_path = os.path.join(os.path.dirname(checkpoint_path), "normalization.json")
+    if os.path.exists(stats_path):
+        dataset.set_stats(EEGEyeNetDataset.load_stats(stats_path))
+    elif (stats := torch.load(checkpoint_path, map_location="cpu", weights_only=True).get('normalization')) is not None:
+        dataset.set_stats(stats)
+    else:
+        dataset.compute_stats(train.indices)
+    return dataset.stats
 
-test_loader = DataLoader(test, batch_size=64)
 
-if torch.cuda.is_available():
-    gpu_id = 0  # Change this to the desired GPU ID if you have multiple GPUs
-    torch.cuda.set_device(gpu_id)
-    device = torch.device(f"cuda:{gpu_id}")
-else:
-    device = torch.device("cpu")
+def evaluate(model, test_loader, device):
+    """Returns the test MSE of `model` on normalized data, along with its targets and outputs per batch."""
+    criterion = nn.MSELoss()
 
-criterion = nn.MSELoss()
+    model.to(device)
+    criterion.to(device)
 
-model.to(device)
-criterion.to(device)
+    model.eval()
+    target_list = []
+    output_list = []
+    with torch.no_grad():
+        val_loss = 0.0
+        for inputs, targets, index in test_loader:
+            inputs = inputs.to(device)
+            targets = targets.to(device)
 
-model.eval()
-target_list = []
-output_list = []
-with torch.no_grad():
-    val_loss = 0.0
-    for inputs, targets, index in test_loader:
-        mean = inputs.mean()  # Shape: [batch_size, 1, 1, 500]
-        std = inputs.std()    # Shape: [batch_size, 1, 1, 500]
+            outputs = model(inputs)
+            target_list.append(targets.squeeze())
+            output_list.append(outputs.squeeze())
+            # print(f"target: {targets.squeeze()} outputs: {outputs.squeeze()}")
+            loss = criterion(outputs.squeeze(), targets.squeeze())
+            val_loss += loss.item()
+        val_loss /= len(test_loader)
+    return val_loss, target_list, output_list
 
-        # Normalize
-        normalized_inputs = (inputs - mean) / (std + 1e-8)
-        normalized_targets = (targets - min_target)/(max_target-min_target+1e-8)
-        inputs = normalized_inputs.to(device)
-        targets = normalized_targets.to(device)
 
-        
-        
-        outputs = model(inputs)
-        target_list.append(targets.squeeze())
-        output_list.append(outputs.squeeze())
-        # print(f"target: {targets.squeeze()} outputs: {outputs.squeeze()}")
-        loss = criterion(outputs.squeeze(), targets.squeeze())
-        val_loss += loss.item()
-    val_loss /= len(test_loader)
-    print(f"Test Loss: {val_loss}")
+def load_test_split(data_file='/home/admin/EEGViT/dataset/Position_task_with_dots_synchronised_min.npz', mmap=False):
+    """Returns the EEGEyeNet (train, test) subsets used for evaluation."""
+    EEGEyeNet = EEGEyeNetDataset(data_file, mmap=mmap)
+    train_indices, _, test_indices = split(EEGEyeNet.trainY[:,0],0.7,0.15,0.15)
+    train = Subset(EEGEyeNet,indices=train_indices)
+    test = Subset(EEGEyeNet,indices=test_indices)
+    return train, test
 
 
 def plot_two_lists(list1, list2):
@@ -119,4 +114,23 @@ def plot_two_lists(list1, list2):
     
     plt.show()
 
-plot_two_lists(target_list[6][:8], output_list[6][:8])
+if __name__ == "__main__":
+    checkpoint_path = "/home/admin/EEGViT/checkpoints/model_best.pth"
+    model = EEGViT_pretrained(pretrained=False)
+    model.load_state_dict(torch.load(checkpoint_path, weights_only=True)["model_state_dict"])
+
+    train, test = load_test_split()
+    load_normalization(train, checkpoint_path)
+    test_loader = batch_loader(test, 64)
+
+    if torch.cuda.is_available():
+        gpu_id = 0  # Change this to the desired GPU ID if you have multiple GPUs
+        torch.cuda.set_device(gpu_id)
+        device = torch.device(f"cuda:{gpu_id}")
+    else:
+        device = torch.device("cpu")
+
+    val_loss, target_list, output_list = evaluate(model, test_loader, device)
+    print(f"Test Loss: {val_loss}")
+
+    plot_two_lists(target_list[6][:8], output_list[6][:8])
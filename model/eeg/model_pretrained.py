@@ -8,7 +8,8 @@ import transformers
 
 # model coming from https://arxiv.org/pdf/2308.00454
 class EEGViT_pretrained(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
+        """`pretrained=False` skips downloading the ImageNet weights, e.g. to load a checkpoint offline."""
         super().__init__()
         self.conv1 = nn.Conv2d(
             in_channels=1,
@@ -18,14 +19,18 @@ class EEGViT_pretrained(nn.Module):
             padding=(0,2),
             bias=False
         )
-        self.batchnorm1 = nn.BatchNorm2d(256, False)
+        self.batchnorm1 = nn.BatchNorm2d(256)  # the second positional argument is eps, which must be positive
         model_name = "google/vit-base-patch16-224"
-        config = transformers.ViTConfig.from_pretrained(model_name)
+        # ViTConfig defaults match the vit-base-patch16-224 architecture
+        config = transformers.ViTConfig.from_pretrained(model_name) if pretrained else transformers.ViTConfig()
         config.update({'num_channels': 256})
         config.update({'image_size': (129,14)})
         config.update({'patch_size': (8,1)})
 
-        model = transformers.ViTForImageClassification.from_pretrained(model_name, config=config, ignore_mismatched_sizes=True)
+        if pretrained:
+            model = transformers.ViTForImageClassification.from_pretrained(model_name, config=config, ignore_mismatched_sizes=True)
+        else:
+            model = transformers.ViTForImageClassification(config)
         model.vit.embeddings.patch_embeddings.projection = torch.nn.Conv2d(256, 768, kernel_size=(8, 1), stride=(8, 1), padding=(0,0), groups=256)
         model.classifier=torch.nn.Sequential(torch.nn.Linear(768,1000,bias=True),
                                      torch.nn.Dropout(p=0.1),
@@ -1,24 +1,37 @@
 from model_pretrained import EEGViT_pretrained
 from helper_functions import split
-from dataset import EEGEyeNetDataset
+from dataset import EEGEyeNetDataset, batch_loader
+import sys
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 import numpy as np
-from huggingface_hub import HfApi, HfFolder
 import os
+from contextlib import nullcontext
 from datetime import datetime
 import wandb
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from checkpointing import CheckpointManager, HubSink, unwrap_model
+from memory import enable_activation_checkpointing, accumulation_group_size
+import distributed
+import instrumentation
+
 '''
 models: EEGViT_pretrained; EEGViT_raw; ViTBase; ViTBase_pretrained
 '''
 model = EEGViT_pretrained()
 EEGEyeNet = EEGEyeNetDataset('./dataset/Position_task_with_dots_synchronised_min.npz')
-batch_size = 64
+batch_size = 64  # samples per forward/backward pass
+accumulation_steps = 1  # batches whose gradients are accumulated per optimizer step
+gradient_checkpointing = False  # recompute the ViT encoder activations in the backward pass, to fit larger batches
+keep_last = 3  # epoch checkpoints kept on disk, on top of the best one
+num_workers = 4  # DataLoader workers, samples are normalized inside them
 n_epoch = 15
 learning_rate = 1e-4
+trace_path = None  # e.g. "traces/run.json", timings of data loading and training steps (Chrome trace, or JSONL)
+profile_steps = None  # e.g. (10, 3), training steps captured with torch.profiler into ./profiles
 
 criterion = nn.MSELoss()
 
@@ -35,6 +48,8 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
         scheduler: scheduling learning rate, used when finetuning pretrained models
         repo_id: Hugging Face Hub repository ID where models will be uploaded
     '''
+    # Joins the process group when launched with torchrun, one process per device
+    device = distributed.setup()
     torch.cuda.empty_cache()
     print('Number of samples: ', len(EEGEyeNet))
     train_indices, val_indices, test_indices = split(EEGEyeNet.trainY[:,0],0.7,0.15,0.15)  # indices for the training set
@@ -45,30 +60,21 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
     val = Subset(EEGEyeNet, indices=val_indices)
     test = Subset(EEGEyeNet, indices=test_indices)
 
-    # statistics for normalization
-    train_elements = []
-    for element in train:
-        train_elements.append(element[1])
-    merg = torch.cat(train_elements).reshape(-1,2)
-    min_target = merg.min(dim=0, keepdim=True)[0]
-    max_target = merg.max(dim=0, keepdim=True)[0]
-
-
-    train_loader = DataLoader(train, batch_size=batch_size)
-    val_loader = DataLoader(val, batch_size=batch_size)
-    test_loader = DataLoader(test, batch_size=batch_size)
-
-    if torch.cuda.is_available():
-        gpu_id = 0  # Change this to the desired GPU ID if you have multiple GPUs
-        torch.cuda.set_device(gpu_id)
-        device = torch.device(f"cuda:{gpu_id}")
-    else:
-        device = torch.device("cpu")
-    if torch.cuda.device_count() > 1:
-        model = nn.DataParallel(model)  # Wrap the model with DataParallel
-    print("HI")
+    # statistics for normalization, computed once over the training samples and applied by the dataset
+    EEGEyeNet.compute_stats(train_indices)
+
+    # each batch is sliced from the dataset arrays at once, see EEGEyeNetDataset.get_batch,
+    # and every rank reads its own shard of the splits
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+                         num_replicas=distributed.world_size(), rank=distributed.rank())
+    train_loader = batch_loader(train, batch_size, **loader_kwargs)
+    val_loader = batch_loader(val, batch_size, **loader_kwargs)
+    test_loader = batch_loader(test, batch_size, **loader_kwargs)
 
     model = model.to(device)
+    if gradient_checkpointing:
+        enable_activation_checkpointing(model)
+    model = distributed.wrap_model(model, device)
     criterion = criterion.to(device)
 
     # Initialize lists to store losses
@@ -76,21 +82,37 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
     val_losses = []
     test_losses = []
     print('training...')
-    # Create checkpoint directory
+    # checkpoints are written and the best one uploaded in the background by rank 0, while
+    # every rank resumes from them
     checkpoint_dir = "checkpoints"
-    os.makedirs(checkpoint_dir, exist_ok=True)
-
-    best_val_loss = float('inf')
-
-    # Initialize Hugging Face API
-    api = HfApi()
-
-    # Initialize wandb
+    checkpoints = CheckpointManager(
+        checkpoint_dir,
+        keep_last=keep_last,
+        sink=HubSink(repo_id) if distributed.is_main_process() else None,
+        name_format="model_epoch_{step}.pth",
+        best_name="model_best.pth",
+    )
+    # inference reads the statistics from next to the checkpoint instead of recomputing them
+    if distributed.is_main_process():
+        EEGEyeNet.save_stats(os.path.join(checkpoint_dir, "normalization.json"))
+
+    start_epoch = 0
+    checkpoint = checkpoints.load_latest()
+    if checkpoint is not None:
+        unwrap_model(model).load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if scheduler is not None and checkpoint.get('scheduler_state_dict') is not None:
+            scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        start_epoch = checkpoint['epoch'] + 1
+        print(f"Resuming from epoch {start_epoch}")
+
+    # Initialize wandb, only logging from rank 0
     wandb.init(
         project="EEGViT",
+        mode=None if distributed.is_main_process() else "disabled",
         config={
             "learning_rate": learning_rate,
-            "batch_size": batch_size,
+            "batch_size": batch_size * distributed.world_size(),
             "n_epochs": n_epoch,
             "model": model.__class__.__name__,
             "optimizer": "Adam",
@@ -98,30 +120,37 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
         }
     )
 
+    if trace_path or profile_steps:
+        instrumentation.configure(trace_path, profile_steps=profile_steps)
+
     # Train the model
-    for epoch in range(n_epoch):
+    for epoch in range(start_epoch, n_epoch):
+        distributed.set_epoch(train_loader, epoch)
         model.train()
         epoch_train_loss = 0.0
 
-        for i, (inputs, targets, index) in tqdm(enumerate(train_loader)):
-            mean = inputs.mean()
-            std = inputs.std()
-
-            inputs = (inputs - mean)/(std+1e-8)
-            targets = (targets - min_target)/(max_target-min_target+1e-8)
-
+        for i, (inputs, targets, index) in tqdm(enumerate(instrumentation.timed_iter(train_loader))):
             # Move the inputs and targets to the GPU (if available)
             inputs = inputs.to(device)
             targets = targets.to(device)
 
-            # Compute the outputs and loss for the current batch
-            optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = criterion(outputs.squeeze(), targets.squeeze())
-
-            # Compute the gradients and update the parameters
-            loss.backward()
-            optimizer.step()
+            # Accumulate the gradients, and update the parameters every `accumulation_steps` batches;
+            # DistributedDataParallel only all-reduces the gradients before the update
+            optimizer_step = (i + 1) % accumulation_steps == 0 or i + 1 == len(train_loader)
+            no_sync = model.no_sync if distributed.is_distributed() and not optimizer_step else nullcontext
+            with no_sync():
+                # Compute the outputs and loss for the current batch
+                with instrumentation.span("forward"):
+                    outputs = model(inputs)
+                    loss = criterion(outputs.squeeze(), targets.squeeze())
+
+                with instrumentation.span("backward"):
+                    (loss / accumulation_group_size(i, len(train_loader), accumulation_steps)).backward()
+            if optimizer_step:
+                with instrumentation.span("optimizer"):
+                    optimizer.step()
+                    optimizer.zero_grad()
+                instrumentation.step()
             epoch_train_loss += loss.item()
 
             # Log batch loss
@@ -131,7 +160,8 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
             if i % 100 == 0:
                 print(f"Epoch {epoch}, Batch {i}, Loss: {loss.item()}")
 
-        epoch_train_loss /= len(train_loader)
+        # the losses are averaged over the batches of every rank
+        epoch_train_loss = distributed.reduce_mean(epoch_train_loss, len(train_loader))
         train_losses.append(epoch_train_loss)
 
         # Evaluate the model on the validation set
@@ -139,12 +169,6 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
         with torch.no_grad():
             val_loss = 0.0
             for inputs, targets, index in val_loader:
-                mean = inputs.mean()
-                std = inputs.std()
-
-                inputs = (inputs - mean)/(std+1e-8)
-                targets = (targets - min_target)/(max_target-min_target+1e-8)
-
                 # Move the inputs and targets to the GPU (if available)
                 inputs = inputs.to(device)
                 targets = targets.to(device)
@@ -156,55 +180,26 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
                 val_loss += loss.item()
 
 
-            val_loss /= len(val_loader)
+            val_loss = distributed.reduce_mean(val_loss, len(val_loader))
             val_losses.append(val_loss)
 
             print(f"Epoch {epoch}, Val Loss: {val_loss}")
 
-            # After validation loss calculation
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                checkpoint_path = os.path.join(checkpoint_dir, f"model_best.pth")
-                torch.save({
-                    'epoch': epoch,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                    'val_loss': val_loss,
-                    'train_loss': epoch_train_loss,
-                }, checkpoint_path)
-
-                # Upload to Hugging Face Hub
-                try:
-                    api.upload_file(
-                        path_or_fileobj=checkpoint_path,
-                        path_in_repo=f"model_best.pth",
-                        repo_id=repo_id,
-                        repo_type="model",
-                    )
-                    print(f"Uploaded best model checkpoint to {repo_id}")
-                except Exception as e:
-                    print(f"Failed to upload to Hugging Face Hub: {e}")
-
-            # Save periodic checkpoint
-            if (epoch + 1) % 5 == 0:  # Save every 5 epochs
-                checkpoint_path = os.path.join(checkpoint_dir, f"model_epoch_{epoch+1}.pth")
-                torch.save({
-                    'epoch': epoch,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                    'val_loss': val_loss,
-                    'train_loss': epoch_train_loss,
-                }, checkpoint_path)
+            # Snapshot the epoch, kept as model_best.pth and uploaded when the validation loss improves
+            if distributed.is_main_process() and checkpoints.save({
+                'epoch': epoch,
+                'model_state_dict': unwrap_model(model).state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'scheduler_state_dict': scheduler.state_dict() if scheduler is not None else None,
+                'val_loss': val_loss,
+                'train_loss': epoch_train_loss,
+                'normalization': EEGEyeNet.stats,
+            }, step=epoch + 1, metric=val_loss):
+                print(f"New best model at epoch {epoch}, uploading to {repo_id}")
 
         with torch.no_grad():
             val_loss = 0.0
             for inputs, targets, index in test_loader:
-                mean = inputs.mean()
-                std = inputs.std()
-
-                inputs = (inputs - mean)/(std+1e-8)
-                targets = (targets - min_target)/(max_target-min_target+1e-8)
-
                 # Move the inputs and targets to the GPU (if available)
                 inputs = inputs.to(device)
                 targets = targets.to(device)
@@ -215,7 +210,7 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
                 loss = criterion(outputs.squeeze(), targets.squeeze())
                 val_loss += loss.item()
 
-            val_loss /= len(test_loader)
+            val_loss = distributed.reduce_mean(val_loss, len(test_loader))
             test_losses.append(val_loss)
 
             print(f"Epoch {epoch}, test Loss: {val_loss}")
@@ -232,8 +227,15 @@ def train(model, optimizer, scheduler=None, repo_id="your-username/your-repo-nam
             "learning_rate": optimizer.param_groups[0]['lr']
         })
 
+    # Wait for the last checkpoints to be written and uploaded
+    checkpoints.close()
+    if trace_path or profile_steps:
+        instrumentation.close()
+        instrumentation.print_summary()
+
     # Close wandb run
     wandb.finish()
+    distributed.cleanup()
 
 if __name__ == "__main__":
     # Login to Hugging Face Hub (you'll need to do this once)
@@ -0,0 +1,218 @@
+"""
+Lightweight instrumentation of the data loading and training hot paths.
+
+Timed spans and counters are recorded to a local file: JSON lines (`.jsonl`), or a Chrome
+trace (`.json`, to open in chrome://tracing or https://ui.perfetto.dev). Spans are also
+aggregated in memory, see `summary`. Optionally, a window of training steps is captured
+with `torch.profiler`, in which case the spans also show up in the profiler trace.
+
+Everything is disabled until `configure` is called, and then `span` costs a couple of
+function calls. DataLoader worker processes forked after `configure` record to the same
+file, tagged with their pid.
+
+    import instrumentation
+
+    instrumentation.configure("trace.json", profile_steps=(10, 3))
+    for batch in loader:
+        with instrumentation.span("forward"):
+            ...
+        instrumentation.step()
+    instrumentation.close()
+"""
+
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import contextlib
+import torch
+from typing import Callable, Optional, Tuple
+
+
+class Instrumentation:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.chrome = False
+        self.fd = None
+        self.buffer = []
+        self.flush_every = 256
+        self.profiler = None
+        self.steps = 0
+        self.reset_summary()
+
+    def configure(self,
+                  path: Optional[str] = None,
+                  profile_steps: Optional[Tuple[int, int]] = None,
+                  profile_dir: str = "profiles"):
+        """
+        Enables recording. Spans and counters go to `path` when given (Chrome trace if it ends
+        in `.json`, JSON lines otherwise). `profile_steps=(start, count)` captures `count`
+        steps with `torch.profiler`, starting at step `start`, into `profile_dir`.
+        """
+        self.close()
+        self.reset_summary()
+        self.steps = 0
+        self.enabled = True
+        self.pid = os.getpid()
+        self.path = path
+        self.chrome = path is not None and path.endswith(".json")
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # appends are shared by the worker processes, every flush is a single write
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_TRUNC, 0o644)
+            if self.chrome:
+                os.write(self.fd, b"[\n")  # the closing bracket is optional in the trace format
+
+        if profile_steps is not None:
+            start, count = profile_steps
+            os.makedirs(profile_dir, exist_ok=True)
+            self.profiler = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=count, repeat=1),
+                on_trace_ready=lambda profiler: profiler.export_chrome_trace(
+                    os.path.join(profile_dir, f"profile_{os.getpid()}_{profiler.step_num}.json")
+                ),
+                record_shapes=True,
+                profile_memory=True,
+            )
+            self.profiler.start()
+        return self
+
+    def reset_summary(self):
+        self.totals = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def _span(self, name, attributes):
+        with contextlib.ExitStack() as stack:
+            if self.profiler is not None:
+                stack.enter_context(torch.profiler.record_function(name))
+            timestamp = time.time_ns() // 1000
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                duration = time.perf_counter() - start
+                count, total, longest = self.totals.get(name, (0, 0.0, 0.0))
+                self.totals[name] = (count + 1, total + duration, max(longest, duration))
+                if self.fd is not None:
+                    self._record({"name": name, "ph": "X", "ts": timestamp, "dur": duration * 1e6, "args": attributes})
+
+    def span(self, name: str, **attributes):
+        """Context manager timing its body as `name`, a no-op unless enabled."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._span(name, attributes)
+
+    def timed(self, name: str) -> Callable:
+        """Decorator timing every call of the function as `name`."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, value: float = 1):
+        """Adds `value` to the counter `name`."""
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+        if self.fd is not None:
+            self._record({"name": name, "ph": "C", "ts": time.time_ns() // 1000, "args": {name: self.counters[name]}})
+
+    def step(self):
+        """Marks the end of a training step: advances the profiler window and flushes the records."""
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.profiler is not None:
+            self.profiler.step()
+        self.flush()
+
+    def summary(self) -> dict:
+        """Count, total, mean and max milliseconds of every span recorded by this process, and the counters."""
+        spans = {
+            name: {"count": count, "total_ms": 1000 * total, "mean_ms": 1000 * total / count, "max_ms": 1000 * longest}
+            for name, (count, total, longest) in self.totals.items()
+        }
+        return {"spans": spans, "counters": dict(self.counters)}
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{'span':>24} {'count':>8} {'total ms':>12} {'mean ms':>10} {'max ms':>10}")
+        for name, span in sorted(summary["spans"].items(), key=lambda item: -item[1]["total_ms"]):
+            print(f"{name:>24} {span['count']:>8} {span['total_ms']:>12.1f} {span['mean_ms']:>10.3f} {span['max_ms']:>10.3f}")
+        for name, value in summary["counters"].items():
+            print(f"{name:>24} {value:>8}")
+
+    def _record(self, event):
+        event["pid"], event["tid"] = os.getpid(), threading.get_ident()
+        if event["pid"] != self.pid:
+            # a forked worker: drop the records inherited from the parent, and write right away
+            # since workers are terminated without running exit handlers
+            self.pid, self.buffer, self.flush_every = event["pid"], [], 1
+        self.buffer.append(event)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.fd is None or not self.buffer:
+            return
+        if self.chrome:
+            lines = "".join(json.dumps(event) + ",\n" for event in self.buffer)
+        else:
+            lines = "".join(json.dumps({key: value for key, value in event.items() if key != "ph"}) + "\n"
+                            for event in self.buffer)
+        self.buffer = []
+        os.write(self.fd, lines.encode())
+
+    def close(self):
+        """Stops the profiler and flushes the remaining records."""
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# process-wide instance, used through the module-level functions below
+_instrumentation = Instrumentation()
+atexit.register(_instrumentation.close)
+
+configure = _instrumentation.configure
+span = _instrumentation.span
+timed = _instrumentation.timed
+count = _instrumentation.count
+step = _instrumentation.step
+summary = _instrumentation.summary
+print_summary = _instrumentation.print_summary
+close = _instrumentation.close
+
+
+class TimedCollate:
+    """Wraps a DataLoader `collate_fn` (the default one when None) in a `collate` span, picklable for workers."""
+
+    def __init__(self, collate_fn: Optional[Callable] = None):
+        self.collate_fn = collate_fn or torch.utils.data.default_collate
+
+    def __call__(self, batch):
+        with span("collate"):
+            return self.collate_fn(batch)
+
+
+def timed_iter(iterable, name: str = "data"):
+    """Yields from `iterable`, timing every `next` as `name`, e.g. the wait for a DataLoader batch."""
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
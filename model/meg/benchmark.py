@@ -0,0 +1,81 @@
+"""
+CPU-runnable training throughput benchmark of MatrixGPT2 across precision and compilation modes.
+Runs on random tokens with a small, randomly initialised GPT2 configuration, e.g.:
+
+    python benchmark.py --channels 8 --seq-len 64 --compile
+"""
+
+import time
+import argparse
+import torch
+from types import SimpleNamespace
+from transformers import GPT2Config
+from meg_gpt import MatrixGPT2
+from precision import PRECISIONS, autocast, grad_scaler, maybe_compile
+
+
+def benchmark_mode(args, precision, compile, device):
+    """Returns the tokens/sec of MatrixGPT2 training steps under `precision` (and `compile`)."""
+    gpt2_config = GPT2Config(
+        vocab_size=args.vocab_size,
+        n_positions=args.seq_len,
+        n_embd=args.embd,
+        n_layer=args.layers,
+        n_head=args.heads,
+    )
+    model_args = SimpleNamespace(
+        num_channels=args.channels, vocab_size=args.vocab_size, gpt2_config=gpt2_config
+    )
+    torch.manual_seed(0)
+    model = maybe_compile(MatrixGPT2(gpt2_config, model_args).to(device), compile)
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    scaler = grad_scaler(precision, device)
+
+    batch = torch.randint(0, args.vocab_size, (args.batch_size, args.channels, args.seq_len + 1), device=device)
+    inputs, targets = batch[:, :, :-1], batch[:, :, -1:]
+
+    def step():
+        with autocast(precision, device):
+            logits = model({'inputs': inputs})
+            loss = model.criterion(logits.reshape(-1, args.vocab_size), targets.reshape(-1))
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        return loss.item()
+
+    for _ in range(args.warmup):
+        step()
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    elapsed = time.perf_counter() - start
+
+    return args.steps * inputs.numel() / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--seq-len', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--embd', type=int, default=768)
+    parser.add_argument('--heads', type=int, default=12)
+    parser.add_argument('--vocab-size', type=int, default=255)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--compile', action='store_true', help='Also benchmark the torch.compile-d model')
+    parser.add_argument('--device', type=str, default='cpu')
+    parsed_args = parser.parse_args()
+
+    device = torch.device(parsed_args.device)
+    compile_modes = [False, True] if parsed_args.compile else [False]
+
+    print(f"{'precision':>10} {'compile':>8} {'tokens/sec':>12}")
+    for precision in PRECISIONS:
+        for compile in compile_modes:
+            tokens_per_sec = benchmark_mode(parsed_args, precision, compile, device)
+            print(f"{precision:>10} {str(compile):>8} {tokens_per_sec:>12.1f}")
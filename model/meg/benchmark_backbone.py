@@ -0,0 +1,94 @@
+"""
+Compares the flattened MatrixGPT2 backbone (one GPT2 sequence per channel) against the
+channel-grouped one, for a full-sensor channel count. For each `channel_group_size` it
+reports the FLOPs of a training step, the bytes of activations saved for backward and the
+wall time per step, on CPU with a small, randomly initialised GPT2 configuration, e.g.:
+
+    python benchmark_backbone.py --channels 306 --group-sizes 1 3 6
+"""
+
+import time
+import argparse
+import torch
+from types import SimpleNamespace
+from torch.utils.flop_counter import FlopCounterMode
+from transformers import GPT2Config
+from meg_gpt import MatrixGPT2
+
+
+def build_model(args, group_size):
+    gpt2_config = GPT2Config(
+        vocab_size=args.vocab_size,
+        n_positions=args.seq_len,
+        n_embd=args.embd,
+        n_layer=args.layers,
+        n_head=args.heads,
+        channel_group_size=group_size,
+    )
+    model_args = SimpleNamespace(num_channels=args.channels, vocab_size=args.vocab_size, gpt2_config=gpt2_config)
+    torch.manual_seed(0)
+    return MatrixGPT2(gpt2_config, model_args)
+
+
+def training_step(model, batch):
+    inputs, targets = batch[:, :, :-1], batch[:, :, -1:]
+    logits = model({'inputs': inputs})
+    loss = model.criterion(logits.reshape(-1, model.quant_levels), targets.reshape(-1))
+    loss.backward()
+    return loss
+
+
+def saved_activation_bytes(model, batch):
+    """Bytes of the tensors autograd keeps alive for the backward pass of a training step."""
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        training_step(model, batch)
+    return sum(saved.values())
+
+
+def benchmark_backbone(args, group_size):
+    model = build_model(args, group_size)
+    batch = torch.randint(0, args.vocab_size, (args.batch_size, args.channels, args.seq_len + 1))
+
+    with FlopCounterMode(display=False) as flop_counter:
+        training_step(model, batch)
+    activations = saved_activation_bytes(model, batch)
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        model.zero_grad()
+        training_step(model, batch)
+    step_time = (time.perf_counter() - start) / args.steps
+
+    return {
+        "group_size": group_size,
+        "sequences": args.batch_size * args.channels // group_size,
+        "gflops": flop_counter.get_total_flops() / 1e9,
+        "activations_mb": activations / 2**20,
+        "step_time_s": step_time,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=306)
+    parser.add_argument('--group-sizes', type=int, nargs='+', default=[1, 3, 6])
+    parser.add_argument('--seq-len', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--embd', type=int, default=128)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--vocab-size', type=int, default=255)
+    parser.add_argument('--steps', type=int, default=3)
+    parsed_args = parser.parse_args()
+
+    print(f"{'group':>6} {'sequences':>10} {'GFLOPs':>10} {'activations MB':>15} {'step time s':>12}")
+    for group_size in parsed_args.group_sizes:
+        result = benchmark_backbone(parsed_args, group_size)
+        print(f"{result['group_size']:>6} {result['sequences']:>10} {result['gflops']:>10.2f} "
+              f"{result['activations_mb']:>15.1f} {result['step_time_s']:>12.3f}")
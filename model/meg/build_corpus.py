@@ -0,0 +1,130 @@
+"""
+Builds a tokenized MEG corpus out of raw recordings.
+
+Every recording is tokenized block by block with its own `SignalProcessor` scale, and
+written into sharded uint8 `.npy` files shaped (channels, samples), so that the corpus is
+never held in memory at once. Recordings are packed back to back along the time axis of a
+shard, and `index.json` records the (shard, offset, length) of each of them.
+
+Supported recordings are `.fif` files (MEG channels are picked) and `.npy` arrays, either
+a single (channels, samples) recording or a stack of (recordings, channels, samples).
+"""
+
+import os
+import sys
+import json
+import numpy as np
+from typing import Iterator, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import SignalProcessor
+
+INDEX = "index.json"
+
+
+class _FifRecording:
+    """Reads the MEG channels of a FIF file block by block, without preloading it."""
+
+    def __init__(self, path: str):
+        import mne
+        self.raw = mne.io.read_raw_fif(path, preload=False, verbose=False)
+        self.picks = mne.pick_types(self.raw.info, meg=True)
+        self.shape = (len(self.picks), int(self.raw.n_times))
+
+    def blocks(self, block_size: int) -> Iterator[np.ndarray]:
+        for start in range(0, self.shape[1], block_size):
+            yield self.raw.get_data(picks=self.picks, start=start, stop=start + block_size)
+
+
+class _ArrayRecording:
+    """A (channels, samples) array, typically memory-mapped."""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+        self.shape = array.shape
+
+    def blocks(self, block_size: int) -> Iterator[np.ndarray]:
+        for start in range(0, self.shape[1], block_size):
+            yield self.array[:, start:start + block_size]
+
+
+def _open_recordings(paths: List[str]) -> Iterator[Tuple[str, object]]:
+    for path in paths:
+        if path.endswith(".fif"):
+            yield path, _FifRecording(path)
+        else:
+            array = np.load(path, mmap_mode="r")
+            if array.ndim == 2:
+                yield path, _ArrayRecording(array)
+            else:
+                for i, recording in enumerate(array):
+                    yield f"{path}[{i}]", _ArrayRecording(recording)
+
+
+def build_corpus(paths: List[str],
+                 out_dir: str,
+                 shard_size: int = 50_000_000,
+                 block_size: int = 65_536,
+                 num_tokens: int = 255
+                ) -> dict:
+    """
+    Tokenizes the recordings in `paths` into `out_dir`. Shards hold at most `shard_size`
+    samples per channel, unless a single recording is longer than that.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    recordings = list(_open_recordings(paths))
+    num_channels = recordings[0][1].shape[0]
+
+    # assign recordings to shards upfront, so each shard can be written as a memmap
+    shards, current, current_length = [], [], 0
+    for source, recording in recordings:
+        if recording.shape[0] != num_channels:
+            raise ValueError(f"{source} has {recording.shape[0]} channels, expected {num_channels}")
+        if current and current_length + recording.shape[1] > shard_size:
+            shards.append(current)
+            current, current_length = [], 0
+        current.append((source, recording))
+        current_length += recording.shape[1]
+    shards.append(current)
+
+    index = {"num_channels": num_channels, "num_tokens": num_tokens, "shards": [], "recordings": []}
+    for shard, members in enumerate(shards):
+        name = f"shard_{shard:05d}.npy"
+        length = sum(recording.shape[1] for _, recording in members)
+        tokens = np.lib.format.open_memmap(
+            os.path.join(out_dir, name), mode="w+", dtype=np.uint8, shape=(num_channels, length)
+        )
+
+        offset = 0
+        for source, recording in members:
+            processor = SignalProcessor(num_tokens=num_tokens).fit_stream(recording.blocks(block_size))
+            position = offset
+            for block in processor.transform_stream(recording.blocks(block_size)):
+                tokens[:, position:position + block.shape[1]] = block
+                position += block.shape[1]
+
+            index["recordings"].append({
+                "source": source, "shard": shard, "offset": offset, "length": recording.shape[1]
+            })
+            offset = position
+
+        tokens.flush()
+        del tokens
+        index["shards"].append(name)
+        print(f"Wrote {name} with {len(members)} recordings, {length} samples")
+
+    with open(os.path.join(out_dir, INDEX), "w") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recordings', nargs='+', help='.fif or .npy recordings to tokenize')
+    parser.add_argument('--out-dir', type=str, required=True)
+    parser.add_argument('--shard-size', type=int, default=50_000_000, help='Samples per channel in a shard')
+    parser.add_argument('--block-size', type=int, default=65_536, help='Samples tokenized at once')
+    parsed_args = parser.parse_args()
+
+    build_corpus(parsed_args.recordings, parsed_args.out_dir, parsed_args.shard_size, parsed_args.block_size)
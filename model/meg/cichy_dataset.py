@@ -1,24 +1,67 @@
-import numpy as np 
+import os
+import sys
+import json
+import random
+import numpy as np
+import torch
+from typing import Optional
 from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
+
+DEFAULT_DATA_PATH = '/home/admin/MEGmodel/MEG-gpt/tokenised_data/combined_data.npy'
 
 
 class MEGWaves(Dataset):
     """
-    Dataset class for MEG waves. 
+    Dataset class for MEG waves.
     Shape is:
         - (Num recordings, Num channels, Num timepoints)
+
+    `data_path` is either a single `.npy` array of that shape, or a corpus directory written
+    by `build_corpus.py`. Both are memory-mapped. Corpus samples are windows of `window`
+    timepoints, which corpus directories require, randomly cropped from the recordings each
+    time they are drawn; an epoch holds as many samples as non-overlapping windows fit in the
+    corpus.
     """
-    def __init__(self, data_path):
+    def __init__(self, data_path, window=None):
         self.data_path = data_path
-        self.data = np.load(data_path)
-        
+        self.is_corpus = os.path.isdir(data_path)
+
+        if not self.is_corpus:
+            self.data = np.load(data_path, mmap_mode='r')
+            return
+        if window is None:
+            raise ValueError(f"{data_path} is a corpus directory, a window length is needed to crop its samples")
+
+        with open(os.path.join(data_path, "index.json")) as f:
+            self.index = json.load(f)
+        self.shards = [np.load(os.path.join(data_path, name), mmap_mode='r') for name in self.index["shards"]]
+
+        lengths = [recording["length"] for recording in self.index["recordings"]]
+        self.window = window
+        self.recordings = [recording for recording in self.index["recordings"] if recording["length"] >= self.window]
+        if not self.recordings:
+            raise ValueError(f"No recording of {data_path} holds a window of {self.window} timepoints, "
+                             f"the longest has {max(lengths, default=0)}")
+        self.cumulative_windows = np.cumsum([recording["length"] // self.window for recording in self.recordings])
+
     def __len__(self):
+        if self.is_corpus:
+            return int(self.cumulative_windows[-1])
         return len(self.data)
 
+    @instrumentation.timed("dataset.getitem")
     def __getitem__(self, index):
-        return self.data[index, :, :]
+        if not self.is_corpus:
+            return np.array(self.data[index, :, :])
+
+        recording = self.recordings[np.searchsorted(self.cumulative_windows, index, side='right')]
+        start = recording["offset"] + random.randint(0, recording["length"] - self.window)
+        tokens = self.shards[recording["shard"]][:, start:start + self.window]
+        return torch.from_numpy(tokens.astype(np.int64))
 
 
 class CichyDataset:
@@ -28,18 +71,24 @@ class CichyDataset:
     - https://www.nature.com/articles/srep27755
 
     """
-    def __init__(self, data_path:str='/home/admin/MEGmodel/MEG-gpt/tokenised_data/combined_data.npy'):
-        self.data_path = data_path
-        self.dataset = MEGWaves(data_path)
-    
+    def __init__(self, data_path:Optional[str]=None, window:Optional[int]=None):
+        self.data_path = data_path or DEFAULT_DATA_PATH
+        self.dataset = MEGWaves(self.data_path, window=window)
+
     def __len__(self):
         return len(self.dataset)
-    
-    def train_dataloader(self, batch_size:int=32, shuffle:bool=True):
-        return DataLoader(self.dataset, batch_size=batch_size, shuffle=shuffle)
-    
-    def val_dataloader(self, batch_size:int=32, shuffle:bool=False):
-        return DataLoader(self.dataset, batch_size=batch_size, shuffle=shuffle)
+
+    def _dataloader(self, batch_size, shuffle, distributed):
+        # under DistributedDataParallel, every rank loads its own shard, reshuffled by `set_epoch`
+        sampler = DistributedSampler(self.dataset, shuffle=shuffle) if distributed else None
+        return DataLoader(self.dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                          collate_fn=instrumentation.TimedCollate())
+
+    def train_dataloader(self, batch_size:int=32, shuffle:bool=True, distributed:bool=False):
+        return self._dataloader(batch_size, shuffle, distributed)
+
+    def val_dataloader(self, batch_size:int=32, shuffle:bool=False, distributed:bool=False):
+        return self._dataloader(batch_size, shuffle, distributed)
 
 
 # example usage
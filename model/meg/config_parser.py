@@ -11,6 +11,20 @@ class TrainingConfig:
     epochs: int
     val_freq: int
     print_freq: int
+    precision: str = 'fp32'  # one of fp32, bf16, fp16
+    compile: bool = False  # whether to torch.compile the model
+    batch_size: int = 8  # samples per optimizer step
+    micro_batch_size: Optional[int] = None  # samples per forward/backward pass, gradients accumulated up to batch_size
+    memory_budget_mb: Optional[float] = None  # when set, micro_batch_size is the largest one fitting this budget
+    gradient_checkpointing: bool = False  # recompute the GPT2 block activations in the backward pass
+    trace_path: Optional[str] = None  # timings of data loading and training steps, Chrome trace (.json) or JSONL
+    profile_steps: Optional[List[int]] = None  # [start, count], training steps captured with torch.profiler
+
+    def __post_init__(self):
+        if self.precision not in ('fp32', 'bf16', 'fp16'):
+            raise ValueError(f"Unknown precision {self.precision}, expected one of fp32, bf16, fp16")
+        if self.micro_batch_size is not None and not 0 < self.micro_batch_size <= self.batch_size:
+            raise ValueError(f"micro_batch_size={self.micro_batch_size} should be between 1 and batch_size={self.batch_size}")
 
 @dataclass
 class DatasetConfig:
@@ -22,6 +36,12 @@ class DatasetConfig:
     save_data: bool
     dump_data: str
     load_data: str
+    window: Optional[int] = None  # timepoints per sample of a corpus directory, None for n_positions + out_times
+
+    def __post_init__(self):
+        # YAML reads an unquoted None as the string "None"
+        if self.data_path in ('None', ''):
+            self.data_path = None
 
 @dataclass
 class SavingConfig:
@@ -29,6 +49,7 @@ class SavingConfig:
     push_to_hub: bool
     hub_user: str
     model_name: str
+    keep_last: int = 3  # epoch checkpoints kept on disk, on top of the best one
 
 class Config:
     def __init__(self, config_path: str):
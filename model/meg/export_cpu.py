@@ -0,0 +1,113 @@
+"""
+Exports MatrixGPT2 for CPU inference and reports accuracy against latency for each variant:
+fp32 and dynamic int8, eager and TorchScript (plus ONNX with --onnx). Accuracy is the
+next-token cross-entropy on held-out windows, and the fraction of next tokens on which a
+variant agrees with the fp32 model, e.g.:
+
+    python export_cpu.py --config config.yaml --checkpoint model.pt --data-path corpus/ --window 64
+"""
+
+import os
+import sys
+import json
+import argparse
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.data import DataLoader
+from meg_gpt import MatrixGPT2
+from config_parser import Config
+from cichy_dataset import MEGWaves
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cpu_export import quantize_dynamic_int8, export_torchscript, export_onnx, load_cpu_model, measure_latency
+
+
+class NextTokenLogits(nn.Module):
+    """Tensor-in, tensor-out view of MatrixGPT2: B x C x T tokens to B x C x 1 x V next-token logits."""
+
+    def __init__(self, model: MatrixGPT2):
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        return self.model({'inputs': inputs})
+
+
+def export_variants(model, example_inputs, out_dir, onnx=False):
+    """Writes the CPU exports of `model` to `out_dir`, returning the name -> model of every variant."""
+    # tracing unrolls the chunk loop for the example shape, export a single fused pass instead
+    model.max_chunk_tokens = None
+    wrapped = NextTokenLogits(model).eval()
+    int8_model = quantize_dynamic_int8(wrapped)
+    variants = {"fp32": wrapped, "int8": int8_model}
+
+    for name, variant in (("fp32", wrapped), ("int8", int8_model)):
+        path = os.path.join(out_dir, f"meg_gpt_{name}.pt")
+        export_torchscript(variant, example_inputs, path)
+        variants[f"torchscript_{name}"] = load_cpu_model(path)
+
+    if onnx:
+        path = os.path.join(out_dir, "meg_gpt_fp32.onnx")
+        export_onnx(wrapped, example_inputs, path)
+        variants["onnx_fp32"] = load_cpu_model(path)
+
+    return variants
+
+
+@torch.inference_mode()
+def evaluate(variants, batches, vocab_size):
+    """Next-token cross-entropy of every variant, and its next-token agreement with the fp32 model."""
+    totals = {name: {"cross_entropy": 0.0, "agreement": 0.0} for name in variants}
+    for batch in batches:
+        inputs, targets = batch[:, :, :-1], batch[:, :, -1:]
+        reference = variants["fp32"](inputs).argmax(dim=-1)
+        for name, variant in variants.items():
+            logits = variant(inputs)
+            totals[name]["cross_entropy"] += F.cross_entropy(logits.reshape(-1, vocab_size), targets.reshape(-1)).item()
+            totals[name]["agreement"] += (logits.argmax(dim=-1) == reference).float().mean().item()
+
+    return {name: {key: value / len(batches) for key, value in metrics.items()} for name, metrics in totals.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='./config.yaml', help='Path to config YAML file')
+    parser.add_argument('--checkpoint', type=str, default=None, help='MatrixGPT2 state dict')
+    parser.add_argument('--data-path', type=str, default=None, help='Tokenised .npy file or corpus directory, random tokens if unset')
+    parser.add_argument('--window', type=int, default=64, help='Timesteps per evaluation window, the last one is predicted')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--num-batches', type=int, default=8)
+    parser.add_argument('--out-dir', type=str, default='./exports')
+    parser.add_argument('--onnx', action='store_true', help='Also export and evaluate ONNX (needs onnx, onnxruntime)')
+    parsed_args = parser.parse_args()
+
+    torch.set_num_threads(os.cpu_count())
+    os.makedirs(parsed_args.out_dir, exist_ok=True)
+
+    args = Config(parsed_args.config).to_args()
+    model = MatrixGPT2(args.gpt2_config, args)
+    if parsed_args.checkpoint is not None:
+        model.load_state_dict(torch.load(parsed_args.checkpoint, map_location="cpu", weights_only=True))
+    model.eval()
+
+    if parsed_args.data_path is not None:
+        loader = DataLoader(MEGWaves(parsed_args.data_path, window=parsed_args.window + 1), batch_size=parsed_args.batch_size)
+        batches = [batch for batch, _ in zip(loader, range(parsed_args.num_batches))]
+    else:
+        vocab_size = args.gpt2_config.vocab_size
+        shape = (parsed_args.batch_size, args.num_channels, parsed_args.window + 1)
+        batches = [torch.randint(0, vocab_size, shape) for _ in range(parsed_args.num_batches)]
+
+    example_inputs = (batches[0][:, :, :-1],)
+    variants = export_variants(model, example_inputs, parsed_args.out_dir, onnx=parsed_args.onnx)
+    report = evaluate(variants, batches, args.gpt2_config.vocab_size)
+
+    print(f"{'variant':>18} {'cross-entropy':>14} {'agreement':>10} {'p50 ms':>10} {'p90 ms':>10}")
+    for name, variant in variants.items():
+        report[name].update(measure_latency(variant, example_inputs))
+        print(f"{name:>18} {report[name]['cross_entropy']:>14.4f} {report[name]['agreement']:>10.3f} "
+              f"{report[name]['p50_ms']:>10.1f} {report[name]['p90_ms']:>10.1f}")
+
+    with open(os.path.join(parsed_args.out_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
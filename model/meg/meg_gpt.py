@@ -14,10 +14,10 @@ class MatrixEmbeddings(Module):
         self.args = args
         
         # Per-token embedding vectors
-        self.token_embedding = Embedding(args.vocab_size, 768)  # token ~ quant
+        self.token_embedding = Embedding(args.vocab_size, args.gpt2_config.n_embd)  # token ~ quant
         
         # Per-channel embedding vectors
-        self.channel_embedding = Embedding(args.num_channels, 768)
+        self.channel_embedding = Embedding(args.num_channels, args.gpt2_config.n_embd)
         
         # Initialize weights
         self.apply(self._init_weights)
@@ -26,72 +26,131 @@ class MatrixEmbeddings(Module):
         if isinstance(module, Embedding):
             module.weight.data.normal_(mean=0.0, std=0.02)
             
-    def forward(self, x, ids, condition=None, subject_ids=None):
+    def forward(self, x, ids=None, condition=None, subject_ids=None):
+        """Embeds B x C x T tokens. `ids` selects the channels of x, all of them when None."""
         # Get embeddings for inputs
         x = self.token_embedding(x)  # B x C x T -> B x C x T x E
         
-        channel_ids = torch.arange(
-            self.args.num_channels, 
-            dtype=torch.long,
-            device=x.device
-        )
-        
         # Get channel embeddings
-        channel_emb = self.channel_embedding(
-            channel_ids[ids]
-        ).unsqueeze(0).unsqueeze(2) # 1 x C x 1 x E
+        if ids is None:
+            channel_emb = self.channel_embedding.weight  # C x E
+        else:
+            channel_emb = self.channel_embedding(
+                torch.as_tensor(ids, dtype=torch.long, device=x.device)
+            )
         
-        # Add channel embeddings
-        x = x + channel_emb  # at last, B x C x T x E
+        # Add channel embeddings, broadcast as 1 x C x 1 x E
+        x = x + channel_emb[:, None, :]  # at last, B x C x T x E
             
         return x
 
 class OutputHead(Module):
-    def __init__(self, config, num_channels, out_times):
+    def __init__(self, config, num_channels, out_times, group_size=1):
         super().__init__()
         self.out_times = out_times
         self.num_channels = num_channels
         
-        # Output projection
-        self.head = Linear(config.n_embd, config.vocab_size, bias=False)
+        # Output projection, one set of logits per channel in the group
+        self.head = Linear(config.n_embd, group_size * config.vocab_size, bias=False)
         self.head.weight.data.normal_(mean=0.0, std=0.02)
         
     def forward(self, x):
-        x = self.head(x)  # B*C x T x vocab_size
-        return x[:, -self.out_times:, :]
+        # only the last `out_times` positions are projected onto the vocabulary
+        return self.head(x[:, -self.out_times:, :])  # B*C/G x out_times x G*vocab_size
 
 class MatrixGPT2(Module):
+    """
+    Multi-channel GPT2. By default every (batch, channel) pair is flattened into its own GPT2
+    sequence. With `channel_group_size` G > 1 in the GPT2 config, each timestep of G adjacent
+    channels is projected into a single shared token, so that GPT2 runs on B*C/G sequences
+    and attention mixes information across the channels of a group; the head then predicts
+    the G channels of a group at once. For Elekta MEG, G=3 groups the two gradiometers and
+    the magnetometer of each sensor location.
+    """
     def __init__(self, config, args):
         super().__init__()
         self.args = args
         self.num_channels = args.num_channels
         self.quant_levels = args.gpt2_config.vocab_size
         self.out_times = 1
+        # tokens per GPT2 call, None runs all the (batch, channel) sequences in one fused pass
+        self.max_chunk_tokens = getattr(args.gpt2_config, 'max_chunk_tokens', None)
+        # channels sharing a single GPT2 token, 1 processes every channel independently
+        self.channel_group_size = getattr(args.gpt2_config, 'channel_group_size', 1)
+        if self.num_channels % self.channel_group_size != 0:
+            raise ValueError(
+                f"num_channels={self.num_channels} is not divisible by channel_group_size={self.channel_group_size}"
+            )
         
         # Core components
         self.gpt2 = GPT2Model(args.gpt2_config)
+        # tokens are embedded by MatrixEmbeddings, GPT2's own token embedding never gets gradients,
+        # which DistributedDataParallel would otherwise wait for
+        self.gpt2.wte.requires_grad_(False)
         self.embeddings = MatrixEmbeddings(args)
-        self.head = OutputHead(args.gpt2_config, self.num_channels, self.out_times)
+        self.head = OutputHead(args.gpt2_config, self.num_channels, self.out_times, self.channel_group_size)
+        if self.channel_group_size > 1:
+            n_embd = args.gpt2_config.n_embd
+            self.group_projection = Linear(self.channel_group_size * n_embd, n_embd)
         
         # Loss functions
         self.criterion = CrossEntropyLoss()
     
-    @torch.no_grad()
+    def _chunk_size(self, num_sequences, seq_len):
+        """Number of sequences per GPT2 call fitting the `max_chunk_tokens` budget."""
+        if self.max_chunk_tokens is None:
+            return num_sequences
+        return max(1, self.max_chunk_tokens // seq_len)
+
+    def _to_sequences(self, tokens):
+        """Embeds B x C x T tokens into the (B*C/G) x T x E sequences processed by GPT2."""
+        x = self.embeddings(tokens)
+        batch_size, channels, seq_len, emb_dim = x.shape
+        group_size = self.channel_group_size
+
+        if group_size == 1:
+            return x.reshape(batch_size * channels, seq_len, emb_dim)
+
+        # B x C/G x G x T x E -> (B*C/G) x T x (G*E), projected back to E
+        x = x.reshape(batch_size, channels // group_size, group_size, seq_len, emb_dim)
+        x = x.transpose(2, 3).reshape(batch_size * channels // group_size, seq_len, group_size * emb_dim)
+        return self.group_projection(x)
+
+    def _from_sequences(self, logits, batch_size):
+        """Reshapes (B*C/G) x T x (G*V) logits back to B x C x T x V."""
+        num_sequences, seq_len, _ = logits.shape
+        group_size = self.channel_group_size
+        logits = logits.reshape(batch_size, num_sequences // batch_size, seq_len, group_size, self.quant_levels)
+        return logits.transpose(2, 3).reshape(batch_size, -1, seq_len, self.quant_levels)
+
+    def embed_groups(self, tokens, group_ids):
+        """
+        Embeds N x T x G tokens of arbitrary channel groups, e.g. rows coming from requests
+        with different channel counts, into N x T x E GPT2 sequences.
+        """
+        group_size = self.channel_group_size
+        channel_ids = group_ids[:, None] * group_size + torch.arange(group_size, device=tokens.device)
+
+        x = self.embeddings.token_embedding(tokens)  # N x T x G x E
+        x = x + self.embeddings.channel_embedding(channel_ids)[:, None]
+        x = x.reshape(*tokens.shape[:2], -1)
+
+        if group_size == 1:
+            return x
+        return self.group_projection(x)
+
+    def group_logits(self, hidden):
+        """Next-token logits N x G x V of the last position of N x T x E hidden states."""
+        return self.head(hidden)[:, -1].reshape(hidden.shape[0], self.channel_group_size, self.quant_levels)
+
     def forward(self, data):
-        x = data['inputs']  # B x C x T
-        
-        # Get embeddings
-        x = self.embeddings(
-            x, 
-            range(self.num_channels)
-        )
+        batch_size, _, seq_len = data['inputs'].shape  # B x C x T
         
-        # Reshape to process with GPT2
-        batch_size, channels, seq_len, emb_dim = x.shape
-        x = x.reshape(batch_size * channels, seq_len, emb_dim)
+        # Get embeddings, reshaped to process with GPT2
+        x = self._to_sequences(data['inputs'])
         
-        # Process in chunks of 100 batches
-        chunk_size = 100
+        # Process in chunks of `chunk_size` sequences, a single chunk when memory allows
+        chunk_size = self._chunk_size(x.shape[0], seq_len)
         all_logits = []
         
         for i in range(0, x.shape[0], chunk_size):
@@ -99,7 +158,7 @@ class MatrixGPT2(Module):
             chunk = x[i:i + chunk_size]
             
             # GPT2 forward pass for chunk
-            chunk_outputs = self.gpt2(inputs_embeds=chunk)
+            chunk_outputs = self.gpt2(inputs_embeds=chunk, use_cache=False)
             
             # Get logits from LM head
             chunk_logits = self.head(chunk_outputs[0])
@@ -107,31 +166,95 @@ class MatrixGPT2(Module):
             all_logits.append(chunk_logits)
         
         # Concatenate all chunks
-        logits = torch.cat(all_logits, dim=0)
+        logits = torch.cat(all_logits, dim=0) if len(all_logits) > 1 else all_logits[0]
         
         # Reshape output
-        logits = logits.reshape(batch_size, channels, logits.shape[1], -1)
-        
-        return logits
+        return self._from_sequences(logits, batch_size)
+
+    @torch.inference_mode()
+    def predict(self, data):
+        """Inference-only forward pass, without autograd tracking."""
+        return self.forward(data)
+
+    def _run_gpt2(self, x, chunk_size, past_key_values=None):
+        """
+        Runs the flattened (B*C/G) x T x E embeddings through GPT2 in chunks of `chunk_size`
+        sequences, returning the next-token logits and the per-chunk key/value caches.
+        """
+        chunk_logits = []
+        presents = []
 
-    def generate(self, input_ids, max_length, condition=None):
+        for chunk_idx, i in enumerate(range(0, x.shape[0], chunk_size)):
+            outputs = self.gpt2(
+                inputs_embeds=x[i:i + chunk_size],
+                past_key_values=None if past_key_values is None else past_key_values[chunk_idx],
+                use_cache=True
+            )
+            chunk_logits.append(self.head(outputs.last_hidden_state)[:, -1:, :])
+            presents.append(outputs.past_key_values)
+
+        return torch.cat(chunk_logits, dim=0), presents
+
+    def generate(self, input_ids, max_length, condition=None, use_cache=True, on_token=None):
+        """
+        Greedily generates `max_length` new tokens per channel, returning B x C x (T + max_length).
+        With `use_cache`, the prompt is processed once and every following step only embeds
+        and runs the newest timestep against the per-channel `past_key_values`.
+        `on_token(step, tokens)` is called with the B x C tokens of every step as soon as they
+        are generated.
+        """
         self.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
+            if not use_cache:
+                return self._generate_full(input_ids, max_length, condition, on_token)
+
             batch_size, channels, seq_len = input_ids.shape
-            curr_ids = input_ids
-            
-            for _ in range(max_length):
-                # Forward pass
-                outputs = self.forward({
-                    'inputs': curr_ids,
-                    'condition': condition
-                })
-                
-                # Sample next token for each channel
-                next_token_logits = outputs[:, :, -1, :]
+            output_ids = input_ids.new_empty(batch_size, channels, seq_len + max_length)
+            output_ids[:, :, :seq_len] = input_ids
+
+            # the chunking is fixed upfront, so that each chunk keeps its own caches
+            num_sequences = batch_size * channels // self.channel_group_size
+            chunk_size = self._chunk_size(num_sequences, seq_len + max_length)
+
+            # Prefill: process the whole prompt once, keeping the key/value caches
+            x = self._to_sequences(input_ids)
+            next_token_logits, past_key_values = self._run_gpt2(x, chunk_size)
+
+            for step in range(max_length):
+                next_token_logits = self._from_sequences(next_token_logits, batch_size)[:, :, -1, :]
                 next_tokens = torch.argmax(next_token_logits, dim=-1)
-                
-                # Append to sequence
-                curr_ids = torch.cat([curr_ids, next_tokens.unsqueeze(-1)], dim=-1)
-                
-            return curr_ids
\ No newline at end of file
+                output_ids[:, :, seq_len + step] = next_tokens
+                if on_token is not None:
+                    on_token(step, next_tokens)
+
+                if step == max_length - 1:
+                    break
+
+                # Decode: only the newest timestep goes through the model
+                x = self._to_sequences(next_tokens.unsqueeze(-1))
+                next_token_logits, past_key_values = self._run_gpt2(x, chunk_size, past_key_values)
+
+            return output_ids
+
+    def _generate_full(self, input_ids, max_length, condition=None, on_token=None):
+        """Reference greedy decoding, re-running the full forward on the growing sequence."""
+        batch_size, channels, seq_len = input_ids.shape
+        curr_ids = input_ids
+        
+        for step in range(max_length):
+            # Forward pass
+            outputs = self.predict({
+                'inputs': curr_ids,
+                'condition': condition
+            })
+            
+            # Sample next token for each channel
+            next_token_logits = outputs[:, :, -1, :]
+            next_tokens = torch.argmax(next_token_logits, dim=-1)
+            if on_token is not None:
+                on_token(step, next_tokens)
+            
+            # Append to sequence
+            curr_ids = torch.cat([curr_ids, next_tokens.unsqueeze(-1)], dim=-1)
+            
+        return curr_ids
@@ -0,0 +1,27 @@
+"""Mixed-precision and compilation helpers for the MEG-GPT training loop."""
+
+import torch
+
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def autocast(precision: str, device: torch.device):
+    """Autocast context for `precision`, a no-op in fp32."""
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=dtype is not None)
+
+
+def grad_scaler(precision: str, device: torch.device) -> torch.amp.GradScaler:
+    """Gradient scaler, only enabled in fp16 where small gradients would underflow."""
+    return torch.amp.GradScaler(device.type, enabled=precision == 'fp16')
+
+
+def maybe_compile(model: torch.nn.Module, enabled: bool) -> torch.nn.Module:
+    """Wraps `model` with `torch.compile` when `enabled`."""
+    if not enabled:
+        return model
+    return torch.compile(model)
@@ -0,0 +1,46 @@
+"""
+MEGWaves over a small corpus directory laid out the way `build_corpus.py` writes it:
+
+    python -m pytest model/meg/test_cichy_dataset.py
+"""
+
+import os
+import sys
+import json
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from cichy_dataset import CichyDataset, MEGWaves
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    # two recordings of 30 and 12 samples over 4 channels in a single shard
+    tokens = np.arange(4 * 42, dtype=np.uint8).reshape(4, 42)
+    np.save(tmp_path / "shard_00000.npy", tokens)
+    index = {"num_channels": 4, "num_tokens": 255, "shards": ["shard_00000.npy"], "recordings": [
+        {"source": "a.fif", "shard": 0, "offset": 0, "length": 30},
+        {"source": "b.fif", "shard": 0, "offset": 30, "length": 12},
+    ]}
+    with open(tmp_path / "index.json", "w") as f:
+        json.dump(index, f)
+    return str(tmp_path)
+
+
+def test_corpus_samples_are_windows_of_a_recording(corpus):
+    dataset = CichyDataset(corpus, window=10)
+    # 3 + 1 non-overlapping windows
+    assert len(dataset) == 4
+    for index in range(len(dataset)):
+        sample = dataset.dataset[index]
+        start = int(sample[0, 0])
+        assert sample.shape == (4, 10)
+        assert start + 10 <= 30 if index < 3 else 30 <= start <= 32
+
+
+def test_corpus_requires_a_window_that_fits(corpus):
+    with pytest.raises(ValueError, match="a window length is needed"):
+        MEGWaves(corpus)
+    with pytest.raises(ValueError, match="the longest has 30"):
+        MEGWaves(corpus, window=31)
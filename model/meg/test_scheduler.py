@@ -0,0 +1,59 @@
+"""
+Continuous batching of MatrixGPT2 requests against `MatrixGPT2.generate` run on each request
+alone, on a tiny randomly initialised GPT2:
+
+    python -m pytest model/meg/test_scheduler.py
+"""
+
+import os
+import sys
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from scheduler import GenerationScheduler, MatrixGPT2Backend
+from test_meg_gpt import build_model
+
+
+def reference(model, input_ids, max_new_tokens):
+    """`generate` on a single request; channel groups are independent sequences, so a request
+    with fewer channels is padded with arbitrary ones, dropped from the output."""
+    channels = input_ids.shape[0]
+    padded = torch.cat([input_ids, torch.zeros(model.num_channels - channels, input_ids.shape[1], dtype=torch.long)])
+    return model.generate(padded[None], max_length=max_new_tokens)[0, :channels]
+
+
+@pytest.mark.parametrize("group_size", [1, 3])
+def test_mixed_requests_match_generate(group_size):
+    model = build_model(num_channels=6, group_size=group_size)
+    generator = torch.Generator().manual_seed(0)
+    # (channels, prompt length, new tokens) of every request
+    requests = {"a": (3, 5, 6), "b": (6, 8, 2), "c": (6, 3, 4)}
+    inputs = {name: torch.randint(0, 16, (channels, length), generator=generator)
+              for name, (channels, length, _) in requests.items()}
+
+    # a and b fill the batch, c waits for b to retire and joins while a is running
+    scheduler = GenerationScheduler(MatrixGPT2Backend(model), max_rows=9 // group_size)
+    emitted = []
+    futures = {
+        name: scheduler.submit(inputs[name], max_new_tokens=max_new_tokens,
+                               on_token=lambda step, tokens, name=name: emitted.append((name, step, tokens)))
+        for name, (_, _, max_new_tokens) in requests.items()
+    }
+    with scheduler:
+        outputs = {name: future.result(timeout=60) for name, future in futures.items()}
+
+    for name, (_, length, max_new_tokens) in requests.items():
+        expected = reference(model, inputs[name], max_new_tokens)
+        assert torch.equal(outputs[name], expected)
+
+        steps = [(step, tokens) for emitter, step, tokens in emitted if emitter == name]
+        assert [step for step, _ in steps] == list(range(max_new_tokens))
+        assert all(torch.equal(tokens, expected[:, length + step]) for step, tokens in steps)
+
+    order = [name for name, _, _ in emitted]
+    last = lambda name: len(order) - 1 - order[::-1].index(name)
+    assert last("b") < order.index("c") < last("a")
+    # every request is retired once done
+    assert not scheduler.active and not scheduler.pending
@@ -1,49 +1,73 @@
 import os
+import sys
 import wandb
 import torch
 import numpy as np
 from torch.optim import AdamW
 from meg_gpt import MatrixGPT2
 from config_parser import Config
-from huggingface_hub import HfApi
+from precision import autocast, grad_scaler, maybe_compile
 from cichy_dataset import CichyDataset
+from contextlib import nullcontext
 from transformers import PreTrainedModel
-from torch.nn.parallel import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 
-# Add this helper function at the top level
-def get_device():
-    """Get the device to use for training."""
-    if torch.cuda.is_available():
-        return torch.device('cuda')
-    return torch.device('cpu')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from checkpointing import CheckpointManager, HubSink, unwrap_model
+from memory import enable_activation_checkpointing, find_micro_batch_size, accumulation_steps_for, accumulation_group_size
+import instrumentation
+import distributed
 
-def train_epoch(model, dataloader, optimizer, args, device):
+def compute_loss(model, batch, args):
+    """Loss of predicting the last `out_times` timesteps of every channel from the ones before."""
+    out_times = unwrap_model(model).out_times
+    inputs, targets = batch[:, :, :-out_times], batch[:, :, -out_times:]
+    logits = model({
+        'inputs': inputs,
+    })
+    return unwrap_model(model).criterion(
+        logits.reshape(-1, args.gpt2_config.vocab_size),
+        targets.reshape(-1)
+    ).mean()
+
+def train_epoch(model, dataloader, optimizer, args, device, scaler=None, accumulation_steps=1):
+    """
+    One epoch over `dataloader`, whose batches are micro-batches: gradients are accumulated over
+    `accumulation_steps` of them before every optimizer step. Returns the mean loss over the
+    batches of every rank.
+    """
     model.train()
     total_loss = 0
     num_batches = 0
+    scaler = scaler or grad_scaler(args.precision, device)
+    optimizer.zero_grad()
     
-    for batch in dataloader:
+    for batch in instrumentation.timed_iter(dataloader):
         # Move data to appropriate device
-        inputs = batch.to(device)
-        targets = inputs[:, 1:]
-            
-        logits = model({
-            'inputs': inputs,
-        })
-        
-        loss = model.criterion(
-            logits.reshape(-1, args.gpt2_config.vocab_size),
-            targets.reshape(-1)
-        ).mean()
+        batch = batch.to(device)
+        num_batches += 1
+        # the last step of the epoch may accumulate fewer micro-batches
+        optimizer_step = num_batches % accumulation_steps == 0 or num_batches == len(dataloader)
+
+        # DistributedDataParallel only needs to all-reduce the gradients before an optimizer step
+        no_sync = model.no_sync if isinstance(model, DistributedDataParallel) and not optimizer_step else nullcontext
+        with no_sync():
+            with instrumentation.span("forward"), autocast(args.precision, device):
+                loss = compute_loss(model, batch, args)
             
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+            with instrumentation.span("backward"):
+                group_size = accumulation_group_size(num_batches - 1, len(dataloader), accumulation_steps)
+                scaler.scale(loss / group_size).backward()
             
         total_loss += loss.item()
-        num_batches += 1
+        if optimizer_step:
+            with instrumentation.span("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+            instrumentation.step()
         
-    return total_loss / num_batches
+    return distributed.reduce_mean(total_loss, num_batches)
 
 def validate(model, dataloader, args, device):
     model.eval()
@@ -52,63 +76,109 @@ def validate(model, dataloader, args, device):
     
     with torch.no_grad():
         for batch in dataloader:
-            inputs = batch['inputs'].to(device)
-            targets = batch['targets'].to(device) if 'targets' in batch else inputs
-            condition = batch.get('condition', None)
-            if condition is not None:
-                condition = condition.to(device)
+            batch = batch.to(device)
                 
-            logits = model({
-                'inputs': inputs,
-                'condition': condition
-            })
-            
-            loss = model.criterion(
-                logits.reshape(-1, args.gpt2_config.vocab_size),
-                targets.reshape(-1)
-            ).mean()
+            with autocast(args.precision, device):
+                loss = compute_loss(model, batch, args)
             
             total_loss += loss.item()
             num_batches += 1
             
-    return total_loss / num_batches
+    return distributed.reduce_mean(total_loss, num_batches)
 
 def main(args):
-    # Get device
-    device = get_device()
-    print(f"Using device: {device}")
+    # Joins the process group when launched with torchrun, one process per device
+    device = distributed.setup()
+    print(f"Using device: {device}, rank {distributed.rank()} of {distributed.world_size()}")
+    if args.trace_path or args.profile_steps:
+        instrumentation.configure(args.trace_path, profile_steps=args.profile_steps)
     
     # Initialize model and move to device
     model = MatrixGPT2(args.gpt2_config, args).to(device)
+    if args.gradient_checkpointing:
+        enable_activation_checkpointing(model)
     
-    # Use DataParallel if multiple GPUs are available
-    if torch.cuda.device_count() > 1 and device.type == 'cuda':
-        model = DataParallel(model)
-        print(f"Using {torch.cuda.device_count()} GPUs!")
-    
-    # Load dataset
-    dataset = CichyDataset()
-    train_loader = dataset.train_dataloader(batch_size=8)
-    val_loader = dataset.val_dataloader()
+    # Load dataset, corpus samples are cropped to the inputs GPT2 takes and the predicted timesteps
+    window = args.window or args.gpt2_config.n_positions + model.out_times
+    dataset = CichyDataset(args.data_path, window=window)
+
+    # micro-batches are accumulated into batches of `batch_size` samples per optimizer step
+    micro_batch_size = args.micro_batch_size or args.batch_size
+    if args.memory_budget_mb is not None:
+        sample = torch.as_tensor(np.asarray(dataset.dataset[0]), dtype=torch.long, device=device)
+
+        def step(size):
+            with autocast(args.precision, device):
+                loss = compute_loss(model, sample.expand(size, *sample.shape), args)
+            loss.backward()
+
+        micro_batch_size = find_micro_batch_size(model, step, args.memory_budget_mb, args.batch_size, device)
+        # every rank has to accumulate the same number of micro-batches per optimizer step
+        micro_batch_size = distributed.reduce_min(micro_batch_size)
+    accumulation_steps = accumulation_steps_for(args.batch_size, micro_batch_size)
+    print(f"Micro-batches of {micro_batch_size}, {accumulation_steps} accumulated per optimizer step")
+
+    # every rank trains and validates on its own shard, `batch_size` is per rank
+    train_loader = dataset.train_dataloader(batch_size=micro_batch_size, distributed=distributed.is_distributed())
+    val_loader = dataset.val_dataloader(batch_size=micro_batch_size, distributed=distributed.is_distributed())
+
+    model = maybe_compile(model, args.compile)
+    model = distributed.wrap_model(model, device)
     
     optimizer = AdamW(model.parameters(), lr=args.learning_rate)
+    scaler = grad_scaler(args.precision, device)
+
+    # checkpoints are written, and the best one pushed to the hub, in the background by rank 0,
+    # while every rank resumes from them
+    checkpoints = CheckpointManager(
+        args.result_dir,
+        keep_last=args.keep_last,
+        sink=HubSink(f"{args.hub_user}/{args.model_name}") if args.push_to_hub and distributed.is_main_process() else None,
+    )
+
+    start_epoch = 0
+    checkpoint = checkpoints.load_latest(map_location=device)
+    if checkpoint is not None:
+        unwrap_model(model).load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if checkpoint['scaler_state_dict']:  # empty when the scaler is disabled
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        start_epoch = checkpoint['epoch'] + 1
+        print(f"Resuming from epoch {start_epoch}")
     
-    best_val_loss = float('inf')
-    for epoch in range(args.epochs):
-        # Train and validate with device
-        train_loss = train_epoch(model, train_loader, optimizer, args, device)
+    for epoch in range(start_epoch, args.epochs):
+        distributed.set_epoch(train_loader, epoch)
+        # Train and validate with device, the losses are averaged over the ranks
+        train_loss = train_epoch(model, train_loader, optimizer, args, device, scaler, accumulation_steps)
         
-        # Rest of the training loop remains the same
-        wandb.log({
-            "train/loss": train_loss,
-            "epoch": epoch,
-        })
+        if distributed.is_main_process():
+            wandb.log({
+                "train/loss": train_loss,
+                "epoch": epoch,
+            })
         
         if epoch % args.val_freq == 0:
             val_loss = validate(model, val_loader, args, device)
-            # Rest of the validation code remains the same...
+            if not distributed.is_main_process():
+                continue
+            wandb.log({"val/loss": val_loss, "epoch": epoch})
+
+            checkpoints.save({
+                'epoch': epoch,
+                'model_state_dict': unwrap_model(model).state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'scaler_state_dict': scaler.state_dict(),
+                'val_loss': val_loss,
+                'train_loss': train_loss,
+            }, step=epoch + 1, metric=val_loss)
     
-    wandb.finish()
+    checkpoints.close()
+    if args.trace_path or args.profile_steps:
+        instrumentation.close()
+        instrumentation.print_summary()
+    if distributed.is_main_process():
+        wandb.finish()
+    distributed.cleanup()
 
 if __name__ == '__main__':
     import argparse
@@ -0,0 +1,131 @@
+"""
+Memory helpers for training with long sequences: activation checkpointing of the transformer
+backbones, gradient accumulation, and a search for the largest micro-batch fitting a memory budget.
+
+    enable_activation_checkpointing(model)
+    micro_batch_size = find_micro_batch_size(model, step, budget_mb=20_000, max_batch_size=64, device=device)
+    accumulation_steps = accumulation_steps_for(64, micro_batch_size)
+"""
+
+import math
+import torch
+from typing import Callable
+from transformers import PreTrainedModel
+
+
+def enable_activation_checkpointing(model: torch.nn.Module) -> int:
+    """
+    Enables gradient checkpointing in every Hugging Face backbone of `model` (the GPT2 blocks of
+    MatrixGPT2 and WavesTransformer, the ViT encoder of EEGViT): the activations of each block
+    are recomputed in the backward pass instead of being kept from the forward one. Returns the
+    number of backbones it was enabled in.
+    """
+    enabled = 0
+    for module in model.modules():
+        # enabling it in a backbone also enables it in the backbones it wraps, e.g. ViTForImageClassification.vit
+        if (isinstance(module, PreTrainedModel) and module.supports_gradient_checkpointing
+                and not module.is_gradient_checkpointing):
+            module.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+            enabled += 1
+    return enabled
+
+
+def accumulation_steps_for(batch_size: int, micro_batch_size: int) -> int:
+    """Micro-batches accumulated per optimizer step for an effective batch of `batch_size`."""
+    return max(1, math.ceil(batch_size / micro_batch_size))
+
+
+def accumulation_group_size(batch_idx: int, num_batches: int, accumulation_steps: int) -> int:
+    """
+    Micro-batches in the accumulation group of batch `batch_idx` (counted from 0) out of the
+    `num_batches` of an epoch: `accumulation_steps`, or fewer for the last group when they do
+    not divide the epoch. Losses are divided by it, for every group to average its micro-batches.
+    """
+    group_start = batch_idx - batch_idx % accumulation_steps
+    return min(accumulation_steps, num_batches - group_start)
+
+
+def _is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error)
+
+
+def step_memory_mb(model: torch.nn.Module,
+                   step: Callable[[int], None],
+                   micro_batch_size: int,
+                   device: torch.device) -> float:
+    """
+    Peak memory of `step(micro_batch_size)`, a forward and backward pass of `model`. On CUDA it
+    is the peak allocated memory. Elsewhere it is estimated as the parameters and their
+    gradients plus the tensors saved for the backward pass, which is what grows with the
+    micro-batch. The gradients of the step are dropped afterwards.
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            step(micro_batch_size)
+            torch.cuda.synchronize(device)
+            return torch.cuda.max_memory_allocated(device) / 2**20
+        finally:
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+
+    saved, storages = [0], set()
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in storages:
+            storages.add(storage.data_ptr())
+            saved[0] += storage.nbytes()
+        return tensor
+
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            step(micro_batch_size)
+    finally:
+        model.zero_grad(set_to_none=True)
+
+    parameters = sum(2 * p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+    return (saved[0] + parameters) / 2**20
+
+
+def find_micro_batch_size(model: torch.nn.Module,
+                          step: Callable[[int], None],
+                          budget_mb: float,
+                          max_batch_size: int,
+                          device: torch.device) -> int:
+    """
+    Largest micro-batch size, up to `max_batch_size`, whose `step` of `model` fits in `budget_mb`.
+    The size is doubled until the step runs out of memory or exceeds the budget, then binary
+    searched between the last size that fit and the first one that did not. Leave headroom in
+    the budget for the optimizer state, which the step does not allocate.
+    """
+    def fits(micro_batch_size):
+        try:
+            memory = step_memory_mb(model, step, micro_batch_size, device)
+        except RuntimeError as error:
+            if not _is_out_of_memory(error):
+                raise
+            memory = math.inf
+        print(f"micro-batch {micro_batch_size}: {memory:.0f} MB of {budget_mb:.0f} MB")
+        return memory <= budget_mb
+
+    if not fits(1):
+        raise RuntimeError(f"A micro-batch of 1 does not fit in {budget_mb} MB, enable activation checkpointing "
+                           f"or use shorter sequences")
+
+    low, high = 1, None  # largest size that fits, smallest one that does not
+    while high is None and low < max_batch_size:
+        candidate = min(2 * low, max_batch_size)
+        if fits(candidate):
+            low = candidate
+        else:
+            high = candidate
+
+    while high is not None and high - low > 1:
+        candidate = (low + high) // 2
+        if fits(candidate):
+            low = candidate
+        else:
+            high = candidate
+    return low
@@ -0,0 +1,314 @@
+"""
+Continuous-batching scheduler for autoregressive MEG generation.
+
+Generation requests of different lengths and channel counts are packed into shared forward
+passes: every request contributes rows to a single batch (the channel groups of a
+`MatrixGPT2` request, the window of a `WavesTransformer` request), whose key/value caches
+are left-padded to a common length and masked. New requests are admitted at every step,
+as soon as there is room for their rows, and finished ones are retired right away, so the
+batch stays full as long as there is work. Results are returned through futures, or
+streamed step by step through async iterators.
+"""
+
+import asyncio
+import threading
+import collections
+import torch
+import torch.nn.functional as F
+from concurrent.futures import Future
+from typing import AsyncIterator, Callable, Optional
+
+
+def _legacy(past_key_values):
+    """Per-layer (key, value) tuples, whatever the cache class returned by the model."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _pad_left(past_key_values, attention_mask, length):
+    padding = length - attention_mask.shape[1]
+    if padding == 0:
+        return past_key_values, attention_mask
+    past_key_values = tuple(
+        tuple(F.pad(tensor, (0, 0, padding, 0)) for tensor in layer) for layer in past_key_values
+    )
+    return past_key_values, F.pad(attention_mask, (padding, 0))
+
+
+def _concat(past_key_values, attention_mask, other_past_key_values, other_attention_mask):
+    """Stacks the rows of two caches, left-padding the shorter one."""
+    length = max(attention_mask.shape[1], other_attention_mask.shape[1])
+    past_key_values, attention_mask = _pad_left(past_key_values, attention_mask, length)
+    other_past_key_values, other_attention_mask = _pad_left(other_past_key_values, other_attention_mask, length)
+
+    past_key_values = tuple(
+        tuple(torch.cat([tensor, other]) for tensor, other in zip(layer, other_layer))
+        for layer, other_layer in zip(past_key_values, other_past_key_values)
+    )
+    return past_key_values, torch.cat([attention_mask, other_attention_mask])
+
+
+def _select(past_key_values, attention_mask, rows):
+    """Keeps `rows` of a cache, dropping the leading positions none of them attends to."""
+    attention_mask = attention_mask[rows]
+    first = int(attention_mask.any(dim=0).int().argmax())
+    past_key_values = tuple(
+        tuple(tensor[rows, :, first:] for tensor in layer) for layer in past_key_values
+    )
+    return past_key_values, attention_mask[:, first:]
+
+
+class MatrixGPT2Backend:
+    """
+    Serves `MatrixGPT2` requests, whose inputs are C x T token matrices. Each channel group
+    of a request is a row of the shared batch, and requests can have any number of channels
+    up to the model's, as long as it is a multiple of its `channel_group_size`.
+    """
+
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def num_rows(self, request):
+        return request.inputs.shape[0] // self.model.channel_group_size
+
+    def prefill(self, request):
+        input_ids = request.inputs
+        channels, seq_len = input_ids.shape
+        group_size = self.model.channel_group_size
+
+        tokens = input_ids.reshape(channels // group_size, group_size, seq_len).transpose(1, 2)  # N x T x G
+        group_ids = torch.arange(channels // group_size, device=input_ids.device)
+        outputs = self.model.gpt2(inputs_embeds=self.model.embed_groups(tokens, group_ids), use_cache=True)
+
+        request.output = input_ids.new_empty(channels, seq_len + request.max_new_tokens)
+        request.output[:, :seq_len] = input_ids
+        request.prompt_len = seq_len
+
+        attention_mask = torch.ones(tokens.shape[:2], dtype=torch.long, device=input_ids.device)
+        logits = self.model.group_logits(outputs.last_hidden_state)
+        return logits, _legacy(outputs.past_key_values), attention_mask, group_ids
+
+    def step(self, tokens, row_ids, past_key_values, attention_mask, position_ids):
+        outputs = self.model.gpt2(
+            inputs_embeds=self.model.embed_groups(tokens[:, None, :], row_ids),
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True
+        )
+        return self.model.group_logits(outputs.last_hidden_state), _legacy(outputs.past_key_values)
+
+    def write(self, request, step, tokens):
+        request.output[:, request.prompt_len + step] = tokens.reshape(-1)
+
+
+class WavesTransformerBackend:
+    """
+    Serves `WavesTransformer` requests, whose inputs are (EEG window, T MEG prompt tokens).
+    The decoder must support caching, see `EEGConditionedDecoder`.
+    """
+
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def num_rows(self, request):
+        return 1
+
+    def prefill(self, request):
+        eeg_tokens, meg_tokens = request.inputs
+        eeg_states = self.model.encode(eeg_tokens.unsqueeze(0))
+        attention_mask = torch.ones(1, meg_tokens.shape[0], dtype=torch.long, device=meg_tokens.device)
+        logits, past_key_values, attention_mask = self.model.decoder.prefill(
+            eeg_states, meg_tokens.unsqueeze(0), attention_mask
+        )
+
+        request.output = meg_tokens.new_empty(meg_tokens.shape[0] + request.max_new_tokens)
+        request.output[:meg_tokens.shape[0]] = meg_tokens
+        request.prompt_len = meg_tokens.shape[0]
+
+        row_ids = torch.zeros(1, dtype=torch.long, device=meg_tokens.device)
+        return logits.unsqueeze(1), _legacy(past_key_values), attention_mask, row_ids
+
+    def step(self, tokens, row_ids, past_key_values, attention_mask, position_ids):
+        logits, past_key_values = self.model.decoder.step(tokens, past_key_values, attention_mask, position_ids)
+        return logits.unsqueeze(1), _legacy(past_key_values)
+
+    def write(self, request, step, tokens):
+        request.output[request.prompt_len + step] = tokens.reshape(())
+
+
+class _Request:
+    def __init__(self, inputs, max_new_tokens: int, on_token: Optional[Callable] = None):
+        self.inputs = inputs
+        self.max_new_tokens = max_new_tokens
+        self.on_token = on_token
+        self.future = Future()
+        self.generated = 0
+        self.output = None
+
+
+class GenerationScheduler:
+    """
+    Runs greedy generation for many concurrent requests on a background thread, packing up
+    to `max_rows` rows into every forward pass. Use it as a context manager, or call `start`
+    and `stop` explicitly.
+    """
+
+    def __init__(self, backend, max_rows: int = 512):
+        self.backend = backend
+        self.max_rows = max_rows
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # state of the shared batch, rows are laid out in the order of `active`
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.row_ids = None
+        self.logits = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+        for request in list(self.pending) + self.active:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("GenerationScheduler was stopped"))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def submit(self, *inputs, max_new_tokens: int, on_token: Optional[Callable] = None) -> Future:
+        """
+        Queues a request, returning a future resolving to the prompt followed by the generated
+        tokens. `on_token(step, tokens)` is called from the scheduler thread with the tokens of
+        every step, as in `MatrixGPT2.generate`.
+        """
+        request = _Request(inputs[0] if len(inputs) == 1 else inputs, max_new_tokens, on_token)
+        if max_new_tokens == 0:
+            request.future.set_result(request.inputs if len(inputs) == 1 else inputs[-1])
+            return request.future
+
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        return request.future
+
+    async def agenerate(self, *inputs, max_new_tokens: int) -> torch.Tensor:
+        """Async counterpart of `submit`."""
+        return await asyncio.wrap_future(self.submit(*inputs, max_new_tokens=max_new_tokens))
+
+    async def stream(self, *inputs, max_new_tokens: int) -> AsyncIterator[torch.Tensor]:
+        """Yields the tokens generated at each step of a request, as soon as they are available."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        future = self.submit(
+            *inputs,
+            max_new_tokens=max_new_tokens,
+            on_token=lambda step, tokens: loop.call_soon_threadsafe(queue.put_nowait, tokens)
+        )
+        # queued after the last step's tokens, ending the iteration
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, None))
+
+        while (tokens := await queue.get()) is not None:
+            yield tokens
+        future.result()  # raises if the request failed
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending and not self.active:
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+            with torch.inference_mode():
+                self._admit()
+                if self.active:
+                    try:
+                        self._step()
+                    except Exception as error:
+                        for request in self.active:
+                            request.future.set_exception(error)
+                        self.active, self.logits = [], None
+
+    def _admit(self):
+        """Prefills pending requests while their rows fit in the batch, merging them into it."""
+        num_rows = sum(request.num_rows for request in self.active)
+        while True:
+            with self.condition:
+                if not self.pending:
+                    return
+                request = self.pending[0]
+                request.num_rows = self.backend.num_rows(request)
+                if self.active and num_rows + request.num_rows > self.max_rows:
+                    return
+                self.pending.popleft()
+
+            try:
+                logits, past_key_values, attention_mask, row_ids = self.backend.prefill(request)
+            except Exception as error:
+                request.future.set_exception(error)
+                continue
+
+            if not self.active:
+                self.logits, self.past_key_values = logits, past_key_values
+                self.attention_mask, self.row_ids = attention_mask, row_ids
+            else:
+                self.past_key_values, self.attention_mask = _concat(
+                    self.past_key_values, self.attention_mask, past_key_values, attention_mask
+                )
+                self.logits = torch.cat([self.logits, logits])
+                self.row_ids = torch.cat([self.row_ids, row_ids])
+            self.active.append(request)
+            num_rows += request.num_rows
+
+    def _step(self):
+        """Emits one token per active row, retires finished requests and runs the next step."""
+        tokens = torch.argmax(self.logits, dim=-1)  # N x tokens per row
+
+        keep, still_active, start = [], [], 0
+        for request in self.active:
+            rows = slice(start, start + request.num_rows)
+            self.backend.write(request, request.generated, tokens[rows])
+            if request.on_token is not None:
+                request.on_token(request.generated, tokens[rows].reshape(-1).clone())
+            request.generated += 1
+
+            if request.generated == request.max_new_tokens:
+                request.future.set_result(request.output)
+            else:
+                still_active.append(request)
+                keep.extend(range(rows.start, rows.stop))
+            start = rows.stop
+
+        self.active = still_active
+        if not self.active:
+            self.logits = None
+            return
+
+        if len(keep) < len(tokens):
+            keep = torch.tensor(keep, device=tokens.device)
+            self.past_key_values, self.attention_mask = _select(self.past_key_values, self.attention_mask, keep)
+            tokens, self.row_ids = tokens[keep], self.row_ids[keep]
+
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True) - 1
+        self.logits, self.past_key_values = self.backend.step(
+            tokens, self.row_ids, self.past_key_values, self.attention_mask, position_ids
+        )
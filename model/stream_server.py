@@ -0,0 +1,411 @@
+"""
+Streaming EEG -> MEG inference server.
+
+The served model is pluggable. The `__main__` entry point serves MEG-GPT (`MatrixGPT2`),
+which continues the stream as if its channels were MEG sensors: it is a demo of the
+streaming path, not an EEG -> MEG translation, until a trained EEG -> MEG model is served.
+
+Clients connect over a local TCP socket and send newline-delimited JSON messages, either
+a single sample in the platform's `/api/eeg-stream` format (`{"data": [{"value": v}, ...]}`)
+or a chunk of samples (`{"samples": [[c0, c1, ...], ...]}`, one row per timestep).
+Each connection is a session holding a ring buffer of its most recent samples and its own
+tokenizer, whose per-channel scale is updated with every chunk so that a session is
+tokenized consistently over time. Whenever a chunk arrives, the session is continued by as
+many samples as it sent, answered as `{"samples": [...]}`: either by a decoder of its own,
+keeping its state across chunks, or by queuing its whole tokenized context onto a shared
+micro-batcher, which packs the pending sessions into a single model call. Malformed or
+oversized messages and inference failures are answered with `{"error": ...}`, keeping the
+session open.
+
+Streams with other channels than the model, e.g. the 14 sensors of an EPOC X headset, are
+aligned onto the model channels by a `ChannelMap` (see channels.py) before being buffered;
+the responses then hold the model channels.
+"""
+
+import json
+import asyncio
+import numpy as np
+import torch
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from utils import SignalProcessor
+from channels import ChannelMap, channel_map
+
+
+class RingBuffer:
+    """Fixed-capacity (channels x capacity) buffer holding the most recent samples of a stream."""
+
+    def __init__(self, num_channels: int, capacity: int):
+        self.capacity = capacity
+        self.buffer = np.zeros((num_channels, capacity), dtype=np.float32)
+        self.position = 0  # next column to be written
+        self.filled = 0
+
+    def __len__(self):
+        return self.filled
+
+    def extend(self, samples: np.ndarray):
+        """Appends a (channels x n) chunk, overwriting the oldest samples once full."""
+        samples = samples[:, -self.capacity:]
+        n = samples.shape[1]
+
+        first = min(n, self.capacity - self.position)
+        self.buffer[:, self.position:self.position + first] = samples[:, :first]
+        self.buffer[:, :n - first] = samples[:, first:]
+
+        self.position = (self.position + n) % self.capacity
+        self.filled = min(self.filled + n, self.capacity)
+
+    def view(self) -> np.ndarray:
+        """Returns the buffered samples in chronological order, (channels x len(self))."""
+        if self.filled < self.capacity:
+            return self.buffer[:, :self.filled]
+        return np.roll(self.buffer, -self.position, axis=1)
+
+
+class MicroBatcher:
+    """
+    Collects inference requests coming from many sessions and runs them as micro-batches.
+    A batch is dispatched as soon as it holds `max_batch_size` requests or `max_delay_ms`
+    have passed since its first request arrived, which bounds the added queueing latency.
+    """
+
+    def __init__(self,
+                 predict_fn: Callable[[torch.Tensor, int], torch.Tensor],
+                 max_batch_size: int = 32,
+                 max_delay_ms: float = 5.0
+                ):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.queue = asyncio.Queue()
+        # a single worker thread owns the model, keeping the event loop responsive
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, tokens: np.ndarray, horizon: int) -> np.ndarray:
+        """Queues a (channels x T) token context, resolving to (out_channels x horizon) tokens."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tokens, horizon, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # requests can only share a forward pass when their shapes match
+            groups = {}
+            for request in batch:
+                tokens, horizon, _ = request
+                groups.setdefault((tokens.shape, horizon), []).append(request)
+
+            for (_, horizon), requests in groups.items():
+                tokens = torch.from_numpy(np.stack([request[0] for request in requests])).long()
+                try:
+                    outputs = await loop.run_in_executor(self.executor, self.predict_fn, tokens, horizon)
+                except Exception as error:
+                    for *_, future in requests:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+
+                outputs = outputs.cpu().numpy()
+                for i, (*_, future) in enumerate(requests):
+                    if not future.done():
+                        future.set_result(outputs[i])
+
+
+class StreamingServer:
+    """
+    Serves concurrent EEG streaming sessions, emitting enhanced samples for each received chunk.
+
+    Sessions are either continued by `predict_fn`, which re-runs their whole context in shared
+    micro-batches, or each by its own stateful decoder made by `decoder_factory`, see
+    `MatrixGPT2StreamDecoder`. With `max_positions`, the position budget of the model, chunks
+    are answered in pieces of at most `max_positions - context_length` samples, so that the
+    context and the generated samples always fit in it.
+    """
+
+    def __init__(self,
+                 predict_fn: Optional[Callable[[torch.Tensor, int], torch.Tensor]] = None,
+                 num_channels: int = 14,
+                 context_length: int = 256,
+                 max_batch_size: int = 32,
+                 max_delay_ms: float = 5.0,
+                 channel_map: Optional[ChannelMap] = None,
+                 decoder_factory: Optional[Callable[[], Callable[[np.ndarray, int, int], np.ndarray]]] = None,
+                 max_positions: Optional[int] = None,
+                 max_message_bytes: int = 2**24
+                ):
+        if (predict_fn is None) == (decoder_factory is None):
+            raise ValueError("Expected either predict_fn or decoder_factory")
+        if max_positions is not None and max_positions <= context_length:
+            raise ValueError(f"context_length={context_length} leaves no room to generate in {max_positions} positions")
+        self.num_channels = num_channels
+        # stream channels -> model channels, None when the model takes the stream as it is
+        self.channel_map = channel_map
+        self.model_channels = num_channels if channel_map is None else channel_map.num_targets
+        self.context_length = context_length
+        self.max_horizon = None if max_positions is None else max_positions - context_length
+        self.max_message_bytes = max_message_bytes
+        self.decoder_factory = decoder_factory
+        self.batcher = MicroBatcher(predict_fn, max_batch_size=max_batch_size, max_delay_ms=max_delay_ms)
+        self.num_sessions = 0
+
+    def _parse(self, message: dict) -> np.ndarray:
+        """Parses a client message into a (channels x n) float32 chunk."""
+        if "data" in message:
+            samples = [[channel["value"] for channel in message["data"]]]
+        else:
+            samples = message["samples"]
+
+        chunk = np.asarray(samples, dtype=np.float32).T
+        if chunk.shape[0] != self.num_channels:
+            raise ValueError(f"Expected {self.num_channels} channels, got {chunk.shape[0]}")
+        return chunk
+
+    async def _read_message(self, reader: asyncio.StreamReader) -> bytes:
+        """
+        Next newline-delimited message, b"" once the client is done. Messages longer than
+        `max_message_bytes` are skipped up to their newline and raise a ValueError.
+        """
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as error:
+            return error.partial  # a last message without newline, or b"" at the end of the stream
+        except asyncio.LimitOverrunError as error:
+            consumed = error.consumed
+
+        while True:
+            await reader.readexactly(consumed)
+            try:
+                await reader.readuntil(b"\n")
+                break
+            except asyncio.IncompleteReadError:
+                break
+            except asyncio.LimitOverrunError as error:
+                consumed = error.consumed
+        raise ValueError(f"Message longer than {self.max_message_bytes} bytes, send smaller chunks")
+
+    async def _reply(self, writer: asyncio.StreamWriter, response: dict):
+        writer.write((json.dumps(response) + "\n").encode())
+        await writer.drain()
+
+    async def _continue(self, decoder, tokens: np.ndarray, num_new: int, horizon: int) -> np.ndarray:
+        if decoder is None:
+            return await self.batcher.submit(tokens, horizon=horizon)
+        # decoders run on the thread owning the model, as the micro-batches do
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.batcher.executor, decoder, tokens, num_new, horizon)
+
+    async def handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        buffer = RingBuffer(self.model_channels, self.context_length)
+        processor = SignalProcessor()
+        decoder = self.decoder_factory() if self.decoder_factory is not None else None
+        self.num_sessions += 1
+        try:
+            while True:
+                try:
+                    line = await self._read_message(reader)
+                    if not line:
+                        break
+                    chunk = self._parse(json.loads(line))
+                    if self.channel_map is not None:
+                        chunk = self.channel_map.apply(chunk)
+                except (ValueError, KeyError, TypeError) as error:
+                    await self._reply(writer, {"error": str(error)})
+                    continue
+
+                processor.partial_fit(chunk)
+                step = self.max_horizon or chunk.shape[1]
+                outputs = []
+                try:
+                    # pieces of at most `max_horizon` samples, each continuing the context before it
+                    for start in range(0, chunk.shape[1], step):
+                        piece = chunk[:, start:start + step]
+                        buffer.extend(piece)
+                        tokens = processor.transform(buffer.view())
+                        outputs.append(await self._continue(decoder, tokens, piece.shape[1], piece.shape[1]))
+                except Exception as error:
+                    if decoder is not None:
+                        decoder.reset()
+                    await self._reply(writer, {"error": f"Inference failed: {error}"})
+                    continue
+
+                outputs = np.concatenate(outputs, axis=1)
+                await self._reply(writer, {"samples": processor.detokenize(outputs, rescale=False).T.tolist()})
+        finally:
+            self.num_sessions -= 1
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765):
+        server = await asyncio.start_server(self.handle_session, host, port, limit=self.max_message_bytes)
+        batcher = asyncio.create_task(self.batcher.run())
+        print(f"Streaming inference server listening on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def model_channel_map(stream_channels: int, model_channels: int, eeg_map=None) -> Optional[ChannelMap]:
+    """
+    Map of the `stream_channels` sent by the clients onto the `model_channels` rows the model
+    takes. `eeg_map` is a `ChannelMap` or preset name of channels.py; its target rows come
+    first and the remaining model rows stay zero, as the datasets pad the EEG rows. Without
+    it, the stream channels are fed as they are and must match the model.
+    """
+    if eeg_map is None:
+        if stream_channels != model_channels:
+            raise ValueError(f"The stream has {stream_channels} channels and the model {model_channels}, "
+                             f"a channel map is needed to align them")
+        return None
+
+    eeg_map = channel_map(eeg_map)
+    if len(eeg_map.source_index) and eeg_map.source_index.max() >= stream_channels:
+        raise ValueError(f"The channel map reads rows up to {eeg_map.source_index.max()}, "
+                         f"the stream has {stream_channels} channels")
+    if eeg_map.num_targets > model_channels:
+        raise ValueError(f"The channel map writes {eeg_map.num_targets} rows, the model takes {model_channels}")
+    return ChannelMap(eeg_map.source_index, eeg_map.target_index, model_channels)
+
+
+def matrix_gpt2_predictor(model, device: Optional[str] = None) -> Callable[[torch.Tensor, int], torch.Tensor]:
+    """Wraps a `MatrixGPT2` so that it continues each B x C x T context by `horizon` tokens."""
+    device = device or next(model.parameters()).device
+    model = model.to(device).eval()
+
+    def predict(tokens: torch.Tensor, horizon: int) -> torch.Tensor:
+        outputs = model.generate(tokens.to(device), max_length=horizon)
+        return outputs[:, :, -horizon:]
+
+    return predict
+
+
+def _crop(past_key_values, length):
+    """The first `length` positions of the key/value caches of a GPT2 call."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return tuple(tuple(tensor[:, :, :length] for tensor in layer) for layer in past_key_values)
+
+
+class MatrixGPT2StreamDecoder:
+    """
+    Continues the stream of a single session with a `MatrixGPT2`, keeping the key/value
+    caches of the tokens received so far from one chunk to the next: a chunk only runs its new
+    tokens and the generated ones, which are dropped from the caches afterwards as the next
+    chunk brings the actual samples. Once the caches would outgrow `max_positions`, they are
+    rebuilt from the session context, so the work per chunk is bounded by a prefill of the
+    context.
+
+    Tokens stay cached as they were tokenized on arrival, while `SignalProcessor` may have
+    widened its scale since; the context is re-tokenized whenever the caches are rebuilt.
+    """
+
+    def __init__(self, model, max_positions: int, device: Optional[str] = None):
+        self.model = model.eval()
+        self.max_positions = max_positions
+        self.device = device or next(model.parameters()).device
+        self.reset()
+
+    def reset(self):
+        self.past_key_values = None
+        self.length = 0  # tokens of the stream in the caches
+
+    def __call__(self, tokens: np.ndarray, num_new: int, horizon: int) -> np.ndarray:
+        """
+        Continues the (channels x T) token context, whose last `num_new` tokens arrived since
+        the previous call, by `horizon` (channels x horizon) tokens.
+        """
+        model = self.model
+        tokens = torch.from_numpy(np.asarray(tokens, dtype=np.int64)).to(self.device)
+        num_sequences = tokens.shape[0] // model.channel_group_size
+        # fixed for the session, so that every chunk of sequences keeps its own caches
+        chunk_size = model._chunk_size(num_sequences, self.max_positions)
+
+        with torch.inference_mode():
+            if self.past_key_values is None or self.length + num_new + horizon > self.max_positions:
+                self.reset()
+                new_tokens = tokens
+            else:
+                new_tokens = tokens[:, tokens.shape[1] - num_new:]
+
+            logits, past_key_values = model._run_gpt2(model._to_sequences(new_tokens[None]), chunk_size,
+                                                      self.past_key_values)
+            self.length += new_tokens.shape[1]
+
+            output = tokens.new_empty(tokens.shape[0], horizon)
+            for step in range(horizon):
+                next_tokens = torch.argmax(model._from_sequences(logits, 1)[0, :, -1], dim=-1)
+                output[:, step] = next_tokens
+                if step < horizon - 1:
+                    logits, past_key_values = model._run_gpt2(
+                        model._to_sequences(next_tokens[None, :, None]), chunk_size, past_key_values
+                    )
+
+            # generated tokens are only predictions, the caches keep the received ones
+            self.past_key_values = [_crop(chunk, self.length) for chunk in past_key_values]
+        return output.cpu().numpy()
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import argparse
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "meg"))
+    from meg_gpt import MatrixGPT2
+    from config_parser import Config
+    from channels import EPOC_X_CHANNELS, PRESETS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='./meg/config.yaml', help='Path to config YAML file')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Path to a MatrixGPT2 state dict')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--context', type=int, default=256, help='Samples of context kept per session')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-delay-ms', type=float, default=5.0)
+    parser.add_argument('--stream-channels', type=int, default=len(EPOC_X_CHANNELS),
+                        help='Channels sent by the clients, the EPOC X headset by default')
+    parser.add_argument('--channel-map', type=str, default='epoc_x', choices=[*PRESETS, 'none'],
+                        help='Preset aligning the stream channels onto the model ones, none to feed them as they are')
+    parser.add_argument('--batch-sessions', action='store_true',
+                        help='Re-run the context of every session in shared micro-batches, instead of keeping '
+                             'the decoder state of each session across chunks')
+    parsed_args = parser.parse_args()
+
+    # MEG-GPT continues the stream as if its channels were MEG sensors: this is a continuation
+    # demo of the serving path, not an EEG -> MEG translation, for which no model is trained yet
+    args = Config(parsed_args.config).to_args()
+    model = MatrixGPT2(args.gpt2_config, args)
+    if parsed_args.checkpoint is not None:
+        model.load_state_dict(torch.load(parsed_args.checkpoint, map_location="cpu", weights_only=True))
+    max_positions = args.gpt2_config.n_positions
+    print("Serving MEG-GPT continuation of the stream, not an EEG -> MEG translation")
+
+    eeg_map = None if parsed_args.channel_map == 'none' else parsed_args.channel_map
+    if parsed_args.batch_sessions:
+        engine = dict(predict_fn=matrix_gpt2_predictor(model))
+    else:
+        engine = dict(decoder_factory=lambda: MatrixGPT2StreamDecoder(model, max_positions))
+    server = StreamingServer(
+        num_channels=parsed_args.stream_channels,
+        context_length=parsed_args.context,
+        max_batch_size=parsed_args.max_batch_size,
+        max_delay_ms=parsed_args.max_delay_ms,
+        channel_map=model_channel_map(parsed_args.stream_channels, args.num_channels, eeg_map),
+        max_positions=max_positions,
+        **engine
+    )
+    asyncio.run(server.serve(parsed_args.host, parsed_args.port))
@@ -0,0 +1,136 @@
+"""
+EGG2MEG_Dataset on small synthetic ds000117-like FIF recordings:
+
+    python -m pytest model/test_dataset.py
+"""
+
+import os
+import sys
+import mne
+import numpy as np
+import pytest
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from dataset import ColumnSplitTransform, EGG2MEG_Dataset, NegativeSampler, WindowTransform
+
+
+def write_recordings(base_path, lengths, num_eeg=4, num_meg=6):
+    """One participant holding a FIF file per length, with `num_eeg` EEG and `num_meg` MEG channels."""
+    path = os.path.join(base_path, "ds000117_R1.0.0/derivatives/meg_derivatives/sub-01/ses-meg/meg")
+    os.makedirs(path)
+    names = [f"EEG{c:03d}" for c in range(num_eeg)] + [f"MEG{c:04d}" for c in range(num_meg)]
+    info = mne.create_info(names, sfreq=100.0, ch_types=["eeg"] * num_eeg + ["mag"] * num_meg)
+
+    rng = np.random.default_rng(0)
+    for run, length in enumerate(lengths):
+        raw = mne.io.RawArray(rng.standard_normal((num_eeg + num_meg, length)), info, verbose=False)
+        raw.save(os.path.join(path, f"sub-01_run-{run:02d}_raw.fif"), verbose=False)
+    return base_path
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    return write_recordings(str(tmp_path), lengths=[300, 250])
+
+
+def assert_same_items(dataset, reference):
+    assert len(dataset) == len(reference)
+    for idx in range(len(dataset)):
+        for tensor, expected in zip(dataset[idx], reference[idx]):
+            assert tensor.shape == expected.shape
+            assert torch.equal(tensor, expected)
+
+
+def test_lazy_windows_match_eager(recordings):
+    # windows are laid out over 1000 columns, most of them past the end of the recordings
+    eager = EGG2MEG_Dataset(recordings, transform=ColumnSplitTransform(4), max_column_size=1000)
+    lazy = EGG2MEG_Dataset(recordings, transform=ColumnSplitTransform(4), max_column_size=1000, lazy=True)
+
+    assert len(lazy) == 8
+    assert_same_items(lazy, eager)
+    # the windows past the end of a recording are zero padded
+    assert not lazy[3][0].any() and not lazy[3][1].any()
+
+
+def test_cropped_windows_stay_within_recordings(recordings):
+    # 300 and 250 recorded samples out of 1000 columns: 5 + 4 windows of 100 every 50 columns
+    kwargs = dict(max_column_size=1000, window_size=100, stride=50, jitter=10, seed=3)
+    eager = EGG2MEG_Dataset(recordings, **kwargs)
+    lazy = EGG2MEG_Dataset(recordings, lazy=True, **kwargs)
+
+    assert len(eager) == 9
+    for epoch in (0, 1):
+        eager.set_epoch(epoch)
+        lazy.set_epoch(epoch)
+        assert_same_items(lazy, eager)
+    # every crop holds recorded samples only
+    assert all(eager[idx][1].all() for idx in range(len(eager)))
+
+
+def test_negatives_come_from_other_recordings():
+    # 3 recordings of 40, 30 and 30 windows
+    sampler = NegativeSampler(100, num_negatives=3, seed=0, recording_ends=[40, 70, 100])
+    sampler.set_epoch(1)
+    negatives = [sampler(idx) for idx in range(100)]
+
+    for idx, drawn in enumerate(negatives):
+        recording = 0 if idx < 40 else 1 if idx < 70 else 2
+        assert len(set(drawn)) == 3
+        assert all(0 <= n < 100 and (0 if n < 40 else 1 if n < 70 else 2) != recording for n in drawn)
+    # offsets from the item differ across items, and the negatives across epochs
+    assert len({tuple(n - idx for n in drawn) for idx, drawn in enumerate(negatives)}) > 90
+    assert negatives[0] == sampler(0)
+    sampler.set_epoch(2)
+    assert sum(sampler(idx) != drawn for idx, drawn in enumerate(negatives)) > 90
+
+
+def test_negatives_of_a_single_recording_exclude_the_item_only():
+    sampler = NegativeSampler(5, num_negatives=4, recording_ends=[5])
+    assert all(sorted(sampler(idx)) == [n for n in range(5) if n != idx] for idx in range(5))
+
+
+def test_one_item_dataset_falls_back_to_pairs(tmp_path):
+    recordings = write_recordings(str(tmp_path), lengths=[300])
+    with pytest.warns(UserWarning, match="Cannot draw 1 negatives"):
+        dataset = EGG2MEG_Dataset(recordings, max_column_size=1000, lazy=True)
+    assert len(dataset) == 1 and len(dataset[0]) == 2
+
+
+def test_negatives_match_across_modes(recordings):
+    kwargs = dict(transform=ColumnSplitTransform(4), max_column_size=1000, num_negatives=3)
+    eager = EGG2MEG_Dataset(recordings, **kwargs)
+    lazy = EGG2MEG_Dataset(recordings, lazy=True, **kwargs)
+    cached = EGG2MEG_Dataset(recordings, cache_dir=os.path.join(recordings, "cache"), **kwargs)
+
+    assert eager[0][2].shape == (3, 6, 250)
+    assert_same_items(lazy, eager)
+    assert_same_items(cached, eager)
+
+
+@pytest.mark.filterwarnings("ignore:Invalid tag")
+@pytest.mark.parametrize("lazy", [False, True])
+def test_unreadable_files_are_reported(recordings, capsys, lazy):
+    path = os.path.join(recordings, "ds000117_R1.0.0/derivatives/meg_derivatives/sub-01/ses-meg/meg")
+    with open(os.path.join(path, "sub-01_run-99_raw.fif"), "wb") as f:
+        f.write(b"not a fif file")
+
+    dataset = EGG2MEG_Dataset(recordings, transform=ColumnSplitTransform(4), max_column_size=1000, lazy=lazy)
+    assert len(dataset) == 8
+    assert [metrics["error"] is None for metrics in dataset.load_metrics] == [True, True, False]
+    assert dataset.load_metrics[2]["file"].endswith("run-99_raw.fif")
+    assert "Failed to load" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("transform", [
+    WindowTransform(8), WindowTransform(8, hop_length=3), WindowTransform(8, hop_length=3, pad_last=False),
+    WindowTransform(8, hop_length=12), ColumnSplitTransform(4),
+])
+@pytest.mark.parametrize("num_cols", [3, 8, 20, 21])
+def test_unfold_matches_windows(transform, num_cols):
+    x = torch.arange(2 * num_cols, dtype=torch.float32).reshape(2, num_cols) + 1
+    windows = transform(x)
+    unfolded = transform.unfold(x)
+
+    assert unfolded.shape == (len(windows), 2, transform.layout(num_cols)[0])
+    assert all(torch.equal(window, expected) for window, expected in zip(unfolded, windows))
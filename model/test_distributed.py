@@ -0,0 +1,121 @@
+"""
+The DistributedDataParallel path on a single machine: two CPU processes over the gloo
+backend, spawned the way torchrun would launch them.
+
+    python -m pytest model/test_distributed.py
+"""
+
+import os
+import sys
+import socket
+import importlib.util
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import distributed
+
+WORLD_SIZE = 2
+
+
+def _eeg_dataset():
+    # model/eeg/dataset.py, loaded under its own name as model/dataset.py is also "dataset"
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eeg", "dataset.py")
+    spec = importlib.util.spec_from_file_location("eeg_dataset", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _gather(value):
+    values = [None] * distributed.world_size()
+    dist.all_gather_object(values, value)
+    return values
+
+
+def _check_sampler_shards():
+    BatchIndexSampler = _eeg_dataset().BatchIndexSampler
+    for num_indices in (20, 21):
+        sampler = BatchIndexSampler(np.arange(100, 100 + num_indices), batch_size=3, shuffle=True,
+                                    num_replicas=distributed.world_size(), rank=distributed.rank())
+        sampler.set_epoch(1)
+        shards = _gather([int(i) for batch in sampler for i in batch])
+
+        assert len(shards[0]) == len(shards[1]), "every rank runs the same number of samples"
+        assert set(shards[0]) | set(shards[1]) == set(range(100, 100 + num_indices))
+        if num_indices % WORLD_SIZE == 0:
+            assert not set(shards[0]) & set(shards[1])
+        else:
+            # a single index is repeated to even the shards out
+            assert len(shards[0]) + len(shards[1]) == num_indices + 1
+
+
+def _check_reductions():
+    rank = distributed.rank()
+    # rank 0 sums 1.0 over 1 item, rank 1 sums 5.0 over 2 items
+    assert distributed.reduce_mean(1.0 + 4.0 * rank, 1 + rank) == 2.0
+    assert distributed.reduce_min(3 + rank) == 3
+    assert _gather(distributed.reduce_mean(1.0 + 4.0 * rank, 1 + rank)) == [2.0, 2.0]
+
+
+def _check_optimizer_step(device):
+    generator = torch.Generator().manual_seed(0)
+    inputs, targets = torch.randn(8, 4, generator=generator), torch.randn(8, 1, generator=generator)
+
+    # a different initialization per rank, DistributedDataParallel broadcasts the one of rank 0
+    torch.manual_seed(distributed.rank())
+    model = distributed.wrap_model(torch.nn.Linear(4, 1).to(device), device)
+    reference = torch.nn.Linear(4, 1)
+    reference.load_state_dict(model.module.state_dict())
+
+    # every rank steps on its half of the batch, the gradients are averaged over the ranks
+    shard = slice(distributed.rank() * 4, (distributed.rank() + 1) * 4)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    torch.nn.functional.mse_loss(model(inputs[shard]), targets[shard]).backward()
+    optimizer.step()
+
+    parameters = _gather([p.detach().clone() for p in model.parameters()])
+    assert all(torch.equal(a, b) for a, b in zip(*parameters))
+
+    # the same step as a single process on the whole batch
+    reference_optimizer = torch.optim.SGD(reference.parameters(), lr=0.1)
+    torch.nn.functional.mse_loss(reference(inputs), targets).backward()
+    reference_optimizer.step()
+    assert all(torch.allclose(a, b, atol=1e-6) for a, b in zip(model.parameters(), reference.parameters()))
+
+
+def _worker(rank, port):
+    # the environment torchrun sets for every process
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(WORLD_SIZE),
+                      MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), CUDA_VISIBLE_DEVICES="")
+    device = distributed.setup(backend="gloo")
+    try:
+        assert distributed.is_distributed() and distributed.world_size() == WORLD_SIZE
+        assert distributed.is_main_process() == (rank == 0)
+        _check_sampler_shards()
+        _check_reductions()
+        _check_optimizer_step(device)
+        distributed.barrier()
+    finally:
+        distributed.cleanup()
+
+
+def test_gloo_two_processes():
+    mp.spawn(_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
+
+
+def test_single_process_fallback():
+    assert not distributed.is_distributed()
+    assert distributed.rank() == 0 and distributed.world_size() == 1
+    assert distributed.reduce_mean(6.0, 3) == 2.0 and distributed.reduce_min(5) == 5
+    model = torch.nn.Linear(2, 2)
+    assert distributed.wrap_model(model, torch.device("cpu")) is model
+    assert distributed.sampler(range(4)) is None
@@ -0,0 +1,57 @@
+"""
+EEGEyeNetDataset on a small synthetic archive, through a default DataLoader and through
+`batch_loader`:
+
+    python -m pytest model/test_eeg_dataset.py
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader, Subset
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from test_distributed import _eeg_dataset
+
+eeg_dataset = _eeg_dataset()
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    # 10 trials of 20 timepoints over 5 electrodes, labels are (trial id, x, y)
+    rng = np.random.default_rng(0)
+    data_file = str(tmp_path / "eegeyenet.npz")
+    np.savez(data_file, EEG=rng.standard_normal((10, 20, 5)), labels=rng.uniform(0, 800, (10, 3)))
+    dataset = eeg_dataset.EEGEyeNetDataset(data_file)
+    dataset.compute_stats(np.arange(8))
+    return dataset
+
+
+def assert_batch(batch, dataset, indices):
+    X, y, idx = batch
+    assert X.shape == (len(indices), 1, 5, 20) and y.shape == (len(indices), 2)
+    assert idx.tolist() == list(indices)
+    for row, index in enumerate(indices):
+        expected_X, expected_y, _ = dataset[index]
+        assert torch.equal(X[row], expected_X) and torch.equal(y[row], expected_y)
+
+
+def test_default_dataloader(dataset):
+    batches = list(DataLoader(dataset, batch_size=4))
+    assert len(batches) == 3
+    for batch, start in zip(batches, range(0, 10, 4)):
+        assert_batch(batch, dataset, range(start, min(start + 4, 10)))
+
+    subset = Subset(dataset, [7, 2, 5])
+    assert_batch(next(iter(DataLoader(subset, batch_size=3))), dataset, [7, 2, 5])
+
+
+def test_batch_loader_matches_samples(dataset):
+    loader = eeg_dataset.batch_loader(Subset(dataset, np.arange(3, 10)), batch_size=3)
+    batches = list(loader)
+    assert [len(batch[2]) for batch in batches] == [3, 3, 1]
+    for batch in batches:
+        assert_batch(batch, dataset, batch[2].tolist())
+    assert sorted(i for batch in batches for i in batch[2].tolist()) == list(range(3, 10))
@@ -0,0 +1,113 @@
+"""
+The streaming server over a local socket, and the stateful MatrixGPT2 session decoder
+against `MatrixGPT2.generate`:
+
+    python -m pytest model/test_stream_server.py
+"""
+
+import os
+import sys
+import json
+import socket
+import asyncio
+import numpy as np
+import pytest
+import torch
+from types import SimpleNamespace
+from transformers import GPT2Config
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "meg"))
+from stream_server import MatrixGPT2StreamDecoder, StreamingServer
+from meg_gpt import MatrixGPT2
+
+
+def build_model(num_channels=6, group_size=1, n_positions=32):
+    gpt2_config = GPT2Config(vocab_size=255, n_positions=n_positions, n_embd=16, n_layer=2, n_head=2,
+                             channel_group_size=group_size)
+    model_args = SimpleNamespace(num_channels=num_channels, vocab_size=255, gpt2_config=gpt2_config)
+    torch.manual_seed(0)
+    return MatrixGPT2(gpt2_config, model_args).eval()
+
+
+@pytest.mark.parametrize("group_size", [1, 3])
+def test_stream_decoder_matches_generate(group_size):
+    model = build_model(group_size=group_size)
+    decoder = MatrixGPT2StreamDecoder(model, max_positions=32)
+    stream = np.random.default_rng(0).integers(0, 255, (6, 40))
+
+    # chunks of 1 to 5 samples, the caches are rebuilt once the stream outgrows 32 positions
+    received, context_start = 0, 0
+    for size in [4, 1, 5, 3, 2, 5, 4, 1, 5]:
+        received += size
+        if decoder.past_key_values is not None and decoder.length + 2 * size > 32:
+            context_start = received - 8
+        context = stream[:, context_start:received]
+
+        outputs = decoder(context, num_new=size, horizon=size)
+        expected = model.generate(torch.from_numpy(context)[None], max_length=size)[0, :, -size:]
+        assert np.array_equal(outputs, expected.numpy())
+        assert decoder.length == context.shape[1]
+
+
+async def _exchange(server, messages):
+    """Sends `messages` over one session, returning the decoded replies."""
+    port = _free_port()
+    serving = asyncio.create_task(server.serve(port=port))
+    try:
+        for _ in range(100):
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                break
+            except OSError:
+                await asyncio.sleep(0.01)
+
+        replies = []
+        for message in messages:
+            writer.write(message if isinstance(message, bytes) else (json.dumps(message) + "\n").encode())
+            await writer.drain()
+            replies.append(json.loads(await reader.readline()))
+        writer.close()
+        return replies
+    finally:
+        serving.cancel()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_server_survives_oversized_messages_and_failures():
+    calls = []
+
+    def predict(tokens, horizon):
+        calls.append((tokens.shape[-1], horizon))
+        if horizon == 3:
+            raise RuntimeError("model failure")
+        return tokens[:, :, -1:].expand(-1, -1, horizon)
+
+    server = StreamingServer(predict, num_channels=2, context_length=8, max_positions=12, max_message_bytes=1024)
+    chunk = lambda n: {"samples": np.ones((n, 2)).tolist()}
+    oversized = (json.dumps({"samples": np.ones((200, 2)).tolist()}) + "\n").encode()
+
+    replies = asyncio.run(_exchange(server, [chunk(2), oversized, chunk(3), chunk(10), {"samples": [[1.0]]}]))
+
+    assert len(replies[0]["samples"]) == 2
+    assert "longer than 1024 bytes" in replies[1]["error"]
+    assert "model failure" in replies[2]["error"]
+    # 10 samples are answered in pieces of at most 12 - 8 positions
+    assert len(replies[3]["samples"]) == 10 and len(replies[3]["samples"][0]) == 2
+    assert all(context + horizon <= 12 for context, horizon in calls)
+    assert "Expected 2 channels" in replies[4]["error"]
+
+
+def test_server_with_session_decoders():
+    model = build_model(num_channels=6)
+    server = StreamingServer(num_channels=6, context_length=16, max_positions=32,
+                             decoder_factory=lambda: MatrixGPT2StreamDecoder(model, max_positions=32))
+    chunks = [{"samples": np.random.default_rng(n).standard_normal((n, 6)).tolist()} for n in (5, 1, 20, 3)]
+
+    replies = asyncio.run(_exchange(server, chunks))
+    assert [len(reply["samples"]) for reply in replies] == [5, 1, 20, 3]
@@ -1,12 +1,15 @@
 import torch
+from contextlib import nullcontext
 from torch.optim import AdamW
 from torch.nn import CrossEntropyLoss
 from waves_transformer import WavesTransformer
 from torch.utils.data import DataLoader
 from dataset import EGG2MEG_Dataset
 import wandb
-from huggingface_hub import Repository
-import os
+import instrumentation
+from checkpointing import CheckpointManager, HubSink, unwrap_model
+from memory import enable_activation_checkpointing, accumulation_group_size
+import distributed
 
 
 def train_waves_transformer(
@@ -16,35 +19,61 @@ def train_waves_transformer(
     learning_rate: float = 1e-4,
     device: str = "cuda" if torch.cuda.is_available() else "cpu",
     repo_name: str = None,  # HF repo name
-    checkpoint_interval: int = 1
+    checkpoint_interval: int = 1,
+    checkpoint_dir: str = "checkpoints",
+    keep_last: int = 3,
+    accumulation_steps: int = 1,  # batches whose gradients are accumulated per optimizer step
+    gradient_checkpointing: bool = False,  # recompute the EEG encoder and GPT2 activations in the backward pass
+    trace_path: str = None,  # JSONL (.jsonl) or Chrome trace (.json) of the step timings
+    profile_steps: tuple = None  # (first step, number of steps) captured with torch.profiler
 ):
-    # Initialize wandb
+    # Initialize wandb, only logging from rank 0 when distributed
     wandb.init(
         project="waves-transformer",
+        mode=None if distributed.is_main_process() else "disabled",
         config={
             "learning_rate": learning_rate,
             "num_epochs": num_epochs,
-            "device": device,
+            "device": str(device),
         }
     )
     
-    # Setup HuggingFace repo if provided
-    if repo_name:
-        repo = Repository(
-            local_dir="checkpoints",
-            clone_from=repo_name,
-            use_auth_token=True
-        )
+    if trace_path or profile_steps:
+        instrumentation.configure(trace_path, profile_steps=profile_steps)
+
+    # Checkpoints are written, and pushed to the HuggingFace repo if provided, in the background
+    # by rank 0, while every rank resumes from them
+    checkpoints = CheckpointManager(
+        checkpoint_dir,
+        keep_last=keep_last,
+        sink=HubSink(repo_name) if repo_name and distributed.is_main_process() else None,
+        upload="all",
+        name_format="epoch_{step}.pt",
+    )
     
     model = model.to(device)
+    if gradient_checkpointing:
+        enable_activation_checkpointing(model)
+    # DistributedDataParallel when launched with torchrun, the dataloader sharding the data with `distributed.sampler`
+    model = distributed.wrap_model(model, torch.device(device))
     optimizer = AdamW(model.parameters(), lr=learning_rate)
     loss_fn = CrossEntropyLoss()
+
+    # Resume from the latest checkpoint, if any
+    start_epoch = 0
+    checkpoint = checkpoints.load_latest(map_location=device)
+    if checkpoint is not None:
+        unwrap_model(model).load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        start_epoch = checkpoint['epoch'] + 1
     
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
+        distributed.set_epoch(train_dataloader, epoch)
         model.train()
         total_loss = 0
+        optimizer.zero_grad()
         
-        for batch_idx, batch in enumerate(train_dataloader):
+        for batch_idx, batch in enumerate(instrumentation.timed_iter(train_dataloader)):
             eeg_tokens, meg_tokens = batch
             eeg_tokens = eeg_tokens.to(device)
             meg_tokens = meg_tokens.to(device)
@@ -54,25 +83,33 @@ def train_waves_transformer(
             input_meg = meg_tokens[:, :-1]
             target_meg = meg_tokens[:, 1:]
             
-            # Zero gradients
-            optimizer.zero_grad()
-            
-            # Forward pass
-            # The output should be of shape [batch_size, sequence_length, vocab_size]
-            outputs = model(eeg_tokens, input_meg)
+            # Optimize once `accumulation_steps` batches were accumulated, DistributedDataParallel
+            # only all-reduces the gradients before that
+            optimizer_step = (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 1 == len(train_dataloader)
+            no_sync = model.no_sync if distributed.is_distributed() and not optimizer_step else nullcontext
+            with no_sync():
+                # Forward pass
+                # The output should be of shape [batch_size, sequence_length, vocab_size]
+                with instrumentation.span("forward"):
+                    outputs = model(eeg_tokens, input_meg)
             
-            # Reshape outputs and targets for loss calculation
-            # outputs: [batch_size * sequence_length, vocab_size]
-            # target_meg: [batch_size * sequence_length]
-            outputs = outputs.view(-1, outputs.size(-1))
-            target_meg = target_meg.view(-1)
+                    # Reshape outputs and targets for loss calculation
+                    # outputs: [batch_size * sequence_length, vocab_size]
+                    # target_meg: [batch_size * sequence_length]
+                    outputs = outputs.view(-1, outputs.size(-1))
+                    target_meg = target_meg.view(-1)
             
-            # Calculate loss
-            loss = loss_fn(outputs, target_meg)
+                    # Calculate loss
+                    loss = loss_fn(outputs, target_meg)
             
-            # Backward pass and optimize
-            loss.backward()
-            optimizer.step()
+                # Backward pass
+                with instrumentation.span("backward"):
+                    (loss / accumulation_group_size(batch_idx, len(train_dataloader), accumulation_steps)).backward()
+            if optimizer_step:
+                with instrumentation.span("optimizer"):
+                    optimizer.step()
+                    optimizer.zero_grad()
+                instrumentation.step()
             
             # Log batch loss to wandb
             wandb.log({
@@ -83,7 +120,8 @@ def train_waves_transformer(
             
             total_loss += loss.item()
         
-        avg_loss = total_loss / len(train_dataloader)
+        # averaged over the batches of every rank
+        avg_loss = distributed.reduce_mean(total_loss, len(train_dataloader))
         print(f"Epoch {epoch+1}/{num_epochs}, Average Loss: {avg_loss:.4f}")
         
         # Log epoch metrics
@@ -92,40 +130,42 @@ def train_waves_transformer(
             "epoch": epoch
         })
         
-        # Save checkpoint to HuggingFace Hub
-        if repo_name and (epoch + 1) % checkpoint_interval == 0:
-            checkpoint_dir = f"checkpoints/epoch_{epoch+1}"
-            os.makedirs(checkpoint_dir, exist_ok=True)
-            
-            # Save model
-            torch.save({
+        # Save checkpoint, without waiting for the write and the upload
+        if (epoch + 1) % checkpoint_interval == 0 and distributed.is_main_process():
+            checkpoints.save({
                 'epoch': epoch,
-                'model_state_dict': model.state_dict(),
+                'model_state_dict': unwrap_model(model).state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'loss': avg_loss,
-            }, f"{checkpoint_dir}/model.pt")
-            
-            # Push to hub
-            repo.push_to_hub(
-                commit_message=f"Epoch {epoch+1} checkpoint"
-            )
+            }, step=epoch + 1, metric=avg_loss)
 
+    checkpoints.close()
+    if trace_path or profile_steps:
+        instrumentation.close()
+        instrumentation.print_summary()
     wandb.finish()
+    distributed.cleanup()
 
 
 if __name__ == "__main__":
+    # One process per device when launched with torchrun, e.g. `torchrun --nproc_per_node 4 train.py`
+    device = distributed.setup()
+
     # Initialize model and prepare data
     model = WavesTransformer()
     
-    # DataLoader returning (eeg_tokens, meg_tokens) pairs
+    # DataLoader returning (eeg_tokens, meg_tokens) pairs, each rank loading its own shard
+    dataset = EGG2MEG_Dataset(num_negatives=0)
+    sampler = distributed.sampler(dataset, shuffle=True)
     train_dataloader = DataLoader(
-        EGG2MEG_Dataset(), batch_size=8, shuffle=True
+        dataset, batch_size=8, shuffle=sampler is None, sampler=sampler, collate_fn=instrumentation.TimedCollate()
     )
     
     # Train the model with HF repo
     train_waves_transformer(
         model, 
         train_dataloader,
+        device=device,
         repo_name="fracapuano/EEG2MEG"
     )
 
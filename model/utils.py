@@ -2,22 +2,95 @@ import os
 import numpy as np
 from tqdm import tqdm
 from pathlib import Path
-from typing import List, Union
-from sklearn.preprocessing import MaxAbsScaler
+from typing import Iterable, Iterator, List, Union
 
 
 class SignalProcessor:
-    """Tokenizes signals into a sequence of integers, amenable to transformer models."""
+    """
+    Tokenizes signals into a sequence of integers, amenable to transformer models.
 
-    def __init__(self, 
-                 min_val: float = -1, 
-                 max_val: float = 1, 
+    Signals are (n_channels, n_samples) matrices. `fit` (or repeated `partial_fit` calls)
+    stores the per-channel maximum absolute value, which `transform` uses to scale each
+    channel to [-1, 1] before clipping and quantizing it to `num_tokens` uint8 levels.
+    """
+
+    def __init__(self,
+                 min_val: float = -1,
+                 max_val: float = 1,
                  num_tokens: int = 255
                 ):
+        if num_tokens > 256:
+            raise ValueError(f"num_tokens={num_tokens} does not fit uint8 tokens")
+
         self.min_val = min_val
         self.max_val = max_val
         self.num_tokens = num_tokens
-        self.maxabs = MaxAbsScaler()
+        self.scale_ = None  # per-channel max absolute value, (n_channels,)
+
+    def fit(self, matrix: np.ndarray) -> "SignalProcessor":
+        """Fits the per-channel scale on a (n_channels, n_samples) matrix."""
+        self.scale_ = None
+        return self.partial_fit(matrix)
+
+    def partial_fit(self, matrix: np.ndarray) -> "SignalProcessor":
+        """Updates the per-channel scale with a (n_channels, n_samples) block."""
+        max_abs = np.abs(matrix).max(axis=1).astype(np.float32)
+        self.scale_ = max_abs if self.scale_ is None else np.maximum(self.scale_, max_abs)
+        return self
+
+    def fit_stream(self, stream: Union[np.ndarray, Iterable[np.ndarray]], block_size: int = 65_536) -> "SignalProcessor":
+        """Fits the per-channel scale block by block, see `transform_stream` for the accepted inputs."""
+        self.scale_ = None
+        for block in self._blocks(stream, block_size):
+            self.partial_fit(block)
+        return self
+
+    def _channel_scale(self) -> np.ndarray:
+        if self.scale_ is None:
+            raise RuntimeError("SignalProcessor must be fitted before transforming")
+        # channels that are constantly zero are left unscaled, as sklearn's MaxAbsScaler does
+        return np.where(self.scale_ == 0, 1, self.scale_)[:, np.newaxis]
+
+    def transform(self, matrix: np.ndarray) -> np.ndarray:
+        """Tokenizes a (n_channels, n_samples) matrix into uint8 tokens of the same shape."""
+        signal = np.divide(matrix, self._channel_scale(), dtype=np.float32)
+        np.clip(signal, self.min_val, self.max_val, out=signal)
+
+        # Normalize to [0, 1], then scale to [0, num_tokens - 1] and round to nearest integer
+        signal -= self.min_val
+        signal *= (self.num_tokens - 1) / (self.max_val - self.min_val)
+        np.rint(signal, out=signal)
+
+        return signal.astype(np.uint8)
+
+    def transform_stream(self, stream: Union[np.ndarray, Iterable[np.ndarray]], block_size: int = 65_536) -> Iterator[np.ndarray]:
+        """
+        Lazily tokenizes a long recording, yielding uint8 blocks of at most `block_size` samples.
+        `stream` is either a (n_channels, n_samples) array, possibly memory-mapped, or an
+        iterable of (n_channels, n) blocks, e.g. chunks coming from a live stream.
+        """
+        for block in self._blocks(stream, block_size):
+            yield self.transform(block)
+
+    def _blocks(self, stream, block_size):
+        if isinstance(stream, np.ndarray):
+            for start in range(0, stream.shape[1], block_size):
+                yield stream[:, start:start + block_size]
+        else:
+            yield from stream
+
+    def detokenize(self, tokens: np.ndarray, rescale: bool = True) -> np.ndarray:
+        """
+        Maps (n_channels, n_samples) tokens back to float32 signals, undoing the per-channel
+        scaling when `rescale` is set, or to [min_val, max_val] otherwise.
+        """
+        signal = tokens.astype(np.float32)
+        signal *= (self.max_val - self.min_val) / (self.num_tokens - 1)
+        signal += self.min_val
+
+        if rescale:
+            signal *= self._channel_scale()
+        return signal
 
     def process_matrix(
             self,
@@ -26,22 +99,5 @@ class SignalProcessor:
         """
         Preprocess a matrix by clipping, scaling and clipping.
         """
-        # normalizing the data
-        matrix = self.maxabs.fit_transform(matrix.T)  # (n_samples, n_channels) -> (n_channels, n_samples)
-
-        matrix = np.clip(
-            matrix,
-            self.min_val,
-            self.max_val
-        )
-
-        # Normalize to [0, 1]
-        signal_normalized = (matrix - self.min_val) / (self.max_val - self.min_val)
-        
-        # Scale to [1, num_tokens] and round to nearest integer
-        tokens = np.round(
-            signal_normalized * (self.num_tokens - 1)
-        ).astype(int)
-
-        return tokens
-
+        # fits on the matrix itself, (n_channels, n_samples) -> (n_samples, n_channels)
+        return self.fit(matrix).transform(matrix).T
@@ -1,47 +1,150 @@
 import os
 import torch
 from torch import nn
-from typing import Optional
-from transformers import load_model
+from typing import Callable, Optional
+from transformers import GPT2Config
+from transformers.models.gpt2.modeling_gpt2 import GPT2Model
+
+
+class EEGConditionedDecoder(nn.Module):
+    """
+    GPT2-based MEG decoder, conditioned on the encoded EEG through a prefix of projected
+    EEG states that precedes the MEG tokens in the GPT2 sequence.
+    """
+    def __init__(self, config: GPT2Config, eeg_dim: int):
+        super().__init__()
+        self.gpt2 = GPT2Model(config)
+        self.eeg_projection = nn.Linear(eeg_dim, config.n_embd)
+        self.head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+
+    def _prefix(self, eeg_states: torch.Tensor) -> torch.Tensor:
+        if eeg_states.dim() == 2:
+            eeg_states = eeg_states.unsqueeze(1)  # B x E -> B x 1 x E
+        return self.eeg_projection(eeg_states)
+
+    def forward(self, eeg_states: torch.Tensor, meg_tokens: torch.Tensor) -> torch.Tensor:
+        """Teacher-forced logits over the MEG positions, B x T x vocab_size."""
+        prefix = self._prefix(eeg_states)
+        x = torch.cat([prefix, self.gpt2.wte(meg_tokens)], dim=1)
+        hidden = self.gpt2(inputs_embeds=x, use_cache=False).last_hidden_state
+        return self.head(hidden[:, prefix.shape[1]:])
+
+    def prefill(self, eeg_states: torch.Tensor, meg_tokens: torch.Tensor, attention_mask: torch.Tensor):
+        """
+        Runs the EEG prefix and the (left-padded) MEG prompt once, returning the next-token
+        logits, the key/value caches and the attention mask over the cached positions.
+        """
+        prefix = self._prefix(eeg_states)
+        attention_mask = torch.cat([attention_mask.new_ones(prefix.shape[:2]), attention_mask], dim=1)
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        x = torch.cat([prefix, self.gpt2.wte(meg_tokens)], dim=1)
+        outputs = self.gpt2(
+            inputs_embeds=x, attention_mask=attention_mask, position_ids=position_ids, use_cache=True
+        )
+        return self.head(outputs.last_hidden_state[:, -1]), outputs.past_key_values, attention_mask
+
+    def step(self, tokens: torch.Tensor, past_key_values, attention_mask: torch.Tensor, position_ids: torch.Tensor):
+        """Runs a single new token per row against the caches, returning its logits and the new caches."""
+        outputs = self.gpt2(
+            inputs_embeds=self.gpt2.wte(tokens),
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True
+        )
+        return self.head(outputs.last_hidden_state[:, -1]), outputs.past_key_values
+
 
 class WavesTransformer(nn.Module):
     """
     Transformer model for turning low-spatial resolution EEG data into high-fidelity MEG.
     """
-    def __init__(self):
+    def __init__(self, encoder: Optional[nn.Module] = None, decoder: Optional[nn.Module] = None):
         """
         The choice of relying on pre-trained models is motivated by the somewhat limited
         amount of paired EEG-MEG data recordings sessions available.
-        
+
         Because of this, relying on pre-trained models priors is essential.
         """
         super().__init__()
 
-        self.encoder = load_model("fracapuano/EEGViT")  # custom EEG-data encoder
-        self.decoder = load_model("fracapuano/MEG-GPT2")  # GPT2-based decoder model
+        if encoder is None or decoder is None:
+            from transformers import load_model
+
+        self.encoder = encoder or load_model("fracapuano/EEGViT")  # custom EEG-data encoder
+        self.decoder = decoder or load_model("fracapuano/MEG-GPT2")  # GPT2-based decoder model
+
+    def encode(self, eeg_tokens: torch.Tensor) -> torch.Tensor:
+        """Encodes the EEG once, so that it can be reused across decoding steps."""
+        return self.encoder(eeg_tokens)
 
     def forward(self, eeg_tokens:torch.Tensor, meg_tokens:torch.Tensor) -> torch.Tensor:
         """Forward pass of the EEG2MEG model."""
-        eeg_tokens = self.encoder(eeg_tokens)
-        meg_tokens = self.encoder(meg_tokens)
+        return self.decoder(self.encode(eeg_tokens), meg_tokens)
 
-        return self.decoder(eeg_tokens, meg_tokens)
-
-    def generate(self, 
-                 eeg_tokens:torch.Tensor, 
+    @torch.inference_mode()
+    def generate(self,
+                 eeg_tokens:torch.Tensor,
                  meg_tokens:torch.Tensor,
-                 max_tokens:int=100
+                 max_tokens:int=100,
+                 meg_lengths:Optional[torch.Tensor]=None,
+                 on_token:Optional[Callable[[int, torch.Tensor], None]]=None
                 ) -> torch.Tensor:
         """
         Autoregressively generate MEG tokens from (1) MEG tokens and (2) EEG tokens.
         Uses greedy sampling from vocabulary.
+
+        The EEG is encoded once and the decoder keeps key/value caches, so each step only
+        runs the newest token. `meg_tokens` is a batch of independent, right-padded prompts
+        whose lengths are given by `meg_lengths` (all of them full-length by default): each
+        row continues from its own position. Returns a B x (T + max_tokens) buffer in which
+        row i holds its prompt followed by its generated tokens, right-padded with zeros.
+        `on_token(step, tokens)` is called with the B tokens of every step as soon as they are
+        generated.
         """
-        eeg_tokens = self.encoder(eeg_tokens)
-        
-        # Generate tokens autoregressively
-        for _ in range(max_tokens):
-            next_token = self.decoder(eeg_tokens, meg_tokens)
-            # Append the new token to meg_tokens
-            meg_tokens = torch.cat([meg_tokens, next_token], dim=1)
-            
-        return meg_tokens
\ No newline at end of file
+        eeg_states = self.encode(eeg_tokens)
+
+        if not hasattr(self.decoder, "prefill"):
+            # decoders without caching support re-run the whole sequence at every step
+            for _ in range(max_tokens):
+                next_token = self.decoder(eeg_states, meg_tokens)
+                # Append the new token to meg_tokens
+                meg_tokens = torch.cat([meg_tokens, next_token], dim=1)
+            return meg_tokens
+
+        batch_size, prompt_len = meg_tokens.shape
+        device = meg_tokens.device
+        if meg_lengths is None:
+            meg_lengths = torch.full((batch_size,), prompt_len, dtype=torch.long, device=device)
+        meg_lengths = torch.as_tensor(meg_lengths, dtype=torch.long, device=device)
+
+        # left-pad the prompts, so that every row's next token is at the last position
+        columns = torch.arange(prompt_len, device=device)
+        attention_mask = (columns >= prompt_len - meg_lengths[:, None]).long()
+        source = (columns - (prompt_len - meg_lengths[:, None])).clamp(min=0)
+        left_padded = torch.gather(meg_tokens, 1, source) * attention_mask
+
+        logits, past_key_values, attention_mask = self.decoder.prefill(eeg_states, left_padded, attention_mask)
+        positions = attention_mask.sum(dim=1, keepdim=True)  # next position of each row
+
+        # preallocated output, the prompts already in place
+        output = meg_tokens.new_zeros(batch_size, prompt_len + max_tokens)
+        output[:, :prompt_len] = meg_tokens * (columns < meg_lengths[:, None])
+        rows = torch.arange(batch_size, device=device)
+
+        for step in range(max_tokens):
+            next_tokens = torch.argmax(logits, dim=-1)
+            output[rows, meg_lengths + step] = next_tokens
+            if on_token is not None:
+                on_token(step, next_tokens)
+
+            if step == max_tokens - 1:
+                break
+
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones(batch_size, 1)], dim=1)
+            logits, past_key_values = self.decoder.step(
+                next_tokens.unsqueeze(-1), past_key_values, attention_mask, positions + step
+            )
+
+        return output
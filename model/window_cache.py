@@ -0,0 +1,188 @@
+"""
+Preprocessed on-disk cache of ds000117 (EEG, MEG) windows.
+
+Building the cache reads every FIF file once, applies the same channel picking, padding and
+column splitting as `EGG2MEG_Dataset`, and writes one pair of .npy shards per recording,
+shaped (num windows, channels, window size), next to a `manifest.json`. Opening the cache
+memory-maps the shards, so later runs start in milliseconds.
+
+The manifest stores a key covering the source files' paths, sizes and mtimes as well as the
+transform parameters: a cache whose key does not match the requested one is stale.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from torch.utils.data import Dataset
+from dataset import load_recording, window_layout, WindowTransform
+from channels import channel_map
+
+MANIFEST = "manifest.json"
+
+
+def cache_key(files, max_column_size, window_size, num_windows, dtype, hop_length=None, eeg_map="ds000117"):
+    """Hash identifying the cache content for these sources and preprocessing parameters."""
+    sources = []
+    for fif_file in files:
+        stat = os.stat(fif_file)
+        sources.append([os.path.abspath(fif_file), stat.st_size, stat.st_mtime_ns])
+
+    parameters = {
+        "sources": sources,
+        "max_column_size": max_column_size,
+        "window_size": window_size,
+        "num_windows": num_windows,
+        "dtype": np.dtype(dtype).name,
+    }
+    if hop_length not in (None, window_size):
+        # only overlapping windows change the key, caches of non-overlapping ones stay valid
+        parameters["hop_length"] = hop_length
+    eeg_map = channel_map(eeg_map)
+    if eeg_map != channel_map("ds000117"):
+        # as for the hop length, caches of the default channel alignment keep their key
+        parameters["eeg_map"] = [eeg_map.source_index.tolist(), eeg_map.target_index.tolist(), eeg_map.num_targets]
+    payload = json.dumps(parameters, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _build_shards(job):
+    """Writes the window shards of a group of recordings, returning one manifest entry per file."""
+    files, first_shard, cache_dir, max_column_size, window_size, hop_length, num_windows, dtype, eeg_map = job
+    # windows over the padded/cropped recordings, which are exactly `max_column_size` wide
+    transform = WindowTransform(window_size, hop_length)
+    entries = []
+    for shard, fif_file in enumerate(files, start=first_shard):
+        try:
+            eeg, meg, _ = load_recording(fif_file, max_column_size, eeg_map)
+        except Exception as error:
+            print(f"Skipping {fif_file}: {error}")
+            continue
+
+        for name, data in (("eeg", eeg), ("meg", meg)):
+            # the last window zero padded, as the transforms do
+            windows = transform.unfold(data)
+            np.save(os.path.join(cache_dir, f"{name}_{shard:05d}.npy"), windows.numpy().astype(dtype))
+
+        entries.append({
+            "source": fif_file,
+            "eeg": f"eeg_{shard:05d}.npy",
+            "meg": f"meg_{shard:05d}.npy",
+            "num_windows": num_windows,
+        })
+    return entries
+
+
+def build_window_cache(files, cache_dir, max_column_size=546_700, transform=None, dtype="float32", num_workers=1,
+                       eeg_map="ds000117"):
+    """
+    Preprocesses `files` into `cache_dir`, returning the written manifest.
+    With `num_workers > 1`, the recordings of each participant are processed in a separate process.
+    """
+    window_size, hop_length, num_windows = window_layout(transform, max_column_size)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # one job per participant, i.e. per directory holding the recordings
+    jobs, groups = [], {}
+    for fif_file in files:
+        groups.setdefault(os.path.dirname(fif_file), []).append(fif_file)
+    first_shard = 0
+    for group in groups.values():
+        jobs.append((group, first_shard, cache_dir, max_column_size, window_size, hop_length, num_windows, dtype, eeg_map))
+        first_shard += len(group)
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_build_shards, jobs))
+    else:
+        results = [_build_shards(job) for job in jobs]
+
+    manifest = {
+        "key": cache_key(files, max_column_size, window_size, num_windows, dtype, hop_length, eeg_map),
+        "dtype": np.dtype(dtype).name,
+        "window_size": window_size,
+        "shards": [entry for entries in results for entry in entries],
+    }
+    # the manifest is written last, an interrupted build is never mistaken for a valid cache
+    with open(os.path.join(cache_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class WindowCache(Dataset):
+    """Memory-mapped (EEG, MEG) windows of a cache written by `build_window_cache`."""
+
+    def __init__(self, cache_dir, key=None):
+        with open(os.path.join(cache_dir, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if key is not None and self.manifest["key"] != key:
+            raise ValueError(f"Window cache at {cache_dir} is stale, rebuild it")
+
+        self.eeg = [np.load(os.path.join(cache_dir, shard["eeg"]), mmap_mode="r") for shard in self.manifest["shards"]]
+        self.meg = [np.load(os.path.join(cache_dir, shard["meg"]), mmap_mode="r") for shard in self.manifest["shards"]]
+        self.offsets = np.cumsum([0] + [shard["num_windows"] for shard in self.manifest["shards"]])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _locate(self, idx):
+        shard = np.searchsorted(self.offsets, idx, side="right") - 1
+        return shard, idx - self.offsets[shard]
+
+    def __getitem__(self, idx):
+        shard, window = self._locate(idx)
+        eeg = torch.from_numpy(np.array(self.eeg[shard][window], dtype=np.float32))
+        meg = torch.from_numpy(np.array(self.meg[shard][window], dtype=np.float32))
+        return eeg, meg
+
+    def meg_window(self, idx):
+        """The MEG window of item `idx` alone, without reading its EEG."""
+        shard, window = self._locate(idx)
+        return torch.from_numpy(np.array(self.meg[shard][window], dtype=np.float32))
+
+
+def open_window_cache(files, cache_dir, max_column_size=546_700, transform=None, dtype="float32", num_workers=1,
+                      eeg_map="ds000117"):
+    """Opens the cache in `cache_dir`, (re)building it first when missing or stale."""
+    window_size, hop_length, num_windows = window_layout(transform, max_column_size)
+    key = cache_key(files, max_column_size, window_size, num_windows, dtype, hop_length, eeg_map)
+
+    try:
+        return WindowCache(cache_dir, key=key)
+    except (FileNotFoundError, ValueError):
+        print(f"Building window cache in {cache_dir}...")
+        build_window_cache(files, cache_dir, max_column_size, transform, dtype=dtype, num_workers=num_workers,
+                           eeg_map=eeg_map)
+        return WindowCache(cache_dir, key=key)
+
+
+if __name__ == "__main__":
+    import argparse
+    from dataset import ColumnSplitTransform, WindowTransform, EGG2MEG_Dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base-path', type=str, required=True, help='Directory holding ds000117_R1.0.0')
+    parser.add_argument('--cache-dir', type=str, required=True)
+    parser.add_argument('--num-splits', type=int, default=None)
+    parser.add_argument('--window-size', type=int, default=None, help='Fixed-size windows instead of --num-splits')
+    parser.add_argument('--hop-length', type=int, default=None, help='Columns between window starts, the window size by default')
+    parser.add_argument('--max-participants', type=int, default=None)
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count())
+    parsed_args = parser.parse_args()
+
+    if parsed_args.window_size:
+        transform = WindowTransform(parsed_args.window_size, parsed_args.hop_length)
+    else:
+        transform = ColumnSplitTransform(parsed_args.num_splits) if parsed_args.num_splits else None
+    dataset = EGG2MEG_Dataset(
+        parsed_args.base_path,
+        transform=transform,
+        max_participants=parsed_args.max_participants,
+        cache_dir=parsed_args.cache_dir,
+        cache_dtype=parsed_args.dtype,
+        num_workers=parsed_args.num_workers
+    )
+    print(f"{len(dataset)} windows cached in {parsed_args.cache_dir}")